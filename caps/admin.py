@@ -1,30 +1,65 @@
 from django.contrib import admin
-from caps.models import CapsForm, Drug, PregnancyProblem, HeartDisease, MedicalProblem, DrugUse
+from caps.models import (EditConflict, CapsForm, Drug, PregnancyProblem, HeartDisease, MedicalProblem, DrugUse,
+                         PdfBatch, FollowUp, FieldChange)
+from caps import audit, pdf, replicas, search
+from caps.filters import CreatedByListFilter
+from caps.forms import CapsFormAdminForm, HistoryInlineFormSet, UserChoiceField
+from caps.widgets import DrugAutocompleteWidget
+from caps.paginator import KeysetChangeList
+from django.core.urlresolvers import reverse
+from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
 from django.utils.encoding import smart_unicode
 from django.conf.urls import patterns
 
 class PreviousPregnancyInline(admin.TabularInline):
     model = PregnancyProblem
+    formset = HistoryInlineFormSet
     extra = 0
 #    verbose_name = "If appropriate, please provide additional information about previous pregnancy problems"
 
 
 class HeartDiseaseInline(admin.TabularInline):
     model = HeartDisease
+    formset = HistoryInlineFormSet
     extra = 0
 #    verbose_name = "If appropriate, please provide additional information about pre-disposing factors for heart disease"
 
 
 class MedicalProblemInline(admin.TabularInline):
     model = MedicalProblem
+    formset = HistoryInlineFormSet
     extra = 0
 
 
 class DrugUseInline(admin.TabularInline):
     model = DrugUse
+    formset = HistoryInlineFormSet
     extra = 0
     fields = ('drug', 'last_use_unknown', 'last_use')
 
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        # Look drugs up as the user types rather than listing the whole dictionary in every row
+        if db_field.name == 'drug':
+            kwargs['widget'] = DrugAutocompleteWidget
+        return super(DrugUseInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+def print_pdf(modeladmin, request, queryset):
+    """
+    Print the selected forms as PDF. The rendering runs in a separate process and the user is sent to a page that
+    follows its progress.
+    """
+    if pdf.A4 is None:
+        modeladmin.message_user(request, pdf.MISSING_REPORTLAB)
+        return None
+    batch = PdfBatch(created_by=request.user)
+    batch.set_form_ids(list(queryset.order_by('pk').values_list('pk', flat=True)))
+    batch.save()
+    pdf.start_batch(batch)
+    return HttpResponseRedirect(reverse('caps_pdf_progress', args=[batch.pk]))
+print_pdf.short_description = "Print selected forms as PDF"
+
 
 class CapsFormAdmin(admin.ModelAdmin):
     # Bring back the first and last name from the User record for display
@@ -60,9 +95,10 @@ class CapsFormAdmin(admin.ModelAdmin):
     prev_med.short_description = "Medical Problems"
     prev_med.boolean = True
     # Set admin display options
+    form = CapsFormAdminForm
     list_display = ('case_id', 'created_name', 'created_on', 'smoking', 'prev_preg', 'heart_dis',
                     'cardiac_arr', 'drug_u', 'prev_med')
-    list_filter = ('created_by', 'created_on', 'smoking', 'previous_pregnancy_problem', 'heart_disease',
+    list_filter = (CreatedByListFilter, 'created_on', 'smoking', 'previous_pregnancy_problem', 'heart_disease',
                    'cardiac_arrest', 'drug_use', 'previous_medical_problem')
     fieldsets = [
         (None, {
@@ -71,6 +107,7 @@ class CapsFormAdmin(admin.ModelAdmin):
                 'case_reported',
                 'created_by',
                 # created_on
+                'expected_due_date',
             ],
             'description': '<p class="example">Please do not enter any personally identifiable information (e.g. name, address, or '
                            'hospital number) on this form<br/>'
@@ -110,8 +147,79 @@ class CapsFormAdmin(admin.ModelAdmin):
             ]
         })
     ]
+    # The search box is answered from the full-text index by full_text_search, so this only makes the admin show it
+    search_fields = ('case_id',)
+    # Newest first, with the id as a tie breaker so the keyset paginator has a unique position for each row
+    ordering = ('-created_on', '-id')
     inlines = [PreviousPregnancyInline, HeartDiseaseInline, MedicalProblemInline, DrugUseInline]
     save_on_top = True
+    actions = [print_pdf]
+
+    def queryset(self, request):
+        # Join in the creator so that created_name doesn't run a query for every row on the page
+        return super(CapsFormAdmin, self).queryset(request).select_related('created_by')
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        # List the users from the cache rather than reading every one of them for each page
+        if db_field.name == 'created_by':
+            kwargs['form_class'] = UserChoiceField
+        return super(CapsFormAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def save_form(self, request, form, change):
+        obj = super(CapsFormAdmin, self).save_form(request, form, change)
+        # The form is valid, so the inline formsets can now check their histories against its answers
+        obj.validate_histories = True
+        return obj
+
+    def save_model(self, request, obj, form, change):
+        # The audit trail of the form and its inlines is written by one INSERT once they are all saved, still inside
+        # the admin's transaction
+        audit.start_batch()
+        super(CapsFormAdmin, self).save_model(request, obj, form, change)
+
+    def save_related(self, request, form, formsets, change):
+        super(CapsFormAdmin, self).save_related(request, form, formsets, change)
+        audit.flush()
+
+    def delete_model(self, request, obj):
+        with audit.batch():
+            super(CapsFormAdmin, self).delete_model(request, obj)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        # CapsFormAdminForm reports changes saved by someone else since the form was opened, so this is only reached
+        # when both save the same answers in the moment between validating the form and saving it. The save has been
+        # rolled back, and the user is shown the form as it was saved.
+        try:
+            return super(CapsFormAdmin, self).change_view(request, object_id, form_url, extra_context)
+        except EditConflict as e:
+            audit.discard()
+            self.message_user(request, u'{0}. Your changes have not been saved.'.format(e))
+            return HttpResponseRedirect(request.get_full_path())
+
+    def full_text_search(self, queryset, text):
+        # Searches the free text answers and history details (see caps.search)
+        return search.matching(queryset, text)
+
+    def history_view(self, request, object_id, extra_context=None):
+        # Show the audit trail of the form's answers and histories below the admin's own list of saves
+        extra_context = dict(extra_context or {},
+                             field_changes=audit.form_history(object_id).select_related('changed_by'))
+        return super(CapsFormAdmin, self).history_view(request, object_id, extra_context)
+
+    def changelist_view(self, request, extra_context=None):
+        # The list is read from a replica, rendering it here while still inside the block, but not the actions posted
+        # from it
+        if request.method == 'POST':
+            return super(CapsFormAdmin, self).changelist_view(request, extra_context)
+        with replicas.use_replica():
+            response = super(CapsFormAdmin, self).changelist_view(request, extra_context)
+            if isinstance(response, TemplateResponse):
+                response.render()
+            return response
+
+    def get_changelist(self, request, **kwargs):
+        # Page through the list by (created_on, id) rather than OFFSET so that deep pages cost the same as the first
+        return KeysetChangeList
 
 #    # Add some custom admin views to export the data
 #    def get_urls(self):
@@ -148,3 +256,57 @@ class DrugAdmin(admin.ModelAdmin):
     save_on_top = True
 
 admin.site.register(Drug, DrugAdmin)
+
+
+class PdfBatchAdmin(admin.ModelAdmin):
+    # Batches are created by the print action on the forms, and only followed and downloaded from here
+    def progress(self, obj):
+        return u'<a href="{0}">{1} of {2} ({3}%)</a>'.format(
+            reverse('caps_pdf_progress', args=[obj.pk]), obj.done, obj.total, obj.percent()
+        )
+    progress.short_description = "Progress"
+    progress.allow_tags = True
+    list_display = ('id', 'created_by', 'created_on', 'status', 'progress', 'finished_on')
+    list_filter = ('status',)
+    readonly_fields = ('created_by', 'created_on', 'finished_on', 'status', 'total', 'done', 'archive', 'error')
+    exclude = ('form_ids',)
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(PdfBatch, PdfBatchAdmin)
+
+
+class FollowUpAdmin(admin.ModelAdmin):
+    # Follow-ups are queued as forms are saved and sent by caps_send_followups, so they are only followed from here
+    list_display = ('form', 'recipient', 'due_on', 'status', 'attempts', 'sent_on')
+    list_filter = ('status',)
+    list_select_related = True
+    date_hierarchy = 'due_on'
+    readonly_fields = ('form', 'recipient', 'expected_due_date', 'due_on', 'status', 'attempts', 'claimed_by',
+                       'claimed_until', 'sent_on', 'error')
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(FollowUp, FollowUpAdmin)
+
+
+class FieldChangeAdmin(admin.ModelAdmin):
+    # The audit trail is written as forms are saved (see caps.audit), and is never changed, so it is only read from here
+    list_display = ('changed_on', 'form_id', 'model', 'object_id', 'field', 'action', 'old_value', 'new_value',
+                    'changed_by')
+    list_filter = ('action', 'model')
+    list_select_related = True
+    date_hierarchy = 'changed_on'
+    ordering = ('-changed_on', '-id')
+    readonly_fields = ('form_id', 'model', 'object_id', 'field', 'action', 'old_value', 'new_value', 'changed_by',
+                       'changed_on')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+admin.site.register(FieldChange, FieldChangeAdmin)
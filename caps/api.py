@@ -0,0 +1,384 @@
+"""
+Read-only JSON API (version 1) over the CAPS forms and their histories, for dashboards and other machine clients.
+
+    /api/v1/forms/          the forms, newest first, a page at a time
+    /api/v1/forms/<id>/     a single form
+
+Pages are addressed by cursor (after= or before=, as given in the next and previous links) with the same keyset
+pagination as the admin changelist, and limit= sets the page size. fields= picks the fields returned, e.g.
+fields=id,case_id,smoking,drug_history. The filters are the same as the changelist's: created_by, created_on__gte and
+created_on__lt, smoking and the Yes/No questions.
+
+Each form's full serialisation is kept in the api_forms cache region (see caps.cache) until it or its histories change,
+so a page is read as just its ids and modification times, with the rest from the cache, and only the forms missing
+from it are read in full. The fields asked for are picked out of the cached serialisation.
+
+Every response carries an ETag, and a single form a Last-Modified too, so clients polling for changes get a 304 when
+nothing has changed. The ETag of a page is worked out from the ids and modification times of its rows, which are read
+without the histories, so an unchanged page is answered without fetching or serialising anything else. The list has no
+Last-Modified, as it can't reflect forms being deleted.
+
+Clients authenticate as a staff user, with either the admin session or HTTP Basic authentication.
+"""
+import base64
+import hashlib
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from functools import wraps
+from django.contrib.admin import SimpleListFilter
+from django.contrib.auth import authenticate
+from django.core.paginator import InvalidPage
+from django.core.urlresolvers import reverse
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.http import urlencode
+from django.views.decorators.http import condition, require_GET
+from caps import cache, choices, replicas
+from caps.importer import parse_boolean, parse_datetime, DATE_FORMATS, DATETIME_FORMATS
+from caps.models import CapsForm, DrugUse, PregnancyProblem, HeartDisease, MedicalProblem
+from caps.paginator import AFTER_VAR, BEFORE_VAR, KeysetPaginator
+
+VERSION = 1
+
+FIELDS_VAR = 'fields'
+LIMIT_VAR = 'limit'
+
+# Page size, by default and at most
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+DISPLAY_SUFFIX = '_display'
+
+# The inline histories, by the related name they are returned under
+HISTORIES = (
+    ('previous_pregnancy_history', PregnancyProblem),
+    ('heart_disease_history', HeartDisease),
+    ('previous_medical_history', MedicalProblem),
+    ('drug_history', DrugUse),
+)
+
+# Columns every query reads, as the paginator and the ETag need them
+KEY_COLUMNS = ('id', 'created_on', 'modified_on')
+
+FORM_FIELDS = [field.name for field in CapsForm._meta.fields]
+
+# Fields that have a label as well as a code, returned as e.g. smoking_display. The Yes/No questions have choices too,
+# but true and false speak for themselves.
+DISPLAY_FIELDS = [field.name for field in CapsForm._meta.fields
+                  if field.choices and field.get_internal_type() not in ('BooleanField', 'NullBooleanField')]
+
+ALL_FIELDS = (FORM_FIELDS + ['created_by_name'] + [name + DISPLAY_SUFFIX for name in DISPLAY_FIELDS] +
+              [name for name, model in HISTORIES])
+
+API_FORMS = cache.form_region('api_forms')
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super(ApiError, self).__init__(message)
+        self.message = message
+        self.status = status
+
+
+def json_response(data, status=200):
+    response = HttpResponse(json.dumps(data), content_type='application/json', status=status)
+    # Clients may keep responses, but must check with us before using them again
+    response['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response
+
+
+def error_response(message, status=400):
+    return json_response({'error': message}, status=status)
+
+
+def staff_api(view):
+    """
+    Only allow staff users, logged in to the admin or authenticated with HTTP Basic authentication, and answer
+    anyone else with a 401 rather than the admin's login page
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        user = request.user
+        if not user.is_authenticated() and 'HTTP_AUTHORIZATION' in request.META:
+            method, _, credentials = request.META['HTTP_AUTHORIZATION'].partition(' ')
+            if method.lower() == 'basic':
+                try:
+                    username, _, password = base64.b64decode(credentials.strip()).partition(':')
+                except TypeError:
+                    username = password = None
+                if username:
+                    user = authenticate(username=username, password=password) or user
+        if not (user.is_active and user.is_staff):
+            response = error_response('Authentication as a staff user is required', status=401)
+            response['WWW-Authenticate'] = 'Basic realm="CAPS API"'
+            return response
+        request.user = user
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+# Filters. Each parameter the changelist filters by is accepted here, with its value parsed according to its field.
+
+def filter_parameters():
+    """
+    The query string parameters accepted as filters, taken from CapsFormAdmin.list_filter
+    """
+    from caps.admin import CapsFormAdmin
+    parameters = []
+    for list_filter in CapsFormAdmin.list_filter:
+        if isinstance(list_filter, type) and issubclass(list_filter, SimpleListFilter):
+            parameters.append(list_filter.parameter_name)
+        elif CapsForm._meta.get_field(list_filter).get_internal_type() == 'DateTimeField':
+            # As the admin's date filter, a range of created_on__gte=... and created_on__lt=...
+            parameters.extend([list_filter + '__gte', list_filter + '__lt'])
+        else:
+            parameters.append(list_filter)
+    return parameters
+
+
+def parse_filter(parameter, value):
+    field = CapsForm._meta.get_field(parameter.split('__')[0])
+    internal_type = field.get_internal_type()
+    if internal_type == 'ForeignKey':
+        return int(value)
+    if internal_type == 'BooleanField':
+        return parse_boolean(value)
+    if internal_type == 'NullBooleanField':
+        return parse_boolean(value, null=True)
+    if internal_type == 'DateTimeField':
+        when = parse_datetime(value, DATETIME_FORMATS + DATE_FORMATS)
+        return timezone.make_aware(when, timezone.get_current_timezone())
+    if field.choices:
+        code = choices.get(CapsForm, field.name).code(value)
+        if code is None:
+            raise ValueError(u"'{0}' is not one of the choices".format(value))
+        return code
+    return value
+
+
+def filter_forms(queryset, params):
+    lookups = {}
+    for parameter in filter_parameters():
+        if parameter in params:
+            try:
+                value = parse_filter(parameter, params[parameter])
+            except ValueError as e:
+                raise ApiError(u'{0}: {1}'.format(parameter, e))
+            lookups[parameter if value is not None else parameter + '__isnull'] = True if value is None else value
+    return queryset.filter(**lookups)
+
+
+def parse_fields(params):
+    if not params.get(FIELDS_VAR):
+        return ALL_FIELDS
+    fields = [name.strip() for name in params[FIELDS_VAR].split(',') if name.strip()]
+    unknown = [name for name in fields if name not in ALL_FIELDS]
+    if unknown:
+        raise ApiError(u'Unknown fields: {0}'.format(u', '.join(unknown)))
+    return fields
+
+
+def form_queryset(fields):
+    """
+    The forms, reading only the columns and histories needed for the given fields
+    """
+    columns = set(KEY_COLUMNS)
+    for name in fields:
+        if name in FORM_FIELDS:
+            columns.add(name)
+        elif name.endswith(DISPLAY_SUFFIX) and name[:-len(DISPLAY_SUFFIX)] in DISPLAY_FIELDS:
+            columns.add(name[:-len(DISPLAY_SUFFIX)])
+    queryset = CapsForm.objects.all()
+    if 'created_by_name' in fields:
+        columns.add('created_by')
+        queryset = queryset.select_related('created_by')
+    queryset = queryset.only(*columns)
+    lookups = [name if name != 'drug_history' else 'drug_history__drug' for name, model in HISTORIES if name in fields]
+    if lookups:
+        queryset = queryset.prefetch_related(*lookups)
+    return queryset
+
+
+def check_parameters(params):
+    known = set(filter_parameters() + [FIELDS_VAR, LIMIT_VAR, AFTER_VAR, BEFORE_VAR])
+    unknown = sorted(name for name in params if name not in known)
+    if unknown:
+        raise ApiError(u'Unknown parameters: {0}'.format(u', '.join(unknown)))
+
+
+def parse_limit(params):
+    try:
+        limit = int(params.get(LIMIT_VAR, DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError(u'{0} must be a number'.format(LIMIT_VAR))
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ApiError(u'{0} must be between 1 and {1}'.format(LIMIT_VAR, MAX_LIMIT))
+    return limit
+
+
+def get_page(queryset, params):
+    paginator = KeysetPaginator(queryset, parse_limit(params), after=params.get(AFTER_VAR),
+                                before=params.get(BEFORE_VAR))
+    try:
+        return paginator.page()
+    except InvalidPage as e:
+        raise ApiError(unicode(e))
+
+
+def etag(*parts):
+    return hashlib.sha1(json.dumps([VERSION] + list(parts), default=unicode)).hexdigest()
+
+
+# Serialisation
+
+def json_value(value):
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = value.astimezone(timezone.utc)
+        return value.isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def serialise_history(name, entry):
+    if name == 'drug_history':
+        return {
+            'id': entry.pk,
+            'drug': entry.drug_id,
+            'drug_name': entry.drug.name,
+            'last_use': json_value(entry.last_use),
+            'last_use_unknown': entry.last_use_unknown,
+        }
+    return {
+        'id': entry.pk,
+        'type': entry.type,
+        'type_display': choices.label(entry, 'type'),
+        'details': entry.details,
+    }
+
+
+def serialise_form(form, fields):
+    data = {}
+    for name in fields:
+        if name in FORM_FIELDS:
+            field = CapsForm._meta.get_field(name)
+            data[name] = json_value(getattr(form, field.attname))
+        elif name == 'created_by_name':
+            data[name] = u'{0} {1}'.format(form.created_by.first_name, form.created_by.last_name)
+        elif name.endswith(DISPLAY_SUFFIX):
+            data[name] = choices.label(form, name[:-len(DISPLAY_SUFFIX)])
+        else:
+            data[name] = [serialise_history(name, entry) for entry in getattr(form, name).all()]
+    return data
+
+
+def serialised_forms(pks, fields):
+    """
+    A dictionary of id -> serialisation of each of the forms with the given ids that exists, with only the given
+    fields. The full serialisations are taken from the cache where possible.
+    """
+    def build(missing):
+        return dict((form.pk, serialise_form(form, ALL_FIELDS))
+                    for form in form_queryset(ALL_FIELDS).filter(pk__in=missing))
+
+    return dict((pk, dict((name, data[name]) for name in fields))
+                for pk, data in API_FORMS.get_many(pks, build).items())
+
+
+# Views
+
+def list_etag(request):
+    params = request.GET
+    try:
+        check_parameters(params)
+        fields = parse_fields(params)
+        # The same page, but only the key columns and without the histories
+        page = get_page(filter_forms(CapsForm.objects.only(*KEY_COLUMNS), params), params)
+    except ApiError:
+        # Leave the view to report the problem
+        return None
+    rows = [(form.pk, form.modified_on) for form in page.object_list]
+    return etag(fields, sorted(params.items()), rows, page.has_next(), page.has_previous())
+
+
+def page_url(request, params, **changes):
+    params = dict(params.items())
+    for name in (AFTER_VAR, BEFORE_VAR):
+        params.pop(name, None)
+    params.update(changes)
+    return request.build_absolute_uri(u'{0}?{1}'.format(reverse('caps_api_forms'), urlencode(sorted(params.items()))))
+
+
+@require_GET
+@staff_api
+@replicas.use_replica()
+@condition(etag_func=list_etag)
+def form_list(request):
+    params = request.GET
+    try:
+        check_parameters(params)
+        fields = parse_fields(params)
+        page = get_page(filter_forms(CapsForm.objects.only(*KEY_COLUMNS), params), params)
+    except ApiError as e:
+        return error_response(e.message, e.status)
+    pks = [form.pk for form in page.object_list]
+    results = serialised_forms(pks, fields)
+    return json_response({
+        'version': VERSION,
+        'results': [results[pk] for pk in pks if pk in results],
+        'next': page_url(request, params, **{AFTER_VAR: page.next_cursor()}) if page.has_next() else None,
+        'previous': page_url(request, params, **{BEFORE_VAR: page.previous_cursor()}) if page.has_previous() else None,
+    })
+
+
+def form_modified(request, form_id):
+    # Cached on the request, as the ETag and Last-Modified functions both need it
+    if not hasattr(request, '_caps_modified_on'):
+        request._caps_modified_on = CapsForm.objects.filter(pk=form_id).values_list('modified_on', flat=True)[:1]
+        request._caps_modified_on = request._caps_modified_on[0] if request._caps_modified_on else None
+    return request._caps_modified_on
+
+
+def detail_etag(request, form_id):
+    modified_on = form_modified(request, form_id)
+    if modified_on is None:
+        return None
+    return etag(request.GET.get(FIELDS_VAR, u''), int(form_id), modified_on)
+
+
+@require_GET
+@staff_api
+@replicas.use_replica()
+@condition(etag_func=detail_etag, last_modified_func=form_modified)
+def form_detail(request, form_id):
+    try:
+        unknown = sorted(name for name in request.GET if name != FIELDS_VAR)
+        if unknown:
+            raise ApiError(u'Unknown parameters: {0}'.format(u', '.join(unknown)))
+        fields = parse_fields(request.GET)
+    except ApiError as e:
+        return error_response(e.message, e.status)
+    result = serialised_forms([int(form_id)], fields).get(int(form_id))
+    if result is None:
+        return error_response(u'No form with id {0}'.format(form_id), status=404)
+    return json_response({'version': VERSION, 'result': result})
+
+
+# A change to a history changes the form as the API returns it, so bring its modification time forward too, and move
+# its version on so that someone editing the form at the same time is told
+
+def touch_form(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    form_id = instance.person_id if sender is DrugUse else instance.form_id
+    CapsForm.objects.filter(pk=form_id).update(modified_on=timezone.now(), version=F('version') + 1)
+
+for model in (PregnancyProblem, HeartDisease, MedicalProblem, DrugUse):
+    post_save.connect(touch_form, sender=model, dispatch_uid='caps_api_touch_form_save')
+    post_delete.connect(touch_form, sender=model, dispatch_uid='caps_api_touch_form_delete')
@@ -0,0 +1,264 @@
+"""
+Audit trail of the changes made to the forms and their histories, for governance.
+
+Each save of a CapsForm or a history entry adds a FieldChange row for each field it changed, holding the old and new
+values as text. Adding an entry is a single row, and deleting one a row for each of its fields, so that it can still be
+rebuilt once it's gone. The rows of a single save are written together by one INSERT in its transaction. Inside a
+batch() (e.g. the admin saving a form with its inlines, or deleting one with its histories) the rows of every save are
+held back and written by one INSERT at the end, still inside the transaction, rather than one per object. A form's own
+changes come from CapsForm.save, which already knows which fields it changed; a history entry's are found by reading its
+previous values before it is saved. Changes are recorded against the user making the request (see AuditMiddleware).
+
+Changes made without the model signals (QuerySet.update(), the importer's bulk_create) aren't recorded. A form that
+was imported, or created before the trail was started, has no row for its creation, and its created_on is taken as
+when it was added instead.
+
+The trail is indexed by form and time, and by user and time (caps/sql/fieldchange.sql), for form_history() and
+changes_by(). form_as_of() rebuilds a form as it was at a given time from the form as it is now and only the changes
+made since then.
+"""
+import threading
+from datetime import date
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.utils import timezone
+from django.utils.encoding import force_unicode
+from caps import validation
+from caps.models import CapsForm, DrugUse, FieldChange, HeartDisease, MedicalProblem, PregnancyProblem, same_value
+
+ADDED = u'c'
+CHANGED = u'u'
+DELETED = u'd'
+
+# Name of each history, its model and the attname of its foreign key to the form
+HISTORIES = (
+    (validation.PREGNANCY, PregnancyProblem, 'form_id'),
+    (validation.HEART, HeartDisease, 'form_id'),
+    (validation.MEDICAL, MedicalProblem, 'form_id'),
+    (validation.DRUGS, DrugUse, 'person_id'),
+)
+
+_local = threading.local()
+
+
+def current_user_id():
+    return getattr(_local, 'user_id', None)
+
+
+class AuditMiddleware(object):
+    """
+    Notes the user making each request, so that the changes saved by it are recorded against them. It must come after
+    AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        user = getattr(request, 'user', None)
+        _local.user_id = user.pk if user is not None and user.is_authenticated() else None
+        # Anything held back by an earlier request on this thread that failed before writing it was rolled back
+        discard()
+
+    def process_response(self, request, response):
+        _local.user_id = None
+        discard()
+        return response
+
+
+def start_batch():
+    """
+    Hold back the rows of the saves and deletes made from now on in this thread, until flush() or discard()
+    """
+    _local.pending = []
+
+
+def flush():
+    """
+    Write the rows held back since start_batch() with one INSERT per database, and stop holding them back
+    """
+    pending, _local.pending = getattr(_local, 'pending', None), None
+    by_database = {}
+    for using, rows in pending or []:
+        by_database.setdefault(using, []).extend(rows)
+    for using, rows in by_database.items():
+        write(rows, using)
+
+
+def discard():
+    """
+    Drop the rows held back, e.g. when the transaction they were saved in has been rolled back
+    """
+    _local.pending = None
+
+
+class batch(object):
+    """
+    Hold back the rows recorded inside the block, and write them together at the end of it, or drop them if it raises
+    """
+    def __enter__(self):
+        start_batch()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            flush()
+        else:
+            discard()
+
+
+def write(rows, using):
+    # SQLite limits the number of parameters in a statement, so a large batch takes several INSERTs there
+    size = 999 // len(FieldChange._meta.fields) if connections[using].vendor == 'sqlite' else len(rows)
+    for start in range(0, len(rows), size):
+        FieldChange.objects.using(using).bulk_create(rows[start:start + size])
+
+
+def audited_fields(model):
+    # The fields whose changes are recorded: all but the id, the form's version and its modification time
+    return [field for field in model._meta.fields if not field.primary_key and field.attname != 'version' and
+            not getattr(field, 'auto_now', False)]
+
+
+def form_id(instance):
+    return instance.person_id if isinstance(instance, DrugUse) else instance.form_id
+
+
+def serialise(value):
+    if value is None:
+        return None
+    if isinstance(value, date):
+        return value.isoformat()
+    return force_unicode(value)
+
+
+def deserialise(field, text):
+    return None if text is None else field.to_python(text)
+
+
+def record(instance, action, changes, using):
+    """
+    Write the rows for a save or delete of instance, with changes a list of (field, old value, new value), or hold
+    them back inside a batch
+    """
+    model = instance._meta.object_name.lower()
+    owner = instance.pk if isinstance(instance, CapsForm) else form_id(instance)
+    now = timezone.now()
+    user_id = current_user_id()
+    if action == ADDED:
+        changes = [(None, None, None)]
+    rows = [
+        FieldChange(form_id=owner, model=model, object_id=instance.pk, field=field.attname if field else u'',
+                    action=action, old_value=serialise(old), new_value=serialise(new), changed_by_id=user_id,
+                    changed_on=now)
+        for field, old, new in changes
+    ]
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        pending.append((using, rows))
+    else:
+        write(rows, using)
+
+
+def read_previous(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Read the values a history entry had before it is saved, to compare with after
+    """
+    instance._audit_previous = None
+    if instance.pk is not None and not raw:
+        fields = audited_fields(sender)
+        for row in sender._default_manager.using(using).filter(pk=instance.pk).values_list(
+                *[field.name for field in fields]):
+            instance._audit_previous = dict((field.attname, value) for field, value in zip(fields, row))
+
+
+def saved(sender, instance, created=False, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    if raw:
+        return
+    if created:
+        record(instance, ADDED, [], using)
+        return
+    if sender is CapsForm:
+        changes = getattr(instance, 'saved_changes', [])
+    else:
+        previous = getattr(instance, '_audit_previous', None)
+        if previous is None:
+            return
+        changes = [(field, previous[field.attname], getattr(instance, field.attname))
+                   for field in audited_fields(sender)
+                   if not same_value(previous[field.attname], getattr(instance, field.attname))]
+    if changes:
+        record(instance, CHANGED, changes, using)
+
+
+def deleted(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    record(instance, DELETED, [(field, getattr(instance, field.attname), None) for field in audited_fields(sender)],
+           using)
+
+
+for model in (CapsForm, PregnancyProblem, HeartDisease, MedicalProblem, DrugUse):
+    uid = u'caps_audit_{0}'.format(model._meta.object_name)
+    if model is not CapsForm:
+        pre_save.connect(read_previous, sender=model, dispatch_uid=uid + u'_pre_save')
+    post_save.connect(saved, sender=model, dispatch_uid=uid + u'_save')
+    post_delete.connect(deleted, sender=model, dispatch_uid=uid + u'_delete')
+
+
+def form_history(form_id, using=DEFAULT_DB_ALIAS):
+    """
+    Every change to a form and its histories, oldest first
+    """
+    return FieldChange.objects.using(using).filter(form_id=form_id).order_by('changed_on', 'id')
+
+
+def changes_by(user, start, end, using=DEFAULT_DB_ALIAS):
+    """
+    Every change made by user from start up to end, oldest first
+    """
+    return FieldChange.objects.using(using).filter(changed_by=user, changed_on__gte=start,
+                                                   changed_on__lt=end).order_by('changed_on', 'id')
+
+
+def rebuild(model, current, later, when):
+    """
+    Rebuild the instances of model as they were at when, from the current ones (a dictionary of them by id) and the
+    changes since (a dictionary of the FieldChange rows by (model name, id)). Returns them in order of id.
+    """
+    name = model._meta.object_name.lower()
+    fields = dict((field.attname, field) for field in model._meta.fields)
+    ids = set(current) | set(object_id for key, object_id in later if key == name)
+    rebuilt = []
+    for object_id in sorted(ids):
+        changes = later.get((name, object_id), [])
+        if any(change.action == ADDED for change in changes):
+            continue
+        if object_id in current:
+            instance = current[object_id]
+        elif any(change.action == DELETED for change in changes):
+            instance = model(pk=object_id)
+        else:
+            continue
+        # The value a field had then is the old value of the first change to it since
+        done = set()
+        for change in changes:
+            if change.field not in done:
+                done.add(change.field)
+                setattr(instance, change.field, deserialise(fields[change.field], change.old_value))
+        rebuilt.append(instance)
+    return rebuilt
+
+
+def form_as_of(pk, when, using=DEFAULT_DB_ALIAS):
+    """
+    Rebuild a form and its histories as they were at when. Returns (form, histories), unsaved instances, with the
+    entries of each history in a dictionary by the name of the history (e.g. validation.DRUGS), or None if the form
+    didn't exist then. Only the changes made since when are read, so the cost depends on how much has changed since
+    then rather than on the length of the trail.
+    """
+    later = {}
+    for change in FieldChange.objects.using(using).filter(form_id=pk, changed_on__gt=when).order_by('changed_on', 'id'):
+        later.setdefault((change.model, change.object_id), []).append(change)
+    current = dict((form.pk, form) for form in CapsForm.objects.using(using).filter(pk=pk))
+    forms = rebuild(CapsForm, current, later, when)
+    if not forms or forms[0].created_on > when:
+        return None
+    histories = {}
+    for name, model, attname in HISTORIES:
+        current = dict((entry.pk, entry) for entry in model._default_manager.using(using).filter(**{attname: pk}))
+        histories[name] = rebuild(model, current, later, when)
+    return forms[0], histories
@@ -0,0 +1,127 @@
+"""
+PostgreSQL backend that takes its connections from a pool kept by each process (see caps/pool.py), rather than
+connecting to the database for every request and closing the connection at the end of it, which costs a round trip
+to the server for the handshake and authentication each time.
+
+It is Django's psycopg2 backend in every other respect. Use it by setting the ENGINE of a database to
+'caps.backends.pooled.postgresql_psycopg2', with the pool's settings under POOL, e.g.
+
+    'POOL': {'MIN_SIZE': 2, 'MAX_SIZE': 10, 'TIMEOUT': 30, 'MAX_LIFETIME': 3600, 'MAX_IDLE': 600, 'CHECK_INTERVAL': 30}
+
+The package is named postgresql_psycopg2 like Django's, as syncdb picks the custom SQL files of the models by the last
+part of the ENGINE (e.g. caps/sql/searchdocument.postgresql_psycopg2.sql), and the app's PostgreSQL triggers and
+indexes would be left out under any other name.
+
+MAX_SIZE should allow one connection for each thread serving requests. When Django closes the connection at the end
+of a request it is given back to the pool instead, after rolling back any transaction left open, so nothing carries
+over into the next request. A connection that has been idle for CHECK_INTERVAL seconds is checked with a trivial query
+before it is used again.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.postgresql_psycopg2 import base, creation
+from django.db.backends.postgresql_psycopg2.base import DatabaseError, IntegrityError
+from django.db.backends.signals import connection_created
+from django.utils.http import urlencode
+from caps import pool
+
+Database = base.Database
+extensions = base.psycopg2.extensions
+
+
+def pool_key(settings_dict):
+    """
+    The pool for a database, by the settings connections are made with
+    """
+    key = u'{0}@{1}:{2}/{3}'.format(settings_dict['USER'], settings_dict['HOST'], settings_dict['PORT'],
+                                    settings_dict['NAME'])
+    if settings_dict['OPTIONS']:
+        key += u'?' + urlencode(sorted(settings_dict['OPTIONS'].items()))
+    return key
+
+
+def connect(settings_dict):
+    """
+    A new connection, set up as Django's psycopg2 backend sets up its own
+    """
+    if not settings_dict['NAME']:
+        raise ImproperlyConfigured('You need to specify NAME in your Django settings file.')
+    params = {'database': settings_dict['NAME']}
+    params.update(settings_dict['OPTIONS'])
+    params.pop('autocommit', None)
+    for setting, param in (('USER', 'user'), ('PASSWORD', 'password'), ('HOST', 'host'), ('PORT', 'port')):
+        if settings_dict[setting]:
+            params[param] = settings_dict[setting]
+    connection = Database.connect(**params)
+    connection.set_client_encoding('UTF8')
+    tz = 'UTC' if settings.USE_TZ else settings_dict.get('TIME_ZONE')
+    if tz and connection.get_parameter_status('TimeZone') != tz:
+        connection.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        connection.cursor().execute('SET TIME ZONE %s', [tz])
+    return connection
+
+
+def check(connection):
+    cursor = connection.cursor()
+    cursor.execute('SELECT 1')
+    cursor.fetchone()
+    cursor.close()
+    connection.rollback()
+
+
+def reset(connection):
+    """
+    Roll back whatever the last user left open. A connection that has been closed, or whose state can't be told, is
+    thrown away.
+    """
+    if connection.closed:
+        raise DatabaseError('The connection has been closed')
+    status = connection.get_transaction_status()
+    if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+        raise DatabaseError('The connection to the server has been lost')
+    if status != extensions.TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+
+
+def make_pool(settings_dict):
+    # A copy, as the test database creation changes the NAME of the settings in place
+    settings_dict = dict(settings_dict, OPTIONS=dict(settings_dict['OPTIONS']))
+    options = dict((name.lower(), value) for name, value in settings_dict.get('POOL', {}).items())
+    return pool.Pool(lambda: connect(settings_dict), check=check, reset=reset, **options)
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # The idle connections to the test database would stop it being dropped
+        pool.close_pool(pool_key(dict(self.connection.settings_dict, NAME=test_database_name)))
+        super(DatabaseCreation, self)._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        self.creation = DatabaseCreation(self)
+
+    def get_pool(self):
+        return pool.get_pool(pool_key(self.settings_dict), lambda: make_pool(self.settings_dict))
+
+    def _cursor(self):
+        if self.connection is None:
+            pooled = self.get_pool()
+            pooled.fill()
+            self.connection = pooled.get()
+            # The last user may have left it at another isolation level, e.g. autocommit for creating a database
+            self.connection.set_isolation_level(self.isolation_level)
+            self._get_pg_version()
+            connection_created.send(sender=self.__class__, connection=self)
+        return super(DatabaseWrapper, self)._cursor()
+
+    def close(self):
+        """
+        Give the connection back to the pool rather than closing it
+        """
+        self.validate_thread_sharing()
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        self.get_pool().put(connection)
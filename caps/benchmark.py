@@ -0,0 +1,287 @@
+# coding=utf-8
+"""
+Benchmarks of the main code paths (form validation and saving, the admin changelist with each filter, the CSV export
+and the drug lookup) against synthetic studies of a given size, so the effect of a change on performance can be
+compared between commits. Run with the caps_benchmark command, which builds a separate database to run them in.
+
+The synthetic forms are generated from a seeded random number generator and loaded through the bulk importer, so a
+given seed always gives the same study. The proportions answering each question (and how many history entries they
+have) are rough guesses at a real study, enough to give the filters, histories and drug lookup realistic work to do.
+
+The request_connections benchmark starts and finishes requests as the WSGI handler does, which the test client used by
+the rest doesn't, so it measures the cost of connecting to the database for each request (or of taking a connection
+from the pool, with the pooled PostgreSQL backend). Run the benchmarks with each ENGINE to compare them.
+
+Each benchmark records its wall time, the number and total time of its database queries and the process's peak
+resident memory afterwards (ru_maxrss only ever goes up, so a jump shows which benchmark caused it).
+"""
+import random
+import resource
+import time
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.core import signals
+from django.db import transaction
+from django.test.client import Client
+from caps import choices, drugs, validation
+from caps.importer import Importer
+from caps.middleware import start_recording, stop_recording
+from caps.models import CapsForm, Drug, PregnancyProblem, HeartDisease, MedicalProblem
+
+BENCHMARK_USERNAME = 'benchmark'
+BENCHMARK_PASSWORD = 'benchmark'
+
+# Number of people entering forms in a synthetic study
+REPORTERS = 20
+
+# Number of forms validated and saved by the form benchmarks
+FORM_SAMPLE = 200
+
+# Requests started and finished by the connection benchmark
+CONNECTION_REQUESTS = 200
+
+# Text typed into the drug lookup, complete names and prefixes as someone would type them, and a misspelling
+DRUG_SEARCHES = (u'c', u'co', u'coc', u'cocaine', u'her', u'mdma', u'cannabis', u'ket', u'amph', u'heorin')
+
+# Share of forms answering each Yes/No question with Yes, and the most history entries a Yes has
+PREGNANCY_PROBLEM_RATE = 0.2
+HEART_DISEASE_RATE = 0.05
+MEDICAL_PROBLEM_RATE = 0.15
+DRUG_USE_RATE = 0.08
+CARDIAC_ARREST_RATE = 0.01
+EMPLOYED_RATE = 0.6
+MAX_ENTRIES = 3
+
+
+def weighted_choice(rng, codes, weights):
+    point = rng.random() * sum(weights)
+    for code, weight in zip(codes, weights):
+        point -= weight
+        if point < 0:
+            return code
+    return codes[-1]
+
+
+class StudyGenerator(object):
+    """
+    Generate synthetic form records in the importer's format from a seed
+    """
+    def __init__(self, seed=0, usernames=(), drug_names=()):
+        self.rng = random.Random(seed)
+        self.usernames = list(usernames)
+        self.drug_names = list(drug_names)
+        # Most women are in the first few ethnic groups, as in the UK population
+        self.ethnic_groups = [code for code, label in choices.get(CapsForm, 'ethnic_group').choices]
+        self.ethnic_weights = [80, 2, 4] + [1] * (len(self.ethnic_groups) - 3)
+        self.problem_types = dict(
+            (name, [code for code, label in choices.get(model, 'type').choices])
+            for name, model in ((validation.PREGNANCY, PregnancyProblem), (validation.HEART, HeartDisease),
+                                (validation.MEDICAL, MedicalProblem))
+        )
+        self.number = 0
+
+    def entries(self, name):
+        rng = self.rng
+        return [{'type': rng.choice(self.problem_types[name]), 'details': u'Synthetic detail' if rng.random() < 0.3
+                 else None} for i in range(rng.randint(1, MAX_ENTRIES))]
+
+    def record(self):
+        rng = self.rng
+        self.number += 1
+        height = int(rng.gauss(164, 7))
+        gravidity_plus = min(int(rng.expovariate(0.8)), 15)
+        gravidity_minus = min(int(rng.expovariate(2.5)), 15)
+        record = {
+            'case_id': u'B{0:08d}'.format(self.number),
+            'created_by': rng.choice(self.usernames),
+            'year_of_birth': rng.randint(1970, 1998),
+            'ethnic_group': weighted_choice(rng, self.ethnic_groups, self.ethnic_weights),
+            'marital_status': weighted_choice(rng, ['married', 'cohabiting', 'single'], [50, 30, 20]),
+            'employed': rng.random() < EMPLOYED_RATE,
+            'height': max(120, min(210, height)),
+            'weight': unicode(Decimal(max(40.0, min(200.0, rng.gauss(70, 14)))).quantize(Decimal('0.1'))),
+            'smoking': weighted_choice(rng, ['never', 'prior', 'during', 'current'], [60, 15, 10, 15]),
+            'gravidity_24plus': gravidity_plus,
+            'gravidity_24minus': gravidity_minus,
+        }
+        if record['employed']:
+            record['occupation'] = u'Synthetic occupation'
+        if gravidity_plus or gravidity_minus:
+            if rng.random() < PREGNANCY_PROBLEM_RATE:
+                record[validation.PREGNANCY] = self.entries(validation.PREGNANCY)
+            else:
+                record['previous_pregnancy_problem'] = False
+        if rng.random() < HEART_DISEASE_RATE:
+            record[validation.HEART] = self.entries(validation.HEART)
+        if rng.random() < MEDICAL_PROBLEM_RATE:
+            record[validation.MEDICAL] = self.entries(validation.MEDICAL)
+        if self.drug_names and rng.random() < DRUG_USE_RATE:
+            record[validation.DRUGS] = [
+                {'drug': rng.choice(self.drug_names), 'last_use': None, 'last_use_unknown': True}
+                for i in range(rng.randint(1, MAX_ENTRIES))
+            ]
+        if rng.random() < CARDIAC_ARREST_RATE:
+            record['cardiac_arrest'] = True
+            record['cardiac_arrest_date'] = u'{0}-{1:02d}-{2:02d}'.format(
+                rng.randint(2000, 2011), rng.randint(1, 12), rng.randint(1, 28))
+        return record
+
+    def records(self, count):
+        for i in range(count):
+            yield self.record()
+
+
+def setup_study(seed=0):
+    """
+    Create the reporters and the benchmark superuser, returning a StudyGenerator for the study
+    """
+    usernames = []
+    for i in range(REPORTERS):
+        user, created = User.objects.get_or_create(username=u'reporter{0:02d}'.format(i),
+                                                   defaults={'first_name': u'Reporter', 'last_name': unicode(i)})
+        usernames.append(user.username)
+    if not User.objects.filter(username=BENCHMARK_USERNAME).exists():
+        User.objects.create_superuser(BENCHMARK_USERNAME, 'benchmark@example.com', BENCHMARK_PASSWORD)
+    drug_names = list(Drug.objects.order_by('pk').values_list('name', flat=True))
+    return StudyGenerator(seed, usernames, drug_names)
+
+
+def grow_study(generator, size, batch_size=5000):
+    """
+    Import synthetic forms until the study has size forms. Returns the number imported.
+    """
+    missing = size - CapsForm.objects.count()
+    if missing <= 0:
+        return 0
+    importer = Importer(batch_size=batch_size)
+    importer.run(generator.records(missing))
+    if importer.errors:
+        raise ValueError('Synthetic records failed validation: {0}'.format(importer.errors[:5]))
+    return importer.imported
+
+
+def measure(name, func, repeat=1):
+    """
+    Run func repeat times and return the timing of the fastest run, with the queries it ran
+    """
+    best = None
+    for i in range(repeat):
+        recorder = start_recording()
+        start = time.time()
+        try:
+            func()
+        finally:
+            elapsed = time.time() - start
+            stop_recording()
+        if best is None or elapsed < best[0]:
+            best = (elapsed, recorder)
+    elapsed, recorder = best
+    return {
+        'benchmark': name,
+        'seconds': round(elapsed, 4),
+        'queries': len(recorder.queries),
+        'query_seconds': round(sum(duration for sql, duration in recorder.queries), 4),
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def form_sample(generator, count=FORM_SAMPLE):
+    """
+    Unsaved forms built from synthetic records, without their histories
+    """
+    importer = Importer()
+    forms = []
+    for record in generator.records(count):
+        for name in (validation.PREGNANCY, validation.HEART, validation.MEDICAL, validation.DRUGS):
+            record.pop(name, None)
+        if record.get('gravidity_24plus') or record.get('gravidity_24minus'):
+            record['previous_pregnancy_problem'] = False
+        forms.append(importer.build(record)[0])
+    return forms
+
+
+def full_clean_forms(forms):
+    for form in forms:
+        form.full_clean()
+
+
+def save_forms(forms):
+    # Rolled back afterwards, so the study is the same size for the benchmarks that follow
+    with transaction.commit_manually():
+        try:
+            for form in forms:
+                form.pk = None
+                form.save()
+        finally:
+            transaction.rollback()
+
+
+def changelist_urls():
+    """
+    The admin changelist, unfiltered and then filtered by a value of each of CapsFormAdmin.list_filter
+    """
+    from caps.admin import CapsFormAdmin
+    from caps.filters import CreatedByListFilter
+    base = '/admin/caps/capsform/'
+    urls = [('changelist', base)]
+    user = User.objects.get(username=u'reporter00')
+    for list_filter in CapsFormAdmin.list_filter:
+        if list_filter is CreatedByListFilter:
+            urls.append(('changelist_created_by', base + '?created_by={0}'.format(user.pk)))
+        elif list_filter == 'created_on':
+            urls.append(('changelist_created_on', base + '?created_on__gte=2000-01-01'))
+        elif list_filter == 'smoking':
+            urls.append(('changelist_smoking', base + '?smoking__exact=current'))
+        else:
+            urls.append(('changelist_' + list_filter, base + '?{0}__exact=1'.format(list_filter)))
+    return urls
+
+
+def get(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise ValueError('{0} returned {1}'.format(url, response.status_code))
+    # Read streamed responses through to the end, as a client downloading them would
+    for chunk in response:
+        pass
+    return response
+
+
+def simulate_requests(count=CONNECTION_REQUESTS):
+    """
+    Start and finish requests as the WSGI handler does, each running one small query, so that each opens and closes
+    its database connection
+    """
+    for i in range(count):
+        signals.request_started.send(sender=None)
+        try:
+            User.objects.filter(username=BENCHMARK_USERNAME).exists()
+        finally:
+            signals.request_finished.send(sender=None)
+
+
+def run_benchmarks(generator, size, repeat=3):
+    """
+    Run every benchmark against the current study, returning a list of results
+    """
+    results = []
+    forms = form_sample(generator)
+    results.append(measure('form_full_clean', lambda: full_clean_forms(forms), repeat))
+    results.append(measure('form_save', lambda: save_forms(forms), repeat))
+
+    client = Client()
+    client.login(username=BENCHMARK_USERNAME, password=BENCHMARK_PASSWORD)
+    for name, url in changelist_urls():
+        results.append(measure(name, lambda url=url: get(client, url), repeat))
+    results.append(measure('export_csv', lambda: get(client, '/admin/caps/capsform/view/all/'), 1))
+
+    results.append(measure('request_connections', simulate_requests, repeat))
+
+    drugs.invalidate()
+    results.append(measure('drug_index_build', drugs.get_index, 1))
+    results.append(measure('drug_search', lambda: [drugs.search(text) for text in DRUG_SEARCHES], repeat))
+    results.append(measure('drug_search_view', lambda: [get(client, '/admin/caps/drug/search/?q=' + text)
+                                                        for text in DRUG_SEARCHES], repeat))
+    for result in results:
+        result['forms'] = size
+    return results
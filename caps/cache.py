@@ -0,0 +1,283 @@
+"""
+Two-tier cache for the reference data behind the admin pages (the drug dictionary, the users a form can be created by,
+the creator counts for the changelist filter) and for values built from a single form (its API serialisation and its
+line of the CSV export).
+
+Values are kept in regions. A region's entries are looked up first in this process's memory (for the regions marked
+local, which hold small, often read reference data), then in the shared tier, a Django cache (CAPS_SHARED_CACHE, the
+default cache unless set) which with memcached or the file based cache is shared by every process, and are only built
+from the database when neither has them.
+
+Each region has a generation token in the shared tier, which is part of every key in the region. Invalidating the whole
+region replaces the token, so every process stops using its entries at once, and the old entries expire in their own
+time. The forms regions also drop single entries, when a form or one of its histories is saved or deleted. Local
+regions have no way of telling other processes to drop a single entry, so there any invalidation replaces the token.
+Invalidation is driven by the post_save and post_delete signals (see Region.invalidate_on); changes that bypass them,
+e.g. QuerySet.update() or bulk_create(), need to invalidate the regions they affect themselves. The forms regions are
+always built from the primary database, never a read replica (see caps.replicas), so they can't be filled with a form
+as it was before its last save. They are only used when the shared tier is really shared between processes: with a
+cache kept in each process's memory (e.g. the default LocMemCache) a save would only drop the entries of the process
+that made it, and the others would go on serving the form as it was, so the values are built every time instead.
+Likewise the local regions' entries are only kept for UNSHARED_TIMEOUT seconds with such a cache, as that is how long
+another process can go on serving e.g. the drug dictionary from before a drug was added.
+
+Each region counts its hits in either tier, misses and invalidations in this process, for tuning the timeouts and
+sizes. stats() returns them, and the caps_cache_stats view shows them for the process serving the request.
+
+The regions are defined in the modules that use them, e.g. drugs.DRUGS and api.API_FORMS.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.db.models.signals import pre_save, post_save, post_delete
+from caps import replicas
+
+# How long entries are kept in the shared tier, unless the region says otherwise
+DEFAULT_TIMEOUT = 60 * 60
+
+GENERATION_TIMEOUT = 60 * 60 * 24
+
+# Default for CAPS_CACHE_LOCAL_MAX_ENTRIES, the most entries kept in memory by each process, across the local regions
+LOCAL_MAX_ENTRIES = 1000
+
+STATS = ('local_hits', 'shared_hits', 'misses', 'invalidations')
+
+# How long the local regions keep their entries when the shared tier isn't shared between processes, and so can't
+# carry an invalidation from one process to the others
+UNSHARED_TIMEOUT = 5
+
+# Cache backends that keep their entries in the memory of each process, so aren't shared between processes
+PROCESS_BACKENDS = ('LocMemCache', 'DummyCache')
+
+REGIONS = OrderedDict()
+
+# The local tier, full key -> (value, time it expires or None), least recently used first
+_local = OrderedDict()
+_lock = threading.Lock()
+
+
+def shared_cache():
+    return get_cache(getattr(settings, 'CAPS_SHARED_CACHE', 'default'))
+
+
+def shared_between_processes():
+    return shared_cache().__class__.__name__ not in PROCESS_BACKENDS
+
+
+class Region(object):
+    """
+    A named set of cached values, built by the same code and invalidated together
+    """
+    def __init__(self, name, timeout=DEFAULT_TIMEOUT, local=False, forms=False):
+        self.name = name
+        self.timeout = timeout
+        self.local = local
+        # Built from the forms, so invalidated by invalidate_forms()
+        self.forms = forms
+        self.prefix = u'caps:{0}:'.format(name)
+        self.stats = dict.fromkeys(STATS, 0)
+        REGIONS[name] = self
+
+    def generation_key(self):
+        return self.prefix + u'generation'
+
+    def generation(self):
+        """
+        The region's current generation token. If it has dropped out of the shared tier we can't tell whether anything
+        changed in the meantime, so a new one is issued. None if the shared tier isn't keeping anything (e.g. the dummy
+        cache), in which case nothing is cached.
+        """
+        cache = shared_cache()
+        generation = cache.get(self.generation_key())
+        if generation is None:
+            cache.add(self.generation_key(), uuid.uuid4().hex, GENERATION_TIMEOUT)
+            generation = cache.get(self.generation_key())
+        return generation
+
+    def full_key(self, generation, key):
+        return u'{0}{1}:{2}'.format(self.prefix, generation, key)
+
+    def get(self, key, build):
+        """
+        The value for key, calling build() to make it if it isn't cached
+        """
+        return self.get_many([key], lambda missing: {key: build()})[key]
+
+    def get_many(self, keys, build):
+        """
+        A dictionary of the values for keys. Those that aren't cached are made by a single call to build(missing keys),
+        which returns a dictionary of them, and may leave out any that no longer exist. None can't be cached.
+        """
+        if self.forms and not shared_between_processes():
+            self.stats['misses'] += len(keys)
+            with replicas.use_primary():
+                return build(list(keys))
+        generation = self.generation()
+        if generation is None:
+            self.stats['misses'] += len(keys)
+            return build(list(keys))
+        timeout = self.timeout
+        if self.local and not shared_between_processes():
+            timeout = min(timeout, UNSHARED_TIMEOUT)
+        full_keys = dict((self.full_key(generation, key), key) for key in keys)
+        found = {}
+        if self.local:
+            now = time.time()
+            with _lock:
+                for full_key, key in full_keys.items():
+                    if full_key in _local:
+                        # Move it to the end, as the most recently used
+                        value, expires = _local[full_key] = _local.pop(full_key)
+                        if expires is not None and expires <= now:
+                            del _local[full_key]
+                        else:
+                            found[key] = value
+            self.stats['local_hits'] += len(found)
+        missing = [full_key for full_key, key in full_keys.items() if key not in found]
+        if missing:
+            shared = shared_cache().get_many(missing)
+            self.stats['shared_hits'] += len(shared)
+            for full_key, value in shared.items():
+                found[full_keys[full_key]] = value
+            self.remember(shared, timeout)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            self.stats['misses'] += len(missing)
+            if self.forms:
+                # Built from the primary even when reading from a replica, which could be behind and put a form back
+                # in the cache as it was before a save that has just dropped it
+                with replicas.use_primary():
+                    values = build(missing)
+            else:
+                values = build(missing)
+            built = dict((self.full_key(generation, key), value) for key, value in values.items() if value is not None)
+            shared_cache().set_many(built, timeout)
+            self.remember(built, timeout)
+            for full_key, value in built.items():
+                found[full_keys[full_key]] = value
+        return found
+
+    def remember(self, values, timeout):
+        # Keep values in the local tier, dropping the least recently used entries once it's full. They are only given
+        # an expiry when the timeout is cut short, as otherwise the generation token drops them.
+        if not self.local or not values:
+            return
+        expires = time.time() + timeout if timeout < self.timeout else None
+        max_entries = getattr(settings, 'CAPS_CACHE_LOCAL_MAX_ENTRIES', LOCAL_MAX_ENTRIES)
+        with _lock:
+            _local.update((full_key, (value, expires)) for full_key, value in values.items())
+            while len(_local) > max_entries:
+                _local.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Drop the entry for key, or every entry in the region if key is None
+        """
+        self.stats['invalidations'] += 1
+        cache = shared_cache()
+        if key is None or self.local:
+            cache.set(self.generation_key(), uuid.uuid4().hex, GENERATION_TIMEOUT)
+            with _lock:
+                for full_key in [full_key for full_key in _local if full_key.startswith(self.prefix)]:
+                    del _local[full_key]
+        else:
+            generation = cache.get(self.generation_key())
+            if generation is not None:
+                cache.delete(self.full_key(generation, key))
+
+    def invalidate_on(self, model, key=None, fields=None):
+        """
+        Invalidate when an instance of model is saved or deleted: the entry key(instance), or the whole region if key is
+        None. If fields are given, a save only invalidates if it changes one of them (or adds a new instance).
+        """
+        if fields:
+            track(model, fields)
+
+        def saved(sender, instance, created=False, **kwargs):
+            if fields and not created and not changed(instance, fields):
+                return
+            self.invalidate(key(instance) if key else None)
+
+        def deleted(sender, instance, **kwargs):
+            self.invalidate(key(instance) if key else None)
+
+        # The receivers are closures, which would be garbage collected straight away if they were only weakly referenced
+        uid = u'caps_cache_{0}_{1}'.format(self.name, model._meta.object_name)
+        post_save.connect(saved, sender=model, weak=False, dispatch_uid=uid + u'_save')
+        post_delete.connect(deleted, sender=model, weak=False, dispatch_uid=uid + u'_delete')
+
+
+# Fields of each model whose changes some region cares about, and whose values are read before each save to compare
+
+TRACKED = {}
+
+
+def track(model, fields):
+    if model not in TRACKED:
+        TRACKED[model] = set()
+        pre_save.connect(read_tracked, sender=model,
+                         dispatch_uid=u'caps_cache_track_{0}'.format(model._meta.object_name))
+    TRACKED[model].update(fields)
+
+
+def read_tracked(sender, instance, raw=False, **kwargs):
+    previous = []
+    if instance.pk is not None and not raw:
+        previous = sender._default_manager.filter(pk=instance.pk).values(*TRACKED[sender])[:1]
+    instance._caps_cache_previous = previous[0] if previous else None
+
+
+def changed(instance, fields):
+    previous = getattr(instance, '_caps_cache_previous', None)
+    if previous is None:
+        return True
+    return any(previous[name] != getattr(instance, name) for name in fields)
+
+
+def form_region(name, timeout=DEFAULT_TIMEOUT):
+    """
+    A region of values built from a single form and its histories, keyed by the form's id. A form's entry is dropped
+    when it or one of its histories is saved or deleted, and the whole region when a user's name or a drug changes, as
+    they appear in the values too.
+    """
+    # Imported here, as the modules the models import at the bottom of caps.models define their regions with this
+    from caps.models import CapsForm, Drug, DrugUse, PregnancyProblem, HeartDisease, MedicalProblem
+    region = Region(name, timeout, forms=True)
+    region.invalidate_on(CapsForm, lambda form: form.pk)
+    for model in (PregnancyProblem, HeartDisease, MedicalProblem):
+        region.invalidate_on(model, lambda entry: entry.form_id)
+    region.invalidate_on(DrugUse, lambda entry: entry.person_id)
+    region.invalidate_on(User, fields=('first_name', 'last_name'))
+    region.invalidate_on(Drug)
+    return region
+
+
+def invalidate_forms():
+    """
+    Invalidate everything built from the forms, for changes made without the model signals (e.g. a bulk import)
+    """
+    for region in REGIONS.values():
+        if region.forms:
+            region.invalidate()
+
+
+def stats():
+    """
+    The counters of each region in this process, with the hit rate across both tiers
+    """
+    result = OrderedDict()
+    for name, region in REGIONS.items():
+        counts = dict(region.stats)
+        lookups = counts['local_hits'] + counts['shared_hits'] + counts['misses']
+        counts['hit_rate'] = round(float(lookups - counts['misses']) / lookups, 3) if lookups else None
+        result[name] = counts
+    return result
+
+
+def reset_stats():
+    for region in REGIONS.values():
+        region.stats = dict.fromkeys(STATS, 0)
@@ -0,0 +1,88 @@
+"""
+Registry of the choice sets used by the CAPS models, flattened into dictionaries once at import time so that turning a
+stored code into its label (for display and exports) or a label back into its code (for imports) is a single lookup
+rather than a scan over the choices tuple.
+"""
+from django.utils.encoding import force_unicode
+
+
+def flatten(choices):
+    """
+    Yield (code, label) pairs from a choices tuple, including those nested in named groups, e.g.
+    ((u'White', ((1, u'British'), (2, u'Irish'))), (0, u'Unknown')) gives (1, u'British'), (2, u'Irish'), (0, u'Unknown')
+    """
+    for code, label in choices:
+        if isinstance(label, (list, tuple)):
+            for pair in flatten(label):
+                yield pair
+        else:
+            yield code, label
+
+
+class ChoiceSet(object):
+    """
+    A flattened set of choices, with lookups in both directions
+    """
+    def __init__(self, choices):
+        self.choices = tuple(flatten(choices))
+        self.labels = {}
+        self.codes = {}
+        for code, label in self.choices:
+            self.labels.setdefault(code, force_unicode(label))
+            # Imports may give either the label or the code as text, in any case, so accept both
+            self.codes.setdefault(force_unicode(label).strip().lower(), code)
+            self.codes.setdefault(force_unicode(code).strip().lower(), code)
+
+    def label(self, code, default=u''):
+        """
+        Return the label for a stored code, or default if the code isn't one of the choices
+        """
+        try:
+            return self.labels.get(code, default)
+        except TypeError:
+            # Unhashable values can't be valid codes
+            return default
+
+    def code(self, text, default=None):
+        """
+        Return the code for an imported value, which may be given as either the label or the code, e.g. u'British',
+        u'british' and u'1' all give 1 for the ethnic group
+        """
+        if text is None:
+            return default
+        return self.codes.get(force_unicode(text).strip().lower(), default)
+
+    def __contains__(self, code):
+        return code in self.labels
+
+    def __len__(self):
+        return len(self.choices)
+
+
+# (app label, model name, field name) -> ChoiceSet
+registry = {}
+
+
+def register_model(model):
+    """
+    Add a ChoiceSet to the registry for every field on the model that has choices
+    """
+    for field in model._meta.fields:
+        if field.choices:
+            registry[(model._meta.app_label, model._meta.module_name, field.name)] = ChoiceSet(field.choices)
+
+
+def get(model, field_name):
+    """
+    Return the ChoiceSet for a field, given the model class or an instance of it (including those loaded with only() or
+    defer(), which are of a subclass of the model)
+    """
+    opts = model._meta.concrete_model._meta
+    return registry[(opts.app_label, opts.module_name, field_name)]
+
+
+def label(obj, field_name, default=u''):
+    """
+    Return the label for the current value of a field on a model instance
+    """
+    return get(obj, field_name).label(getattr(obj, field_name), default)
@@ -0,0 +1,322 @@
+"""
+Columnar (Parquet) export of the forms and their histories for statistical analysis, e.g. with R's arrow package or
+pandas, so the columns arrive with their types rather than as text to be re-parsed.
+
+Each table is written to its own directory as a series of part files, one per snapshot, which together read as a single
+dataset. The choice fields are stored as their codes (integers for ethnic_group) using Parquet dictionary encoding, and
+the code to label mapping for each is kept in the file's metadata under 'caps.choices'.
+
+Rows are read straight from a database cursor and written a row group at a time. After a snapshot, the (created_on, id)
+of the newest form written is kept as a watermark, and the next snapshot appends the forms created since, along with
+their histories. A form's created_on is set before its transaction commits, so a form can become visible after a
+snapshot has already passed its created_on. Each snapshot therefore reads again from OVERLAP before the watermark,
+leaving out the forms it lists as already written. Changes to forms that have already been exported are not picked up;
+use a full export for that.
+
+pyarrow is an optional dependency, only needed for this export.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils import timezone
+from caps import choices
+from caps.models import CapsForm, DrugUse, PregnancyProblem, HeartDisease, MedicalProblem
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Number of rows fetched from the cursor and written as each row group
+ROW_GROUP_SIZE = 50000
+
+WATERMARK_FILE = 'watermark.json'
+
+# How far behind the watermark each snapshot reads again, for forms committed after it was taken. Longer than any
+# transaction adding forms is expected to take.
+OVERLAP = timedelta(minutes=30)
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+PART_NAME = 'part-{0:05d}.parquet'
+
+
+def arrow_type(name):
+    """
+    The pyarrow type for each of the column types used below, looked up by name so this module can be imported (and
+    the tables described) without pyarrow installed
+    """
+    return {
+        'int64': pyarrow.int64(),
+        'int16': pyarrow.int16(),
+        'string': pyarrow.string(),
+        'bool': pyarrow.bool_(),
+        'date': pyarrow.date32(),
+        'timestamp': pyarrow.timestamp('us', tz='UTC'),
+        'weight': pyarrow.decimal128(4, 1),
+    }[name]
+
+
+class Table(object):
+    """
+    An exported table: the model it comes from, its columns as (name, field lookup, type) and the lookup of the form
+    each row belongs to, which the watermark is applied to
+    """
+    def __init__(self, name, model, columns, form_lookup=None):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.form_lookup = form_lookup
+
+    def column_index(self, name):
+        return [column[0] for column in self.columns].index(name)
+
+    def choice_columns(self):
+        """
+        The (column name, ChoiceSet) pairs of the columns holding choice codes, other than the Yes/No questions
+        """
+        result = []
+        for name, lookup, column_type in self.columns:
+            if column_type == 'bool':
+                continue
+            model, field = self.model, lookup
+            if lookup.count('__') == 1:
+                relation, field = lookup.split('__')
+                model = self.model._meta.get_field(relation).rel.to
+            if '__' not in field and model._meta.get_field(field).choices:
+                result.append((name, choices.get(model, field)))
+        return result
+
+    def schema(self):
+        codes = dict((name, [[code, unicode(label)] for code, label in choice_set.choices])
+                     for name, choice_set in self.choice_columns())
+        return pyarrow.schema(
+            [pyarrow.field(name, arrow_type(column_type)) for name, lookup, column_type in self.columns],
+            metadata={'caps.choices': json.dumps(codes, sort_keys=True)}
+        )
+
+    def queryset(self, using, since=None, until=None):
+        """
+        The rows for forms created from since, up to and including until, a (created_on, id) pair
+        """
+        queryset = self.model.objects.using(using).order_by('pk')
+        prefix = self.form_lookup + '__' if self.form_lookup else ''
+        if since is not None:
+            queryset = queryset.filter(**{prefix + 'created_on__gte': since})
+        if until is not None:
+            queryset = queryset.filter(Q(**{prefix + 'created_on__lt': until[0]}) |
+                                       Q(**{prefix + 'created_on': until[0], prefix + 'pk__lte': until[1]}))
+        return queryset.values_list(*[lookup for name, lookup, column_type in self.columns])
+
+
+def history_table(name, model):
+    return Table(name, model, (
+        ('id', 'id', 'int64'),
+        ('form_id', 'form', 'int64'),
+        ('type', 'type', 'string'),
+        ('details', 'details', 'string'),
+    ), form_lookup='form')
+
+
+TABLES = (
+    Table('forms', CapsForm, (
+        ('id', 'id', 'int64'),
+        ('case_id', 'case_id', 'string'),
+        ('case_reported', 'case_reported', 'string'),
+        ('created_by_id', 'created_by', 'int64'),
+        ('created_on', 'created_on', 'timestamp'),
+        ('year_of_birth', 'year_of_birth', 'int16'),
+        ('ethnic_group', 'ethnic_group', 'int16'),
+        ('marital_status', 'marital_status', 'string'),
+        ('employed', 'employed', 'bool'),
+        ('occupation', 'occupation', 'string'),
+        ('height', 'height', 'int16'),
+        ('weight', 'weight', 'weight'),
+        ('smoking', 'smoking', 'string'),
+        ('gravidity_24plus', 'gravidity_24plus', 'int16'),
+        ('gravidity_24minus', 'gravidity_24minus', 'int16'),
+        ('previous_pregnancy_problem', 'previous_pregnancy_problem', 'bool'),
+        ('heart_disease', 'heart_disease', 'bool'),
+        ('cardiac_arrest', 'cardiac_arrest', 'bool'),
+        ('cardiac_arrest_date', 'cardiac_arrest_date', 'date'),
+        ('cardiac_arrest_cause', 'cardiac_arrest_cause', 'string'),
+        ('drug_use', 'drug_use', 'bool'),
+        ('previous_medical_problem', 'previous_medical_problem', 'bool'),
+    )),
+    history_table('pregnancy_problems', PregnancyProblem),
+    history_table('heart_disease', HeartDisease),
+    history_table('medical_problems', MedicalProblem),
+    Table('drug_use', DrugUse, (
+        ('id', 'id', 'int64'),
+        ('form_id', 'person', 'int64'),
+        ('drug_id', 'drug', 'int64'),
+        ('drug_name', 'drug__name', 'string'),
+        ('drug_type', 'drug__type', 'string'),
+        ('drug_uk_class', 'drug__uk_class', 'string'),
+        ('last_use', 'last_use', 'timestamp'),
+        ('last_use_unknown', 'last_use_unknown', 'bool'),
+    ), form_lookup='person'),
+)
+
+
+def to_utc(value):
+    """
+    A naive UTC datetime for pyarrow. Naive values from the database are already in UTC when USE_TZ is on.
+    """
+    if timezone.is_aware(value):
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+# Database drivers differ in what they return for some column types (e.g. SQLite gives 0 and 1 for booleans), so each
+# value is normalised for its column type before it's handed to pyarrow
+NORMALISE = {
+    'bool': bool,
+    'weight': lambda value: value if isinstance(value, Decimal) else Decimal(str(value)),
+    'timestamp': to_utc,
+}
+
+
+def record_batch(table, rows):
+    """
+    Turn a list of row tuples into a pyarrow Table with the table's schema, a column at a time
+    """
+    arrays = []
+    for i, (name, lookup, column_type) in enumerate(table.columns):
+        normalise = NORMALISE.get(column_type)
+        values = [row[i] for row in rows]
+        if normalise is not None:
+            values = [None if value is None else normalise(value) for value in values]
+        arrays.append(pyarrow.array(values, type=arrow_type(column_type)))
+    return pyarrow.Table.from_arrays(arrays, schema=table.schema())
+
+
+def write_table(table, path, using=DEFAULT_DB_ALIAS, since=None, until=None, row_group_size=ROW_GROUP_SIZE, keep=None):
+    """
+    Write the rows of table for forms created between since and until to a Parquet file at path, reading them from a
+    cursor in row groups. If keep is given, only the rows it returns True for are written. Returns the number of rows
+    written.
+    """
+    sql, params = table.queryset(using, since, until).query.sql_with_params()
+    cursor = connections[using].cursor()
+    cursor.execute(sql, params)
+    dictionary_columns = [name for name, choice_set in table.choice_columns()]
+    writer = pyarrow.parquet.ParquetWriter(path, table.schema(), use_dictionary=dictionary_columns or False,
+                                           compression='snappy')
+    count = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(row_group_size)
+            if not rows:
+                break
+            if keep is not None:
+                rows = [row for row in rows if keep(row)]
+                if not rows:
+                    continue
+            writer.write_table(record_batch(table, rows))
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def read_watermark(directory):
+    path = os.path.join(directory, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_watermark(directory, watermark):
+    # Written to a temporary file first, so an interrupted export leaves the previous watermark in place
+    path = os.path.join(directory, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(watermark, f, indent=2)
+    os.rename(path + '.tmp', path)
+
+
+def parse_timestamp(text):
+    value = datetime.strptime(text, TIMESTAMP_FORMAT)
+    if settings.USE_TZ:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def format_timestamp(value):
+    return to_utc(value).strftime(TIMESTAMP_FORMAT)
+
+
+def snapshot(directory, using=DEFAULT_DB_ALIAS, row_group_size=ROW_GROUP_SIZE):
+    """
+    Append the forms created since the last snapshot in directory (or all of them, the first time) and their histories
+    as a new part of each table. Returns a dictionary of table name -> rows written, which is empty if there was
+    nothing new to export.
+    """
+    if pyarrow is None:
+        raise ImportError('The columnar export needs pyarrow, see requirements_optional.txt')
+    watermark = read_watermark(directory) or {}
+    since = None
+    # The forms already written from the overlap, by id, with their created_on
+    recent = dict((pk, parse_timestamp(created_on)) for pk, created_on in watermark.get('recent', []))
+    forms = TABLES[0].model.objects.using(using)
+    if watermark:
+        since = parse_timestamp(watermark['created_on']) - OVERLAP
+        forms = forms.filter(created_on__gte=since)
+    if not any(pk not in recent for pk in forms.values_list('pk', flat=True).iterator()):
+        return {}
+    # Fix the newest form to export before reading any table, so the forms and histories written are of the same
+    # forms, even if more are being added while the export runs
+    until = forms.order_by('-created_on', '-pk').values_list('created_on', 'pk')[0]
+    part = watermark.get('snapshots', 0) + 1
+
+    # Only the histories of the forms written go in, in case a form committed between reading the tables
+    new_forms = {}
+    created_on = TABLES[0].column_index('created_on')
+
+    def keep_form(row):
+        if row[0] in recent:
+            return False
+        new_forms[row[0]] = row[created_on]
+        return True
+
+    written = {}
+    for table in TABLES:
+        table_directory = os.path.join(directory, table.name)
+        if not os.path.isdir(table_directory):
+            os.makedirs(table_directory)
+        path = os.path.join(table_directory, PART_NAME.format(part))
+        if table is TABLES[0]:
+            keep = keep_form
+        else:
+            keep = lambda row, index=table.column_index('form_id'): row[index] in new_forms
+        written[table.name] = write_table(table, path + '.tmp', using, since, until, row_group_size, keep)
+        os.rename(path + '.tmp', path)
+    recent.update(new_forms)
+    write_watermark(directory, {
+        'created_on': format_timestamp(until[0]),
+        'id': until[1],
+        'snapshots': part,
+        'recent': sorted([pk, format_timestamp(value)] for pk, value in recent.items()
+                         if to_utc(value) >= to_utc(until[0]) - OVERLAP),
+    })
+    return written
+
+
+def clear(directory):
+    """
+    Remove the part files and watermark of previous snapshots from directory, so the next snapshot is a full export
+    """
+    for table in TABLES:
+        table_directory = os.path.join(directory, table.name)
+        if os.path.isdir(table_directory):
+            for name in os.listdir(table_directory):
+                if name.startswith('part-') and name.endswith('.parquet'):
+                    os.remove(os.path.join(table_directory, name))
+    if os.path.exists(os.path.join(directory, WATERMARK_FILE)):
+        os.remove(os.path.join(directory, WATERMARK_FILE))
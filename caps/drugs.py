@@ -0,0 +1,119 @@
+"""
+In-process cache of the Drug dictionary, with a prefix and fuzzy search index over the names and alternative names for
+the type-ahead lookup on the drug use inline.
+
+The index is built with a single query the first time it is needed and kept in the drugs cache region, in memory in
+each process, until a Drug is saved or deleted, or for a few seconds if the cache isn't shared between processes (see
+caps.cache).
+"""
+import difflib
+import re
+from bisect import bisect_left
+from django.utils.encoding import force_unicode
+from caps import cache
+from caps.models import Drug
+
+DRUGS = cache.Region('drugs', timeout=cache.GENERATION_TIMEOUT, local=True)
+DRUGS.invalidate_on(Drug)
+
+# Maximum number of results returned by a search
+SEARCH_LIMIT = 20
+
+# How close a misspelling has to be to a name to be offered as a match, from 0 to 1
+FUZZY_CUTOFF = 0.75
+
+WORD_SPLITTER = re.compile(r'[\s,/()]+')
+
+
+def normalise(text):
+    return force_unicode(text or u'').strip().lower()
+
+
+def drug_label(name, alternative_names):
+    """
+    Label for a drug, as given by Drug.__unicode__, e.g. u'Cocaine (Coke, Charlie)'
+    """
+    if alternative_names:
+        return u'{0} ({1})'.format(name, alternative_names)
+    return force_unicode(name)
+
+
+class DrugIndex(object):
+    """
+    A snapshot of the drug dictionary. Each drug is indexed under its full name, each of its alternative names and each
+    word within them, kept in a sorted list so that prefix searches are a binary search.
+    """
+    def __init__(self, rows):
+        self.labels = {}
+        self.names = {}
+        terms = set()
+        for pk, name, alternative_names in rows:
+            self.labels[pk] = drug_label(name, alternative_names)
+            self.names[pk] = normalise(name)
+            for phrase in [name] + (alternative_names or u'').split(u','):
+                phrase = normalise(phrase)
+                if not phrase:
+                    continue
+                terms.add((phrase, pk))
+                for word in WORD_SPLITTER.split(phrase):
+                    if word:
+                        terms.add((word, pk))
+        self.terms = sorted(terms)
+        self.words = sorted(set(term for term, pk in self.terms))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def label(self, pk):
+        return self.labels.get(pk, u'')
+
+    def prefix_matches(self, text):
+        """
+        Ids of the drugs with a name or word in a name starting with text, in order of the term that matched
+        """
+        matches = []
+        for term, pk in self.terms[bisect_left(self.terms, (text,)):]:
+            if not term.startswith(text):
+                break
+            matches.append(pk)
+        return matches
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        """
+        Return up to limit (id, label) pairs for drugs matching text. Names starting with the text come first, then
+        names containing it, then names it looks like a misspelling of.
+        """
+        text = normalise(text)
+        if not text:
+            return []
+        found = []
+        seen = set()
+
+        def add(pks):
+            for pk in pks:
+                if pk not in seen:
+                    seen.add(pk)
+                    found.append(pk)
+
+        add(self.prefix_matches(text))
+        if len(found) < limit:
+            add(pk for pk in sorted(self.labels, key=self.names.get) if text in normalise(self.labels[pk]))
+        if len(found) < limit:
+            for word in difflib.get_close_matches(text, self.words, n=limit, cutoff=FUZZY_CUTOFF):
+                add(self.prefix_matches(word))
+        return [(pk, self.labels[pk]) for pk in found[:limit]]
+
+
+def get_index():
+    """
+    Return the current DrugIndex, rebuilding it if a drug has changed since it was built
+    """
+    return DRUGS.get('index', lambda: DrugIndex(Drug.objects.values_list('pk', 'name', 'alternative_names')))
+
+
+def search(text, limit=SEARCH_LIMIT):
+    return get_index().search(text, limit)
+
+
+def invalidate():
+    DRUGS.invalidate()
@@ -0,0 +1,197 @@
+# coding=utf-8
+"""
+Export engine for the CAPS data. Rows are read from the database in fixed size chunks and written out through the csv
+module one at a time, so the full listing never has to be held in memory and the first bytes of the response can be
+sent to the client before the last row has been read.
+
+Each form's line is kept in the csv_rows cache region (see caps.cache) until the form, its histories, its creator's name
+or a drug change, so a repeat export only reads the forms that have changed since the last one.
+"""
+import csv
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.encoding import smart_str
+from caps import cache
+from caps.models import CapsForm
+
+# Number of forms read per database round trip. Each chunk costs one query for the forms (with their creators joined
+# in) plus one query per inline history, regardless of how many forms are in the chunk.
+CHUNK_SIZE = 500
+
+# Separator used when several inline history entries are flattened into a single CSV cell
+HISTORY_SEPARATOR = u' | '
+
+CSV_ROWS = cache.form_region('csv_rows')
+
+
+def iter_chunks(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Walk a queryset in primary key order, yielding lists of at most chunk_size objects. Each chunk is fetched with a
+    "WHERE id > last seen id" query rather than an OFFSET, so the cost of fetching a chunk does not grow as we work our
+    way through the table, and memory use is bounded by the chunk size rather than the table size. Querysets of
+    values() are walked in the same way, as long as they include 'pk'.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        yield chunk
+        last_pk = chunk[-1]['pk'] if isinstance(chunk[-1], dict) else chunk[-1].pk
+
+
+def export_queryset():
+    """
+    The base queryset for exporting forms, with the creator joined in and the inline histories prefetched per chunk
+    """
+    return CapsForm.objects.select_related('created_by').prefetch_related(
+        'previous_pregnancy_history',
+        'heart_disease_history',
+        'previous_medical_history',
+        'drug_history__drug',
+    )
+
+
+def iter_forms(queryset=None, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over every form to be exported, one at a time, while fetching them from the database in chunks
+    """
+    if queryset is None:
+        queryset = export_queryset()
+    for chunk in iter_chunks(queryset, chunk_size):
+        for form in chunk:
+            yield form
+
+
+def yes_no(value):
+    if value is None:
+        return u'Not Applicable'
+    return u'Yes' if value else u'No'
+
+
+def format_date(value, date_format='%d-%m-%Y'):
+    """
+    A date, or a date and time in local time as the admin shows it
+    """
+    if value is None:
+        return u''
+    if hasattr(value, 'hour') and timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.strftime(date_format)
+
+
+def flatten_history(entries):
+    """
+    Flatten a list of PregnancyProblem, HeartDisease or MedicalProblem objects into a single cell, e.g.
+    "Eclampsia | Other: details given"
+    """
+    values = []
+    for entry in entries:
+        if entry.details:
+            values.append(u"{0}: {1}".format(entry.type_string(), entry.details))
+        else:
+            values.append(entry.type_string())
+    return HISTORY_SEPARATOR.join(values)
+
+
+def flatten_drug_history(entries):
+    """
+    Flatten a list of DrugUse objects into a single cell, e.g. "Cocaine (2012-05-01 10:00) | Heroin (unknown)"
+    """
+    values = []
+    for entry in entries:
+        if entry.last_use_unknown or entry.last_use is None:
+            values.append(u"{0} (unknown)".format(entry.drug.name))
+        else:
+            values.append(u"{0} ({1})".format(entry.drug.name, format_date(entry.last_use, '%Y-%m-%d %H:%M')))
+    return HISTORY_SEPARATOR.join(values)
+
+
+# The exported columns, as (heading, function returning the cell value for a form) pairs, in form section order.
+# The related histories are read through .all() so that the prefetched results are used.
+COLUMNS = (
+    # Background record keeping
+    ('Case ID', lambda f: f.case_id),
+    ('Reported In', lambda f: f.case_reported or u''),
+    ('Created By', lambda f: u"{0} {1}".format(f.created_by.first_name, f.created_by.last_name)),
+    ('Created On', lambda f: format_date(f.created_on, '%d-%m-%Y %H:%M:%S')),
+    # Section 1: Woman's details
+    ('Year of Birth', lambda f: f.year_of_birth),
+    ('Ethnic Group', lambda f: f.ethnic_group_string()),
+    ('Marital Status', lambda f: f.marital_status_string()),
+    ('Employed', lambda f: yes_no(f.employed)),
+    ('Occupation', lambda f: f.occupation or u''),
+    ('Height (cm)', lambda f: f.height),
+    ('Weight (kg)', lambda f: f.weight),
+    ('Smoking Status', lambda f: f.smoking_string()),
+    # Section 2: Previous Obstetric History
+    ('Pregnancies 24+ Weeks', lambda f: f.gravidity_24plus),
+    ('Pregnancies Under 24 Weeks', lambda f: f.gravidity_24minus),
+    ('Previous Pregnancy Problems', lambda f: yes_no(f.previous_pregnancy_problem)),
+    ('Pregnancy Problem History', lambda f: flatten_history(f.previous_pregnancy_history.all())),
+    # Section 3: Previous Medical History
+    ('Heart Disease', lambda f: yes_no(f.heart_disease)),
+    ('Heart Disease History', lambda f: flatten_history(f.heart_disease_history.all())),
+    ('Cardiac Arrest', lambda f: yes_no(f.cardiac_arrest)),
+    ('Cardiac Arrest Date', lambda f: format_date(f.cardiac_arrest_date)),
+    ('Cardiac Arrest Cause', lambda f: f.cardiac_arrest_cause or u''),
+    ('Drug Use', lambda f: yes_no(f.drug_use)),
+    ('Drug Use History', lambda f: flatten_drug_history(f.drug_history.all())),
+    ('Medical Problems', lambda f: yes_no(f.previous_medical_problem)),
+    ('Medical Problem History', lambda f: flatten_history(f.previous_medical_history.all())),
+    # Added after the rest, so the existing columns keep their places
+    ('Expected Due Date', lambda f: format_date(f.expected_due_date)),
+)
+
+
+class Echo(object):
+    """
+    File-like object for the csv writer that hands back each written line rather than storing it
+    """
+    def write(self, value):
+        return value
+
+
+def iter_csv_rows(forms, columns=COLUMNS):
+    """
+    Yield the CSV export one encoded line at a time, starting with the heading row
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow([smart_str(heading) for heading, value in columns])
+    for form in forms:
+        yield writer.writerow([smart_str(value(form)) for heading, value in columns])
+
+
+def iter_cached_csv_rows(chunk_size=CHUNK_SIZE):
+    """
+    Yield the CSV export of every form, as iter_csv_rows(iter_forms()) does, taking each form's line from the cache
+    where it can. The ids are read a chunk at a time and looked up in the cache together, and only the forms missing
+    from it are read from the database, with their histories.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow([smart_str(heading) for heading, value in COLUMNS])
+
+    def build(pks):
+        return dict((form.pk, writer.writerow([smart_str(value(form)) for heading, value in COLUMNS]))
+                    for form in export_queryset().filter(pk__in=pks))
+
+    for chunk in iter_chunks(CapsForm.objects.values('pk'), chunk_size):
+        pks = [row['pk'] for row in chunk]
+        lines = CSV_ROWS.get_many(pks, build)
+        for pk in pks:
+            # A form deleted since its id was read is left out
+            if pk in lines:
+                yield lines[pk]
+
+
+def csv_response(rows, filename='caps-forms.csv'):
+    """
+    Build a response that streams the export to the client as it is generated, from encoded lines such as those of
+    iter_csv_rows. Passing an iterator as the content means Django hands the rows to the WSGI server as they are
+    produced rather than joining them up front.
+    """
+    response = HttpResponse(rows, content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+    return response
@@ -0,0 +1,56 @@
+from django.contrib.admin import SimpleListFilter
+from django.contrib.auth.models import User
+from django.db.models import Count
+from django.utils.encoding import smart_unicode
+from caps import cache, replicas
+from caps.models import CapsForm
+
+# How long the creator counts are kept for. Saves and deletes clear them straight away, so this only bounds how stale
+# the counts can get if a form is changed without the model signals (e.g. directly in the database), or in another
+# process when the cache isn't shared between processes.
+CREATOR_COUNTS_TIMEOUT = 300
+
+# A single aggregate over all the forms rather than a value per form, so it's cached even in a cache kept in each
+# process, where the counts may lag saves made by other processes by up to CREATOR_COUNTS_TIMEOUT
+CREATORS = cache.Region('creators', timeout=CREATOR_COUNTS_TIMEOUT)
+CREATORS.invalidate_on(CapsForm)
+CREATORS.invalidate_on(User, fields=('first_name', 'last_name'))
+
+
+def creator_counts():
+    """
+    Return a list of (user id, "First Last", number of forms) for every user that has created at least one form. This is
+    a single grouped query over the forms table, rather than a scan of every User, and the result is cached.
+    """
+    return CREATORS.get('counts', build_creator_counts)
+
+
+def build_creator_counts():
+    # From the primary, as a replica that is behind would cache the counts from before the save that dropped them
+    with replicas.use_primary():
+        rows = CapsForm.objects.values(
+            'created_by', 'created_by__first_name', 'created_by__last_name'
+        ).annotate(forms=Count('id')).order_by('created_by__last_name', 'created_by__first_name')
+        return [
+            (row['created_by'],
+             smart_unicode(u"{0} {1}".format(row['created_by__first_name'], row['created_by__last_name'])),
+             row['forms'])
+            for row in rows
+        ]
+
+
+class CreatedByListFilter(SimpleListFilter):
+    """
+    Replacement for the default created_by filter, which lists every User in the system. Only users who have entered
+    forms are listed, along with the number of forms they have entered.
+    """
+    title = 'name of person completing form'
+    parameter_name = 'created_by'
+
+    def lookups(self, request, model_admin):
+        return [(str(pk), u"{0} ({1})".format(name, forms)) for pk, name, forms in creator_counts()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(created_by=self.value())
+        return queryset
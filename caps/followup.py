@@ -0,0 +1,229 @@
+"""
+Follow-up reminders: two weeks after a woman's expected due date, the person who completed her form is reminded to
+follow the case up.
+
+Saving a form with an expected due date queues a FollowUp for it, due at FOLLOW_UP_TIME on the day FOLLOW_UP_DELAY
+after the due date, and changing or clearing the date moves or cancels it. The caps_send_followups command (run from
+cron, or left running with --loop) claims the follow-ups that are due a batch at a time and hands each to the backend
+named by CAPS_FOLLOWUP_BACKEND, by default EmailBackend. Finding the due follow-ups is a range scan of the
+(status, due_on) index, so the cost of each poll depends on how many are due, not how many forms there are.
+
+Several workers can run at once. On PostgreSQL a batch is claimed with SELECT ... FOR UPDATE SKIP LOCKED, so workers
+take different rows without waiting for each other. Elsewhere the candidates are read first and then claimed with a
+conditional UPDATE, so a row another worker got to first is left out of the batch. A claim lasts for CLAIM_TIMEOUT,
+after which a follow-up left claimed by a worker that stopped part way is put back in the queue. Failed reminders are
+retried with a growing delay, up to MAX_ATTEMPTS.
+"""
+import os
+import socket
+import uuid
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import get_connection, EmailMessage
+from django.core.urlresolvers import reverse
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.importlib import import_module
+from caps.models import CapsForm, FollowUp
+
+FOLLOW_UP_DELAY = timedelta(days=14)
+
+# Local time of day the reminders are sent
+FOLLOW_UP_TIME = time(9, 0)
+
+# Number of follow-ups claimed at a time
+BATCH_SIZE = 100
+
+CLAIM_TIMEOUT = timedelta(minutes=15)
+
+# Attempts at sending a reminder before giving up on it, and the wait before the first retry, doubled for each one after
+MAX_ATTEMPTS = 5
+RETRY_DELAY = timedelta(hours=1)
+
+DEFAULT_BACKEND = 'caps.followup.EmailBackend'
+
+PENDING = u'pending'
+CLAIMED = u'claimed'
+SENT = u'sent'
+FAILED = u'failed'
+CANCELLED = u'cancelled'
+
+
+def due_on(expected_due_date):
+    """
+    When the follow-up for a form with the given expected due date is due
+    """
+    due = datetime.combine(expected_due_date + FOLLOW_UP_DELAY, FOLLOW_UP_TIME)
+    if settings.USE_TZ:
+        due = timezone.make_aware(due, timezone.get_default_timezone())
+    return due
+
+
+def schedule(forms, using=DEFAULT_DB_ALIAS):
+    """
+    Queue follow-ups for new forms saved without the model signals (i.e. by the importer's bulk_create)
+    """
+    FollowUp.objects.using(using).bulk_create([
+        FollowUp(form_id=form.pk, recipient_id=form.created_by_id, expected_due_date=form.expected_due_date,
+                 due_on=due_on(form.expected_due_date))
+        for form in forms if form.expected_due_date is not None
+    ])
+
+
+def reschedule(sender, instance, created=False, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Keep a form's follow-up in step with its expected due date: queue one when a date is given, move the waiting one
+    when the date changes and cancel it when the date is cleared. A reminder already sent (or being retried) isn't
+    sent again unless the date changes.
+    """
+    date = instance.expected_due_date
+    if raw or (created and date is None):
+        return
+    follow_ups = FollowUp.objects.using(using).filter(form=instance.pk)
+    waiting = follow_ups.filter(status=PENDING)
+    if date is None:
+        waiting.update(status=CANCELLED)
+        return
+    # The date of the latest follow-up that hasn't been cancelled is the one the form was last queued for
+    queued_for = list(follow_ups.exclude(status=CANCELLED).order_by('-pk')
+                      .values_list('expected_due_date', flat=True)[:1])
+    if queued_for and queued_for[0] == date:
+        waiting.exclude(recipient=instance.created_by_id).update(recipient=instance.created_by_id)
+        return
+    if not waiting.update(expected_due_date=date, due_on=due_on(date), recipient=instance.created_by_id):
+        follow_ups.create(form=instance, recipient_id=instance.created_by_id, expected_due_date=date,
+                          due_on=due_on(date))
+
+post_save.connect(reschedule, sender=CapsForm, dispatch_uid='caps_followup_reschedule')
+
+
+def worker_name():
+    return u'{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])[:64]
+
+
+def release_expired(now, using=DEFAULT_DB_ALIAS):
+    """
+    Put follow-ups whose claim has run out back in the queue, returning how many there were
+    """
+    return FollowUp.objects.using(using).filter(status=CLAIMED, claimed_until__lt=now).update(
+        status=PENDING, claimed_by=u'', claimed_until=None)
+
+
+def claim(worker, batch_size=BATCH_SIZE, now=None, using=DEFAULT_DB_ALIAS):
+    """
+    Claim up to batch_size of the follow-ups that are due for worker, earliest first, returning their ids
+    """
+    now = now or timezone.now()
+    release_expired(now, using)
+    connection = connections[using]
+    until = now + CLAIM_TIMEOUT
+    if connection.vendor == 'postgresql' and getattr(connection, 'pg_version', 0) >= 90500:
+        table = connection.ops.quote_name(FollowUp._meta.db_table)
+        with transaction.commit_on_success(using=using):
+            cursor = connection.cursor()
+            cursor.execute(
+                'UPDATE {0} SET status = %s, claimed_by = %s, claimed_until = %s, attempts = attempts + 1 '
+                'WHERE id IN (SELECT id FROM {0} WHERE status = %s AND due_on <= %s ORDER BY due_on LIMIT %s '
+                'FOR UPDATE SKIP LOCKED) RETURNING id'.format(table),
+                [CLAIMED, worker, until, PENDING, now, batch_size])
+            return [row[0] for row in cursor.fetchall()]
+    queue = FollowUp.objects.using(using)
+    candidates = list(queue.filter(status=PENDING, due_on__lte=now).order_by('due_on')
+                      .values_list('pk', flat=True)[:batch_size])
+    if not candidates:
+        return []
+    # Only rows still waiting are claimed, so any another worker has claimed in the meantime are left to it
+    with transaction.commit_on_success(using=using):
+        queue.filter(pk__in=candidates, status=PENDING).update(
+            status=CLAIMED, claimed_by=worker, claimed_until=until, attempts=F('attempts') + 1)
+    return list(queue.filter(pk__in=candidates, status=CLAIMED, claimed_by=worker).values_list('pk', flat=True))
+
+
+class PermanentFailure(Exception):
+    """
+    Raised by a backend for a reminder that can never be sent (e.g. the recipient has no email address), so it isn't
+    retried
+    """
+
+
+class BaseBackend(object):
+    """
+    Sends reminders. send() is called for each follow-up in a batch, between open() and close().
+    """
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, follow_up):
+        raise NotImplementedError
+
+
+class EmailBackend(BaseBackend):
+    """
+    Emails the reminder to the person who completed the form, over a single connection to the mail server per batch
+    """
+    def open(self):
+        self.connection = get_connection()
+        self.connection.open()
+
+    def close(self):
+        self.connection.close()
+
+    def send(self, follow_up):
+        recipient = follow_up.recipient
+        if not recipient.email:
+            raise PermanentFailure(u'{0} has no email address'.format(recipient.username))
+        context = {
+            'follow_up': follow_up,
+            'form': follow_up.form,
+            'recipient': recipient,
+            'form_url': u'http://{0}{1}'.format(Site.objects.get_current().domain,
+                                                reverse('admin:caps_capsform_change', args=[follow_up.form_id])),
+        }
+        subject = u' '.join(render_to_string('caps/followup_subject.txt', context).split())
+        body = render_to_string('caps/followup_email.txt', context)
+        EmailMessage(subject, body, to=[recipient.email], connection=self.connection).send()
+
+
+def get_backend():
+    path = getattr(settings, 'CAPS_FOLLOWUP_BACKEND', DEFAULT_BACKEND)
+    module, _, name = path.rpartition('.')
+    return getattr(import_module(module), name)()
+
+
+def send_batch(worker, backend, batch_size=BATCH_SIZE, now=None, using=DEFAULT_DB_ALIAS):
+    """
+    Claim a batch of due follow-ups and send them. Returns a (sent, failed) pair of counts, both 0 when nothing is due.
+    """
+    now = now or timezone.now()
+    ids = claim(worker, batch_size, now, using)
+    if not ids:
+        return 0, 0
+    queue = FollowUp.objects.using(using)
+    sent = []
+    failed = 0
+    backend.open()
+    try:
+        for follow_up in queue.filter(pk__in=ids).select_related('form', 'recipient').order_by('due_on'):
+            try:
+                backend.send(follow_up)
+            except Exception as e:
+                failed += 1
+                retry = not isinstance(e, PermanentFailure) and follow_up.attempts < MAX_ATTEMPTS
+                queue.filter(pk=follow_up.pk).update(
+                    status=PENDING if retry else FAILED, claimed_by=u'', claimed_until=None, error=unicode(e),
+                    due_on=now + RETRY_DELAY * 2 ** (follow_up.attempts - 1) if retry else follow_up.due_on)
+            else:
+                sent.append(follow_up.pk)
+    finally:
+        backend.close()
+        # Recorded even if the batch stopped part way, so the reminders already sent aren't sent again
+        queue.filter(pk__in=sent).update(status=SENT, sent_on=timezone.now(), claimed_by=u'', claimed_until=None,
+                                         error=u'')
+    return len(sent), failed
@@ -0,0 +1,142 @@
+import json
+from django import forms
+from django.db import models
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.forms.models import BaseInlineFormSet
+from django.utils.encoding import force_unicode
+from caps import cache, choices, validation
+from caps.models import CapsForm, same_value
+
+# (id, label) of every user, for the created_by select
+USERS = cache.Region('users', timeout=cache.GENERATION_TIMEOUT, local=True)
+USERS.invalidate_on(User, fields=('username',))
+
+
+class UserChoiceField(forms.ModelChoiceField):
+    """
+    Choice of any user, as for created_by, with the list of users taken from the cache rather than read from the
+    database every time the form is shown. The submitted choice is still looked up in the database when validated.
+    """
+    def _get_choices(self):
+        choices = USERS.get('choices', lambda: [(user.pk, self.label_from_instance(user)) for user in self.queryset])
+        if self.empty_label is not None:
+            return [(u'', self.empty_label)] + choices
+        return choices
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+
+def saved_value(instance, name):
+    # A field's value as shown to the user, e.g. the label of a choice
+    if instance._meta.get_field(name).choices:
+        return choices.label(instance, name)
+    value = getattr(instance, name)
+    return u'' if value is None else force_unicode(value)
+
+
+def model_value(value):
+    # A cleaned value as the model stores it, i.e. the id of a chosen object
+    return value.pk if isinstance(value, models.Model) else value
+
+
+class CapsFormAdminForm(forms.ModelForm):
+    """
+    The admin's form for a CapsForm, which carries the version of the form that was opened and the answers it had then.
+    If someone else has saved the form since, the two saves are merged as CapsForm.merge does: the answers only they
+    changed keep their values, and those both changed to different values are marked with the saved value rather than
+    overwriting it. The version and the answers carried are then moved on to the ones saved, so that saving the form
+    again keeps the marked answers as submitted. The model's save makes the same check for a save made in the moment
+    between validating this form and saving it (see CapsForm.save).
+    """
+    version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+    # The answers as loaded, as JSON by field
+    loaded = forms.CharField(widget=forms.HiddenInput, required=False)
+
+    class Meta:
+        model = CapsForm
+
+    def __init__(self, *args, **kwargs):
+        super(CapsFormAdminForm, self).__init__(*args, **kwargs)
+        self.fields['version'].initial = self.instance.version
+        self.fields['loaded'].initial = self.saved_answers()
+
+    def answer_fields(self):
+        # The model fields answered on the form
+        return [(name, self.instance._meta.get_field(name)) for name in self.fields
+                if name not in ('version', 'loaded')]
+
+    def saved_answers(self):
+        return json.dumps(dict((field.attname, getattr(self.instance, field.attname))
+                               for name, field in self.answer_fields()), cls=DjangoJSONEncoder, sort_keys=True)
+
+    def loaded_answers(self, text):
+        """
+        The answers carried by the form, by field name, or None if there aren't any to be read
+        """
+        try:
+            values = json.loads(text)
+            return dict((name, field.to_python(values[field.attname])) for name, field in self.answer_fields())
+        except (ValueError, KeyError, TypeError, ValidationError):
+            return None
+
+    def clean(self):
+        cleaned_data = super(CapsFormAdminForm, self).clean()
+        version = cleaned_data.get('version')
+        if self.instance.pk is None or version is None or version == self.instance.version:
+            return cleaned_data
+        loaded = self.loaded_answers(cleaned_data.get('loaded') or u'')
+        self.data = self.data.copy()
+        differences = []
+        for name, field in self.answer_fields():
+            if name not in cleaned_data:
+                continue
+            theirs = getattr(self.instance, field.attname)
+            if loaded is None:
+                # Without the answers as loaded, any answer different to the saved one may overwrite theirs
+                if not same_value(model_value(cleaned_data[name]), theirs):
+                    differences.append(name)
+            elif not same_value(theirs, loaded[name]):
+                if same_value(model_value(cleaned_data[name]), loaded[name]):
+                    # Only they changed it, so their answer stays, and is shown if the form goes back to the user
+                    cleaned_data[name] = getattr(self.instance, name)
+                    self.data[self.add_prefix(name)] = self.fields[name].prepare_value(cleaned_data[name])
+                elif not same_value(model_value(cleaned_data[name]), theirs):
+                    differences.append(name)
+        self.data[self.add_prefix('version')] = self.instance.version
+        self.data[self.add_prefix('loaded')] = self.saved_answers()
+        if not differences:
+            return cleaned_data
+        for name in differences:
+            self._errors.setdefault(name, self.error_class()).append(
+                u'Saved by someone else as "{0}" since you opened this form'.format(saved_value(self.instance, name)))
+        raise ValidationError(u'Someone else has saved this form since you opened it, with different answers to the '
+                              u'questions marked below. Save again to replace their answers with yours.')
+
+
+class HistoryInlineFormSet(BaseInlineFormSet):
+    """
+    Inline formset for the CapsForm histories, which checks the submitted entries against the answers on the submitted
+    form. Everything is taken from the POSTed data, so this sees the histories as they are about to be saved rather
+    than as they were in the database, and doesn't need to query for them.
+    """
+    def clean(self):
+        super(HistoryInlineFormSet, self).clean()
+        # The instance is only the submitted form once the form itself has been validated (see CapsFormAdmin), and the
+        # entries can only be judged once each of them is valid.
+        if not getattr(self.instance, 'validate_histories', False) or any(self.errors):
+            return
+        entries = [form.instance for form in self.forms if self.is_live(form)]
+        errors = validation.check_history(self.instance, self.rel_name, entries)
+        if errors:
+            raise ValidationError(errors)
+
+    def is_live(self, form):
+        """
+        Is this form an entry that will be in the history once saved, i.e. neither blank nor marked for deletion?
+        """
+        cleaned_data = getattr(form, 'cleaned_data', None)
+        if not cleaned_data:
+            return False
+        return not (self.can_delete and cleaned_data.get('DELETE'))
@@ -0,0 +1,363 @@
+# coding=utf-8
+"""
+Bulk import of CAPS forms, e.g. historical UKOSS returns, from CSV or JSON.
+
+Records are read and validated in batches. Everything a record refers to (users and drugs) is loaded up front, the
+field and cross-field validation runs on in-memory objects, and each batch of valid forms is written with bulk_create
+along with their histories inside a single transaction. Records that fail validation are collected with their errors
+rather than stopping the import.
+
+Each record is a dictionary keyed by CapsForm field name, with created_by given as a username and the choice fields as
+either their code or their label. created_on, in the local time zone, keeps the date a historical return was made, and
+is the time of the import if left out. Histories are given under their related names, either as lists of dictionaries
+(JSON) or flattened in the same way as the CSV export (CSV), e.g.
+
+    previous_pregnancy_history: "Eclampsia | Other: Twins"
+    drug_history: "Cocaine (2012-05-01 10:00) | Heroin (unknown)"
+"""
+import csv
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.utils import timezone
+from django.utils.encoding import force_unicode
+# Imported as modules, as any of them may be the module that started importing the models, which import this
+import caps.export
+import caps.filters
+import caps.followup
+import caps.profiles
+import caps.search
+from caps import cache, choices, summary, validation
+from caps.models import CapsForm, Drug, DrugUse, PregnancyProblem, HeartDisease, MedicalProblem
+
+# Number of records validated and written per transaction
+BATCH_SIZE = 1000
+
+# Model for each of the histories, keyed by related name
+HISTORY_MODELS = (
+    (validation.PREGNANCY, PregnancyProblem),
+    (validation.HEART, HeartDisease),
+    (validation.MEDICAL, MedicalProblem),
+)
+
+TRUE_VALUES = (u'yes', u'y', u'true', u't', u'1')
+FALSE_VALUES = (u'no', u'n', u'false', u'f', u'0')
+NULL_VALUES = (u'', u'not applicable', u'n/a', u'none', u'null')
+DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y')
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%d-%m-%Y %H:%M', '%d-%m-%Y %H:%M:%S')
+
+
+def read_csv(fileobj):
+    """
+    Yield each row of a CSV file with a heading row as a dictionary of unicode values
+    """
+    for row in csv.DictReader(fileobj):
+        yield dict((key, force_unicode(value or '', 'utf-8')) for key, value in row.items() if key)
+
+
+def read_json(fileobj):
+    """
+    Yield each record from a file containing either a JSON list of objects, or one JSON object per line
+    """
+    first = fileobj.read(1)
+    while first and first.isspace():
+        first = fileobj.read(1)
+    if first == '[':
+        for record in json.loads(first + fileobj.read()):
+            yield record
+    elif first:
+        line = first + fileobj.readline()
+        while line:
+            if line.strip():
+                yield json.loads(line)
+            line = fileobj.readline()
+
+
+def parse_boolean(value, null=False):
+    if isinstance(value, bool) or (value is None and null):
+        return value
+    text = force_unicode(value if value is not None else u'').strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    if null and text in NULL_VALUES:
+        return None
+    raise ValueError(u"'{0}' is not a Yes/No answer".format(value))
+
+
+def parse_datetime(value, formats):
+    text = force_unicode(value).strip()
+    for date_format in formats:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    raise ValueError(u"'{0}' is not a recognised date".format(value))
+
+
+def is_blank(value):
+    return value is None or force_unicode(value).strip() == u''
+
+
+def split_history(value):
+    """
+    Split a flattened history cell into its entries, e.g. u"Eclampsia | Other: Twins" gives [u'Eclampsia', u'Other: Twins']
+    """
+    if isinstance(value, (list, tuple)):
+        return value
+    if is_blank(value):
+        return []
+    separator = caps.export.HISTORY_SEPARATOR.strip()
+    return [entry.strip() for entry in force_unicode(value).split(separator) if entry.strip()]
+
+
+class Importer(object):
+    """
+    Validate and save records in batches. After run(), imported holds the number of forms saved and errors holds a
+    (record number, case id, list of messages) tuple for each record that was rejected.
+    """
+    def __init__(self, batch_size=BATCH_SIZE, using=DEFAULT_DB_ALIAS, dry_run=False):
+        self.batch_size = batch_size
+        self.using = using
+        self.dry_run = dry_run
+        self.imported = 0
+        self.errors = []
+        # Load everything the records can refer to once, rather than once per record
+        self.users = dict((user.username.lower(), user) for user in User.objects.using(using).all())
+        self.drugs = {}
+        for drug in Drug.objects.using(using).all():
+            self.drugs.setdefault(drug.name.strip().lower(), drug)
+            for name in (drug.alternative_names or u'').split(u','):
+                if name.strip():
+                    self.drugs.setdefault(name.strip().lower(), drug)
+
+    def run(self, records):
+        batch = []
+        for number, record in enumerate(records, 1):
+            try:
+                batch.append(self.build(record))
+            except ValidationError as e:
+                self.errors.append((number, record.get('case_id', u''), e.messages))
+            if len(batch) >= self.batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+        return self.imported
+
+    def build(self, record):
+        """
+        Turn a record into an unsaved CapsForm and a dictionary of its unsaved histories, raising ValidationError if
+        anything about it is invalid.
+        """
+        errors = []
+        form = CapsForm()
+        for field in CapsForm._meta.fields:
+            if field.name in ('id', 'modified_on') or field.name not in record:
+                continue
+            # Leave unanswered fields that have a default (e.g. the Yes/No questions) to take it
+            if field.has_default() and is_blank(record[field.name]):
+                continue
+            try:
+                setattr(form, field.attname, self.parse_field(field, record[field.name]))
+            except (ValueError, InvalidOperation) as e:
+                errors.append(u'{0}: {1}'.format(field.verbose_name, force_unicode(e)))
+        if form.created_by_id is None and not errors:
+            errors.append(u'{0}: This field is required.'.format(CapsForm._meta.get_field('created_by').verbose_name))
+        try:
+            # created_by is resolved from the preloaded users, so skip the per-record existence query
+            form.clean_fields(exclude=['created_by'])
+        except ValidationError as e:
+            for name, messages in e.message_dict.items():
+                errors.extend(u'{0}: {1}'.format(CapsForm._meta.get_field(name).verbose_name, m) for m in messages)
+        histories = {}
+        for name, model in HISTORY_MODELS:
+            histories[name] = []
+            for entry in split_history(record.get(name)):
+                try:
+                    histories[name].append(self.parse_problem(model, entry))
+                except ValueError as e:
+                    errors.append(force_unicode(e))
+        histories[validation.DRUGS] = []
+        for entry in split_history(record.get(validation.DRUGS)):
+            try:
+                histories[validation.DRUGS].append(self.parse_drug_use(entry))
+            except ValueError as e:
+                errors.append(force_unicode(e))
+        if not errors:
+            try:
+                validation.validate(form, histories)
+            except ValidationError as e:
+                errors.extend(e.messages)
+        if errors:
+            raise ValidationError(errors)
+        return form, histories
+
+    def parse_field(self, field, value):
+        if field.name == 'created_by':
+            if isinstance(value, User):
+                return value.pk
+            user = self.users.get(force_unicode(value).strip().lower())
+            if user is None:
+                raise ValueError(u"'{0}' is not a known user".format(value))
+            return user.pk
+        if field.choices and field.get_internal_type() not in ('BooleanField', 'NullBooleanField'):
+            if is_blank(value):
+                return None
+            code = choices.get(CapsForm, field.name).code(value)
+            if code is None:
+                raise ValueError(u"'{0}' is not one of the choices".format(value))
+            return code
+        internal_type = field.get_internal_type()
+        if internal_type == 'BooleanField':
+            return parse_boolean(value)
+        if internal_type == 'NullBooleanField':
+            return parse_boolean(value, null=True)
+        if is_blank(value):
+            return None
+        if internal_type in ('IntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField'):
+            return int(value)
+        if internal_type == 'DecimalField':
+            return Decimal(force_unicode(value).strip())
+        if internal_type == 'DateField':
+            return parse_datetime(value, DATE_FORMATS).date()
+        if internal_type == 'DateTimeField':
+            return timezone.make_aware(parse_datetime(value, DATETIME_FORMATS + DATE_FORMATS),
+                                       timezone.get_current_timezone())
+        return force_unicode(value).strip()
+
+    def parse_problem(self, model, entry):
+        """
+        Build a history entry from either {'type': ..., 'details': ...} or u"Label: details"
+        """
+        if isinstance(entry, dict):
+            text, details = entry.get('type'), entry.get('details')
+        else:
+            text, _, details = entry.partition(u':')
+        code = choices.get(model, 'type').code(text)
+        if code is None:
+            raise ValueError(u"'{0}' is not a recognised {1}".format(text, model._meta.verbose_name))
+        return model(type=code, details=details.strip() if details else None)
+
+    def parse_drug_use(self, entry):
+        """
+        Build a DrugUse from either {'drug': ..., 'last_use': ..., 'last_use_unknown': ...} or u"Name (when)"
+        """
+        if isinstance(entry, dict):
+            name, last_use = entry.get('drug'), entry.get('last_use')
+            unknown = parse_boolean(entry.get('last_use_unknown', last_use is None))
+        else:
+            name, _, last_use = entry.partition(u'(')
+            last_use = last_use.rstrip(u')').strip()
+            unknown = last_use.lower() in (u'', u'unknown')
+        drug = self.drugs.get(force_unicode(name).strip().lower())
+        if drug is None:
+            raise ValueError(u"'{0}' is not in the drug dictionary".format(force_unicode(name).strip()))
+        drug_use = DrugUse(drug=drug, last_use_unknown=unknown)
+        if not unknown and not is_blank(last_use):
+            when = parse_datetime(last_use, DATETIME_FORMATS)
+            drug_use.last_use = timezone.make_aware(when, timezone.get_current_timezone())
+        return drug_use
+
+    def write(self, batch):
+        """
+        Save a batch of (form, histories) pairs in a single transaction
+        """
+        if self.dry_run:
+            self.imported += len(batch)
+            return
+        with transaction.commit_on_success(using=self.using):
+            forms = [form for form, histories in batch]
+            # bulk_create can't tell us the ids it used, so reserve them first and the histories can refer to them
+            for form, pk in zip(forms, self.reserve_ids(len(forms))):
+                form.pk = pk
+            # bulk_create stamps every form with the time it is saved (auto_now_add), so note the times given first
+            created_on = [(form, form.created_on) for form in forms if form.created_on is not None]
+            self.bulk_create(CapsForm, forms)
+            self.set_created_on(created_on)
+            children = dict((model, []) for name, model in HISTORY_MODELS + ((validation.DRUGS, DrugUse),))
+            for form, histories in batch:
+                for name, model in HISTORY_MODELS:
+                    for entry in histories[name]:
+                        entry.form_id = form.pk
+                        children[model].append(entry)
+                for entry in histories[validation.DRUGS]:
+                    entry.person_id = form.pk
+                    children[DrugUse].append(entry)
+            for model, objs in children.items():
+                self.bulk_create(model, objs)
+            # bulk_create doesn't send the save signals, so count the new forms in the summary, queue their follow-ups,
+            # write their risk profiles, index their text and drop the cached values built from the forms here
+            summary.record_imported(batch)
+            caps.followup.schedule(forms, self.using)
+            caps.profiles.record_imported(batch, self.using)
+            caps.search.index_imported(batch, self.using)
+        cache.invalidate_forms()
+        caps.filters.CREATORS.invalidate()
+        self.imported += len(batch)
+
+    def reserve_ids(self, count):
+        """
+        Return count unused ids for new forms. PostgreSQL hands them out from the table's sequence, so concurrent
+        writers are safe. Other backends continue on from the current maximum, which assumes the import is the only
+        thing adding forms while it runs.
+        """
+        connection = connections[self.using]
+        cursor = connection.cursor()
+        table = CapsForm._meta.db_table
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", [table, count]
+            )
+            return [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT MAX(id) FROM {0}".format(connection.ops.quote_name(table)))
+        start = (cursor.fetchone()[0] or 0) + 1
+        return range(start, start + count)
+
+    def set_created_on(self, forms):
+        """
+        Put back the created_on of (form, created_on) pairs that were given in the records, a chunk of forms per UPDATE
+        """
+        connection = connections[self.using]
+        quote_name = connection.ops.quote_name
+        field = CapsForm._meta.get_field('created_on')
+        cursor = connection.cursor()
+        # PostgreSQL takes the values of a CASE as text unless told otherwise. SQLite keeps them as the text they are.
+        value = 'CAST(%s AS {0})'.format(field.db_type(connection)) if connection.vendor == 'postgresql' else '%s'
+        # Three parameters per form, under SQLite's limit
+        size = 999 // 3
+        for start in range(0, len(forms), size):
+            chunk = forms[start:start + size]
+            params = []
+            for form, created_on in chunk:
+                form.created_on = created_on
+                params.extend([form.pk, field.get_db_prep_save(created_on, connection)])
+            params.extend(form.pk for form, created_on in chunk)
+            cursor.execute('UPDATE {0} SET {1} = CASE {2} {3} END WHERE {2} IN ({4})'.format(
+                quote_name(CapsForm._meta.db_table), quote_name(field.column), quote_name(CapsForm._meta.pk.column),
+                ' '.join(['WHEN %s THEN ' + value] * len(chunk)), ', '.join(['%s'] * len(chunk))
+            ), params)
+
+    def bulk_create(self, model, objs):
+        # SQLite limits the number of parameters in a statement, so keep each INSERT under that limit
+        if connections[self.using].vendor == 'sqlite':
+            size = max(1, 999 // len(model._meta.local_fields))
+        else:
+            size = 1000
+        for start in range(0, len(objs), size):
+            model.objects.using(self.using).bulk_create(objs[start:start + size])
+
+
+def write_error_report(errors, fileobj):
+    """
+    Write the rejected records out as CSV, one line per error message
+    """
+    writer = csv.writer(fileobj)
+    writer.writerow(['Record', 'Case ID', 'Error'])
+    for number, case_id, messages in errors:
+        for message in messages:
+            writer.writerow([number, force_unicode(case_id).encode('utf-8'), force_unicode(message).encode('utf-8')])
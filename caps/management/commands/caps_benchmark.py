@@ -0,0 +1,80 @@
+import json
+import platform
+import subprocess
+import sys
+import time
+from optparse import make_option
+import django
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from caps import benchmark
+
+
+def git_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=settings.PROJECT_ROOT).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+class Command(NoArgsCommand):
+    help = ('Benchmark form validation and saving, the changelist, the CSV export, the drug lookup and connecting '
+            'to the database for each request against '
+            'synthetic studies, in a separate database built for the purpose, and print the results as JSON')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='1000',
+            help='Comma separated study sizes to benchmark, in forms, e.g. 1000,100000,1000000 (default 1000)'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='Seed for the synthetic study (default 0)'),
+        make_option('--repeat', dest='repeat', type='int', default=3,
+            help='Runs of each benchmark, of which the fastest is reported (default 3)'),
+        make_option('--output', dest='output', default=None,
+            help='Write the results to this file rather than standard output'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            sizes = sorted(int(size) for size in options['sizes'].split(','))
+        except ValueError:
+            raise CommandError('--sizes should be a comma separated list of numbers of forms')
+        verbosity = int(options.get('verbosity', 1))
+        # Build a database of our own, as the test runner does, rather than touching the real one. On SQLite this is
+        # in memory unless the database's TEST_NAME setting says otherwise.
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # Only the default database is replaced, so the replicas (the real ones) are left out of the run, and the
+        # reads that would go to them are made from the benchmark database
+        replicas_off = override_settings(CAPS_REPLICAS=[])
+        replicas_off.enable()
+        try:
+            call_command('loaddata', 'Drugs', verbosity=0)
+            generator = benchmark.setup_study(options['seed'])
+            results = []
+            for size in sizes:
+                start = time.time()
+                imported = benchmark.grow_study(generator, size)
+                if verbosity > 1:
+                    sys.stderr.write('Generated %d forms in %.1fs\n' % (imported, time.time() - start))
+                results.extend(benchmark.run_benchmarks(generator, size, options['repeat']))
+        finally:
+            replicas_off.disable()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        output = json.dumps({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'engine': connection.settings_dict['ENGINE'],
+            'seed': options['seed'],
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output + '\n')
@@ -0,0 +1,44 @@
+import csv
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from caps import profiles
+
+
+class Command(BaseCommand):
+    args = '<conditions>'
+    help = ('Count the forms with a combination of conditions from the histories, e.g. "pregnancy.eclampsia and '
+            '(heart.prevcardsurg or not medical.cancer)", or write the co-occurrence matrix of every pair of '
+            'conditions as CSV')
+    option_list = BaseCommand.option_list + (
+        make_option('--cases', action='store_true', dest='cases', default=False,
+            help='List the case IDs of the matching forms'),
+        make_option('--cooccurrence', action='store_true', dest='cooccurrence', default=False,
+            help='Write the number of forms with each pair of conditions as CSV'),
+        make_option('--list', action='store_true', dest='list', default=False,
+            help='List the names of the conditions'),
+    )
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for name, label in profiles.CONDITIONS:
+                self.stdout.write(u'{0}\t{1}\n'.format(name, label).encode('utf-8'))
+            return
+        if options['cooccurrence']:
+            writer = csv.writer(self.stdout)
+            names = [name for name, label in profiles.CONDITIONS]
+            writer.writerow([''] + names)
+            for name, row in zip(names, profiles.cooccurrence()):
+                writer.writerow([name] + row)
+            return
+        if len(args) != 1:
+            raise CommandError('Please give the conditions, e.g. "pregnancy.eclampsia and heart.prevcardsurg"')
+        try:
+            condition = profiles.parse(args[0])
+        except ValueError as e:
+            raise CommandError(unicode(e))
+        forms = profiles.cohort(condition)
+        if options['cases']:
+            for case_id in forms.order_by('case_id').values_list('case_id', flat=True):
+                self.stdout.write(case_id.encode('utf-8') + '\n')
+        else:
+            self.stdout.write('%d forms\n' % forms.count())
@@ -0,0 +1,31 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from caps import columnar
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = 'Append the forms created since the last snapshot, and their histories, to a Parquet dataset'
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Remove the previous snapshots and export every form again'),
+        make_option('--row-group-size', dest='row_group_size', type='int', default=columnar.ROW_GROUP_SIZE,
+            help='Number of rows in each row group (default %d)' % columnar.ROW_GROUP_SIZE),
+        make_option('--database', dest='database', default='default',
+            help='Database to export from'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the directory to write the dataset to')
+        if columnar.pyarrow is None:
+            raise CommandError('The columnar export needs pyarrow, see requirements_optional.txt')
+        directory = args[0]
+        if options['full']:
+            columnar.clear(directory)
+        written = columnar.snapshot(directory, using=options['database'], row_group_size=options['row_group_size'])
+        if not written:
+            self.stdout.write('No new forms since the last snapshot\n')
+            return
+        for table in columnar.TABLES:
+            self.stdout.write('%-20s %8d rows\n' % (table.name, written[table.name]))
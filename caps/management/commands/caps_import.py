@@ -0,0 +1,43 @@
+import os
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from caps.importer import Importer, read_csv, read_json, write_error_report, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = 'Bulk import CAPS forms and their histories from a CSV or JSON file'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=('csv', 'json'),
+            help='Input format, csv or json. Defaults to the file extension.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=BATCH_SIZE,
+            help='Number of records to write per transaction (default %d)' % BATCH_SIZE),
+        make_option('--errors', dest='errors',
+            help='Write rejected records and their errors as CSV to this file'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Validate the file without saving anything'),
+        make_option('--database', dest='database', default='default',
+            help='Database to import into'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Please give the file to import')
+        path = args[0]
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format not in ('csv', 'json'):
+            raise CommandError('Unable to tell the format of %s, please give --format' % path)
+        reader = read_csv if file_format == 'csv' else read_json
+        importer = Importer(batch_size=options['batch_size'], using=options['database'], dry_run=options['dry_run'])
+        with open(path, 'rb' if file_format == 'csv' else 'r') as fileobj:
+            importer.run(reader(fileobj))
+        if importer.errors:
+            if options['errors']:
+                with open(options['errors'], 'wb') as report:
+                    write_error_report(importer.errors, report)
+            else:
+                write_error_report(importer.errors, sys.stderr)
+        self.stdout.write('%s %d forms, rejected %d\n' % (
+            'Validated' if options['dry_run'] else 'Imported', importer.imported, len(importer.errors)
+        ))
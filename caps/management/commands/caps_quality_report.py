@@ -0,0 +1,46 @@
+import json
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+from caps import quality
+
+
+class Command(NoArgsCommand):
+    help = 'Report outliers and missing answers across every CAPS form'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--json', action='store_true', dest='json', default=False,
+            help='Output the full report as JSON'),
+        make_option('--database', dest='database', default='default',
+            help='Database to report on'),
+    )
+
+    def handle_noargs(self, **options):
+        if quality.numpy is None:
+            raise CommandError('The data quality report needs NumPy, see requirements_optional.txt')
+        result = quality.report(using=options['database'])
+        if options['json']:
+            self.stdout.write(json.dumps(result, indent=2) + '\n')
+            return
+        self.stdout.write('Forms: %d\n\n' % result['forms'])
+        self.stdout.write('%-20s %8s %8s %8s %8s %8s\n' % ('Measure', 'Count', 'Median', '5%', '95%', 'Outliers'))
+        for measure in quality.MEASURES:
+            row = result['measures'][measure]
+            self.stdout.write('%-20s %8d %8s %8s %8s %8d\n' % (
+                measure, row['count'], format_number(row['median']), format_number(row['p05']),
+                format_number(row['p95']), row['outliers']
+            ))
+        self.stdout.write('\nMissing answers\n')
+        for name, value in sorted(result['missing'].items()):
+            self.stdout.write('%-52s %s\n' % (name, format_rate(value)))
+        self.stdout.write('\n%-12s %8s %10s %10s\n' % ('Reporter', 'Forms', 'Outliers', 'Missing'))
+        for row in result['reporters']:
+            self.stdout.write('%-12d %8d %10s %10s\n' % (
+                row['created_by'], row['forms'], format_rate(row['outlier_rate']), format_rate(row['missing_rate'])
+            ))
+
+
+def format_number(value):
+    return '-' if value is None else '%.1f' % value
+
+
+def format_rate(value):
+    return '-' if value is None else '%.1f%%' % (value * 100)
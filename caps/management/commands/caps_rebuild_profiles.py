@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from caps import profiles
+
+
+class Command(NoArgsCommand):
+    help = ('Recalculate the risk profiles of every form from the histories, e.g. after the history type choices have '
+            'changed')
+
+    def handle_noargs(self, **options):
+        with transaction.commit_on_success():
+            count = profiles.rebuild()
+        self.stdout.write('Rebuilt the risk profiles of %d forms\n' % count)
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+from caps import summary
+from caps.models import SummaryCount
+
+
+class Command(NoArgsCommand):
+    help = 'Recalculate the summary counts of the form data from scratch'
+
+    def handle_noargs(self, **options):
+        summary.rebuild()
+        self.stdout.write('Rebuilt %d summary counts\n' % SummaryCount.objects.count())
@@ -0,0 +1,32 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS
+from caps import reconcile
+
+
+class Command(NoArgsCommand):
+    help = ('Set the summary flags on the forms (e.g. heart_disease) that disagree with their histories, a range of '
+            'form ids at a time')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='List the changes that would be made without making them'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=reconcile.CHUNK_SIZE,
+            help='Number of form ids updated in each transaction (default %d)' % reconcile.CHUNK_SIZE),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to reconcile (default "default")'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options['database']
+        dry_run = options['dry_run']
+        counts = reconcile.sweep(dry_run, options['chunk_size'], using, found=self.show)
+        if int(options.get('verbosity', 1)):
+            for rule in reconcile.RULES:
+                self.stdout.write('%s: %d %s\n' % (rule.flag, counts[rule.flag], 'to fix' if dry_run else 'fixed'))
+            for flag, count in sorted(reconcile.unanswered(using).items()):
+                if count:
+                    self.stdout.write('%s: %d True without any history, to be answered on the form\n' % (flag, count))
+
+    def show(self, mismatch):
+        self.stdout.write(u'{0} {1}: {2} -> True\n'.format(mismatch.case_id, mismatch.flag, mismatch.old_value)
+                          .encode('utf-8'))
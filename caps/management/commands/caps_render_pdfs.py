@@ -0,0 +1,30 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from caps import pdf
+from caps.models import PdfBatch
+
+
+class Command(BaseCommand):
+    args = '<batch id>'
+    help = 'Render the forms of a PDF batch into a zip, across a pool of processes'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', type='int', default=None,
+            help='Number of processes to render with (default CAPS_PDF_PROCESSES, or one per CPU)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the id of the batch to render')
+        try:
+            batch = PdfBatch.objects.get(pk=args[0])
+        except (PdfBatch.DoesNotExist, ValueError):
+            raise CommandError('There is no PDF batch %s' % args[0])
+        if pdf.A4 is None:
+            # Marked as failed, so the progress page stops waiting for it
+            pdf.fail_batch(batch, pdf.MISSING_REPORTLAB)
+            raise CommandError(pdf.MISSING_REPORTLAB)
+        processes = options['processes'] or getattr(settings, 'CAPS_PDF_PROCESSES', None)
+        pdf.run_batch(batch, processes)
+        batch = PdfBatch.objects.get(pk=batch.pk)
+        self.stdout.write('Rendered %d of %d forms to %s\n' % (batch.done, batch.total, pdf.archive_path(batch)))
@@ -0,0 +1,117 @@
+import json
+import os
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from caps import middleware
+
+SORT_KEYS = ('p95', 'max', 'queries', 'count', 'slow')
+
+
+def percentile(values, share):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+def format_ms(value):
+    return '-' if value is None else '%.1f' % value
+
+
+def log_files(path):
+    """
+    The log file and its rotated backups (path.1, path.2, ...), oldest first
+    """
+    files = []
+    number = 1
+    while os.path.exists('%s.%d' % (path, number)):
+        files.insert(0, '%s.%d' % (path, number))
+        number += 1
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+class Command(NoArgsCommand):
+    help = 'Summarise the slowest endpoints from the request instrumentation log'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--log', dest='log', default=None,
+            help='Log file to read (default CAPS_REQUEST_LOG), along with its rotated backups'),
+        make_option('--sort', dest='sort', default='p95', choices=SORT_KEYS,
+            help='Order endpoints by p95 or max wall time, mean queries, number of requests or number of slow '
+                 'requests (default p95)'),
+        make_option('--limit', dest='limit', type='int', default=20,
+            help='Number of endpoints to list (default 20)'),
+    )
+
+    def handle_noargs(self, **options):
+        path = options['log'] or getattr(settings, 'CAPS_REQUEST_LOG', None)
+        files = log_files(path) if path else []
+        if not files:
+            raise CommandError('There is no request log at %s' % path)
+        # Records written before the log had the sample rate in them
+        default_rate = getattr(settings, 'CAPS_INSTRUMENT_SAMPLE_RATE', middleware.SAMPLE_RATE)
+        endpoints = {}
+        for name in files:
+            with open(name) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    stats = endpoints.setdefault(record['endpoint'], {
+                        'wall': [], 'requests': 0.0, 'queries': [], 'query_ms': [], 'template_ms': [],
+                        'repeated': {}, 'slow': [],
+                    })
+                    # Every slow request is logged, so they are counted as they are, but they would swamp the
+                    # percentiles, which are taken from the sampled requests alone
+                    if record.get('slow', not record.get('sampled')):
+                        stats['slow'].append(record['wall_ms'])
+                    if not record.get('sampled'):
+                        continue
+                    stats['wall'].append(record['wall_ms'])
+                    stats['requests'] += 1.0 / (record.get('sample_rate') or default_rate)
+                    stats['queries'].append(record['queries'])
+                    stats['query_ms'].append(record['query_ms'])
+                    stats['template_ms'].append(record['template_ms'])
+                    for repeat in record['repeated']:
+                        count, seen = stats['repeated'].get(repeat['sql'], (0, 0))
+                        stats['repeated'][repeat['sql']] = (max(count, repeat['count']), seen + 1)
+
+        rows = []
+        for name, stats in endpoints.items():
+            sampled = len(stats['queries'])
+            rows.append({
+                'endpoint': name,
+                'count': int(round(stats['requests'])),
+                'slow': len(stats['slow']),
+                'slow_max': max(stats['slow']) if stats['slow'] else None,
+                'p50': percentile(stats['wall'], 0.5),
+                'p95': percentile(stats['wall'], 0.95),
+                'max': max(stats['wall']) if stats['wall'] else None,
+                'queries': float(sum(stats['queries'])) / sampled if sampled else 0,
+                'query_ms': float(sum(stats['query_ms'])) / sampled if sampled else 0,
+                'template_ms': float(sum(stats['template_ms'])) / sampled if sampled else 0,
+                'repeated': stats['repeated'],
+            })
+        if options['sort'] == 'max':
+            rows.sort(key=lambda row: -max(row['max'], row['slow_max']))
+        else:
+            rows.sort(key=lambda row: -(row[options['sort']] or 0))
+
+        # Count is the estimated number of requests, the sampled ones scaled up by the sample rate, and the times are
+        # of the sampled requests. Slow is every request over CAPS_INSTRUMENT_SLOW_MS, sampled or not.
+        self.stdout.write('%-40s %7s %9s %9s %9s %6s %9s %8s %9s %9s\n' % (
+            'Endpoint', 'Count', 'p50 ms', 'p95 ms', 'Max ms', 'Slow', 'Slow max', 'Queries', 'Query ms', 'Tmpl ms'))
+        for row in rows[:options['limit']]:
+            self.stdout.write('%-40s %7d %9s %9s %9s %6d %9s %8.1f %9.1f %9.1f\n' % (
+                row['endpoint'][:40], row['count'], format_ms(row['p50']), format_ms(row['p95']),
+                format_ms(row['max']), row['slow'], format_ms(row['slow_max']), row['queries'], row['query_ms'],
+                row['template_ms']))
+        # Then the repeated queries behind the endpoints listed, the likely N+1 patterns
+        for row in rows[:options['limit']]:
+            if row['repeated']:
+                self.stdout.write('\nRepeated queries in %s:\n' % row['endpoint'])
+                for sql, (count, seen) in sorted(row['repeated'].items(), key=lambda item: -item[1][0]):
+                    self.stdout.write('  up to %d times per request, in %d requests: %s\n' % (count, seen, sql))
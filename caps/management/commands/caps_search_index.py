@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from caps import search
+
+
+class Command(NoArgsCommand):
+    help = ('Build the full-text search index of the forms from scratch, e.g. for forms saved before it was added. '
+            'It is kept up to date as forms are saved from then on.')
+
+    def handle_noargs(self, **options):
+        with transaction.commit_on_success():
+            count = search.rebuild()
+        self.stdout.write('Indexed %d forms\n' % count)
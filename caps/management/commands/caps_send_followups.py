@@ -0,0 +1,39 @@
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS
+from caps import followup
+
+
+class Command(NoArgsCommand):
+    help = ('Send the follow-up reminders that are due, a batch at a time, through CAPS_FOLLOWUP_BACKEND. Run it from '
+            'cron, or leave it running with --loop.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=followup.BATCH_SIZE,
+            help='Number of follow-ups claimed at a time (default %d)' % followup.BATCH_SIZE),
+        make_option('--loop', dest='loop', action='store_true', default=False,
+            help='Keep running, checking for follow-ups that have come due every --interval seconds'),
+        make_option('--interval', dest='interval', type='int', default=60,
+            help='Seconds to wait between checks when there is nothing due, with --loop (default 60)'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to read the follow-up queue from (default "default")'),
+    )
+
+    def handle_noargs(self, **options):
+        worker = followup.worker_name()
+        backend = followup.get_backend()
+        verbosity = int(options.get('verbosity', 1))
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = followup.send_batch(worker, backend, options['batch_size'], using=options['database'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                if verbosity > 1:
+                    self.stdout.write('Sent %d, failed %d\n' % (sent, failed))
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        if verbosity:
+            self.stdout.write('Sent %d follow-up reminders, %d failed\n' % (total_sent, total_failed))
@@ -0,0 +1,224 @@
+"""
+Per-request instrumentation: wall time, database query count and time, template render time and repeated queries (the
+mark of an N+1 pattern, e.g. a list column that looks up a related object for every row).
+
+Only a sample of requests (CAPS_INSTRUMENT_SAMPLE_RATE) is instrumented in full, so the cost to the rest is two calls
+to time(). For a sampled request each database connection records the SQL and duration of its queries, without the
+formatting and debug logging that DEBUG's query log does, and the outermost template render is timed. Requests slower
+than CAPS_INSTRUMENT_SLOW_MS are always logged, with whatever detail was recorded for them.
+
+Records are written as one JSON object per line to the 'caps.requests' logger, which the settings send to a rotating
+log file, and summarised by the caps_request_report command. Streamed responses (e.g. the exports) are timed up to the
+start of the response, not to the end of streaming.
+"""
+import json
+import random
+import threading
+from time import time
+from django.conf import settings
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import connections
+from django.db.backends.util import CursorWrapper, CursorDebugWrapper
+from django.template.base import Template
+from django.utils import timezone
+from django.utils.log import getLogger
+
+logger = getLogger('caps.requests')
+
+# Defaults for the CAPS_INSTRUMENT_* settings
+SAMPLE_RATE = 0.05
+SLOW_MS = 1000
+REPEAT_THRESHOLD = 5
+
+# Longest SQL kept in a record for a repeated query
+SQL_LENGTH = 500
+
+_local = threading.local()
+
+
+class Recorder(object):
+    """
+    What is recorded for one instrumented request
+    """
+    def __init__(self, from_request=False):
+        self.from_request = from_request
+        self.queries = []
+        self.template_time = 0.0
+        self.template_depth = 0
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """
+        (SQL, count, total seconds) of each query run at least threshold times, most frequent first. Queries are
+        compared before their parameters are filled in, so fetching a row by id for each of 50 rows counts as 50
+        repeats of the one query.
+        """
+        counts = {}
+        for sql, duration in self.queries:
+            count, total = counts.get(sql, (0, 0.0))
+            counts[sql] = (count + 1, total + duration)
+        repeated = [(sql, count, total) for sql, (count, total) in counts.items() if count >= threshold]
+        return sorted(repeated, key=lambda item: -item[1])
+
+
+class RecordingCursorWrapper(CursorWrapper):
+    """
+    Cursor that notes the SQL and duration of each query on the current Recorder
+    """
+    def __init__(self, cursor, db, recorder):
+        super(RecordingCursorWrapper, self).__init__(cursor, db)
+        self.recorder = recorder
+
+    def execute(self, sql, params=()):
+        self.set_dirty()
+        start = time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.recorder.queries.append((sql, time() - start))
+
+    def executemany(self, sql, param_list):
+        self.set_dirty()
+        start = time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.recorder.queries.append((sql, time() - start))
+
+
+def current_recorder():
+    return getattr(_local, 'recorder', None)
+
+
+def start_recording(from_request=False):
+    """
+    Start recording queries and template rendering on this thread. Connections are per thread, so switching their
+    cursors over only affects this request. Recording can also be started outside of a request (e.g. by the
+    benchmarks), in which case the middleware leaves it alone.
+    """
+    recorder = _local.recorder = Recorder(from_request)
+    for connection in connections.all():
+        # A connection that was already keeping its query log (with DEBUG on, or in the tests) goes on doing so
+        logging = connection.use_debug_cursor or settings.DEBUG
+        connection._caps_use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        connection.make_debug_cursor = lambda cursor, connection=connection, logging=logging: RecordingCursorWrapper(
+            CursorDebugWrapper(cursor, connection) if logging else cursor, connection, recorder)
+    return recorder
+
+
+def stop_recording():
+    """
+    Stop recording on this thread, returning the Recorder if there was one
+    """
+    recorder = current_recorder()
+    if recorder is not None:
+        _local.recorder = None
+        for connection in connections.all():
+            if hasattr(connection, '_caps_use_debug_cursor'):
+                connection.use_debug_cursor = connection._caps_use_debug_cursor
+                del connection._caps_use_debug_cursor
+                # Go back to the class's own make_debug_cursor
+                connection.__dict__.pop('make_debug_cursor', None)
+    return recorder
+
+
+def instrument_templates():
+    """
+    Time template rendering while a request is being recorded. Only the outermost render is timed, as {% extends %}
+    and {% include %} render other templates within it. The time includes any queries run by the template itself.
+    """
+    if getattr(Template, '_caps_instrumented', False):
+        return
+    render = Template._render
+
+    def _render(self, context):
+        recorder = current_recorder()
+        if recorder is None or recorder.template_depth:
+            return render(self, context)
+        recorder.template_depth += 1
+        start = time()
+        try:
+            return render(self, context)
+        finally:
+            recorder.template_depth -= 1
+            recorder.template_time += time() - start
+
+    Template._render = _render
+    Template._caps_instrumented = True
+
+
+def endpoint(request):
+    """
+    A name for the view that handled the request, e.g. the admin's url name caps_capsform_changelist, falling back to
+    the view function or path
+    """
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return request.path_info
+    if match.url_name:
+        return match.url_name
+    view = getattr(request, '_caps_view', None) or match.func
+    return '{0}.{1}'.format(getattr(view, '__module__', ''), getattr(view, '__name__', view.__class__.__name__))
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records a sample of requests, and every slow one, to the caps.requests log. It should be the first of the
+    MIDDLEWARE_CLASSES, so that its timing covers all of the others.
+    """
+    def __init__(self):
+        self.sample_rate = getattr(settings, 'CAPS_INSTRUMENT_SAMPLE_RATE', SAMPLE_RATE)
+        self.slow_ms = getattr(settings, 'CAPS_INSTRUMENT_SLOW_MS', SLOW_MS)
+        self.repeat_threshold = getattr(settings, 'CAPS_INSTRUMENT_REPEAT_THRESHOLD', REPEAT_THRESHOLD)
+        instrument_templates()
+
+    def process_request(self, request):
+        recorder = current_recorder()
+        if recorder is not None and recorder.from_request:
+            # An earlier request on this thread stopped before its response was processed
+            stop_recording()
+            recorder = None
+        request._caps_started = time()
+        if recorder is None and self.sample_rate and random.random() < self.sample_rate:
+            start_recording(from_request=True)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._caps_view = view_func
+
+    def process_response(self, request, response):
+        started = getattr(request, '_caps_started', None)
+        if started is None:
+            return response
+        wall_ms = (time() - started) * 1000
+        recorder = current_recorder()
+        if recorder is not None and recorder.from_request:
+            stop_recording()
+        else:
+            recorder = None
+        if recorder is not None or wall_ms >= self.slow_ms:
+            logger.info(json.dumps(self.record(request, response, wall_ms, recorder)))
+        return response
+
+    def record(self, request, response, wall_ms, recorder):
+        record = {
+            'time': timezone.now().isoformat(),
+            'method': request.method,
+            'path': request.path_info,
+            'endpoint': endpoint(request),
+            'status': response.status_code,
+            'wall_ms': round(wall_ms, 1),
+            'sampled': recorder is not None,
+            # For the report to scale the sample up to every request, and to tell the slow requests apart
+            'sample_rate': self.sample_rate,
+            'slow': wall_ms >= self.slow_ms,
+        }
+        if recorder is not None:
+            record.update({
+                'queries': len(recorder.queries),
+                'query_ms': round(sum(duration for sql, duration in recorder.queries) * 1000, 1),
+                'template_ms': round(recorder.template_time * 1000, 1),
+                'repeated': [{'sql': sql[:SQL_LENGTH], 'count': count, 'ms': round(total * 1000, 1)}
+                             for sql, count, total in recorder.repeated(self.repeat_threshold)],
+            })
+        return record
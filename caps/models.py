@@ -1,10 +1,12 @@
 # coding=utf-8
-from django.db import models
+from django.db import models, router
+from django.db.models.signals import pre_save, post_save
 from django.contrib.auth.models import User
 from django.utils.encoding import smart_unicode
 from django.core.validators import MaxValueValidator, MinValueValidator
 from datetime import date
 from django.core.exceptions import ValidationError
+from caps import choices, validation
 
 class Drug(models.Model):
     """
@@ -69,8 +71,30 @@ class DrugUse(models.Model):
     def clean(self):
         if self.last_use is None and not self.last_use_unknown:
             raise ValidationError("Section 3: Please specify a date for this drug use, or tick the box to say the timing is unknown")
-        if self.drug is not None:
-            self.person.drug_use = True
+
+
+def same_value(old, new):
+    """
+    Are two values of a field the same? A blank text answer is the same as a null one, as the admin gives u'' for an
+    empty text box whether the field is stored as null or not.
+    """
+    return old == new or (old in (None, u'') and new in (None, u''))
+
+
+class EditConflict(Exception):
+    """
+    Raised when a CapsForm can't be saved because someone else has saved it since it was loaded, giving some of the
+    same fields different values (or has deleted it). conflicts is a list of (field name, our value, their value).
+    """
+    def __init__(self, form, conflicts):
+        self.form = form
+        self.conflicts = conflicts
+        if conflicts:
+            message = u'Case {0} has been changed by someone else: {1}'.format(
+                form.case_id, u', '.join(name for name, ours, theirs in conflicts))
+        else:
+            message = u'Case {0} has been deleted by someone else'.format(form.case_id)
+        super(EditConflict, self).__init__(message)
 
 
 class CapsForm(models.Model):
@@ -153,6 +177,17 @@ class CapsForm(models.Model):
     created_by = models.ForeignKey(User, related_name='+', verbose_name='Name of person completing form', help_text="")
     # TODO: make this automatically default to the logged in user and not be user editable
     created_on = models.DateTimeField(auto_now_add=True, editable=False, help_text="")
+    # Updated whenever the form or one of its histories changes, for the API's Last-Modified and ETag headers
+    modified_on = models.DateTimeField(auto_now=True, editable=False, db_index=True, help_text="")
+    # Moved on by every save, so that a save can tell whether someone else has saved the form since it was loaded
+    version = models.PositiveIntegerField(default=1, editable=False)
+    # The person completing the form is reminded to follow the case up two weeks after this date (see caps.followup)
+    expected_due_date = models.DateField(
+        blank=True,
+        null=True,
+        verbose_name='Expected due date',
+        help_text="If known, you will be sent a reminder to complete the follow up two weeks after this date"
+    )
     # Section 1: Woman's details
     year_of_birth = models.IntegerField(
         max_length=4,
@@ -245,72 +280,107 @@ class CapsForm(models.Model):
         ))
 
     def ethnic_group_string(self):
-        for k,v in self.ETHNIC_ORIGIN_CHOICES:
-            if k == self.ethnic_group:
-                return v
-        return ''
+        return choices.label(self, 'ethnic_group')
 
     def marital_status_string(self):
-        for k,v in self.MARTIAL_STATUS_CHOICES:
-            if k == self.marital_status:
-                return v
-        return ''
+        return choices.label(self, 'marital_status')
 
     def smoking_string(self):
-        for k,v in self.SMOKING_CHOICES:
-            if k == self.smoking:
-                return v
-        return ''
+        return choices.label(self, 'smoking')
 
     def clean(self):
         """
-        Add model level validation for some of the multi-field validation tests required.
-        E.g. Entering Occupation details when employed is marked as True/Yes. Ensuring at least one drug has been
-        selected if drug use is highlighted.
+        Add model level validation for the multi-field tests that only need the values on the form itself, e.g.
+        entering Occupation details when employed is marked as True/Yes. The tests that depend on the histories, e.g.
+        ensuring at least one drug has been selected if drug use is highlighted, need the histories being submitted
+        along with the form, so are run by caps.validation from the admin inline formsets (or the importer) instead.
         """
-        # TODO: Find a better way to do field level validation rather than model level over multiple fields. This feels too inelegant.
-        # Test employed status and ensure there's occupation information when expected
-        if self.employed and len(self.occupation) < 1:
-            raise ValidationError('Section 1: Please enter occupation details for the woman')
-
-        # Test answers in section 2.
-        # If previous pregnancy problems have been entered here, then ensure gravidity count and pregnancy_problem are set
-        if self.previous_pregnancy_history.count() > 0:
-            self.previous_pregnancy_problem = True
-            if self.gravidity_24minus == 0 and self.gravidity_24plus == 0:
-                raise ValidationError("""
-                Section 2: No previous pregnancies have been entered. Please correct the number of previous pregnancies.
-                """)
-        elif self.previous_pregnancy_problem:
-            if self.previous_pregnancy_history.count() == 0:
-                raise ValidationError("Section 2: Please enter more information about previous pregnancy problems.")
-            if self.gravidity_24minus == 0 and self.gravidity_24plus == 0:
-                raise ValidationError("""
-                Section 2: No previous pregnancies have been entered. Please correct the number of previous pregnancies.
-                """)
-        # If there were previous pregnancies, remind them to answer the past problems question
-        if ((self.gravidity_24minus > 0 or self.gravidity_24plus > 0) and self.previous_pregnancy_problem == ""):
-            raise ValidationError("Section 2: Please indicate whether there were any previous pregnancy problems")
-
-#        TODO: Determine validation and save order for admin interface and model. At present related objects are not being
-#              validated on save, and there's no clear way to resolve this in the time remaining. Look to do this in the
-#              admin form validation?
-#        #Section 3 Tests
-        # If there are previous cardiac arrests, ensure a date has been entered
-        if self.cardiac_arrest and self.cardiac_arrest_date == None:
-            raise ValidationError("Section 3: Please enter the date of the most recent cardiac arrest")
-        # Autocorrect the cardiac arrest history
-        if not self.cardiac_arrest and self.cardiac_arrest_date != None:
-            self.cardiac_arrest = True
-#        # Ensure a drug has been linked if drug use is True
-#        if self.drug_use and self.drug_use_history.count() == 0:
-#            raise ValidationError("Section 3: Please specify at least one drug used by the woman")
-#        # Similar tests for medical history
-#        if self.previous_medical_problem and self.previous_medical_history.count() == 0:
-#            raise ValidationError("Section 3: Please specify a pre-existing or previous medical condition")
-
+        errors = validation.check_form(self)
+        if errors:
+            raise ValidationError(errors)
         return None
 
+    def __init__(self, *args, **kwargs):
+        super(CapsForm, self).__init__(*args, **kwargs)
+        self.remember_values()
+
+    def remember_values(self):
+        # The values as loaded or last saved, which a save compares with to find what has changed. Fields deferred by
+        # only() or defer() haven't been loaded, and are left out rather than read.
+        self._saved_values = dict((field.attname, self.__dict__[field.attname]) for field in self._meta.fields
+                                  if field.attname in self.__dict__)
+
+    def compared_fields(self):
+        # The fields a save compares, i.e. all but the id, the version and the modification time
+        return [field for field in self._meta.fields if not field.primary_key and field.attname != 'version' and
+                not getattr(field, 'auto_now', False) and field.attname in self.__dict__]
+
+    def changed_fields(self):
+        """
+        The fields that have changed since the form was loaded or last saved
+        """
+        return [field for field in self.compared_fields() if field.attname not in self._saved_values or
+                not same_value(self._saved_values[field.attname], self.__dict__[field.attname])]
+
+    def save(self, force_insert=False, force_update=False, using=None):
+        """
+        Save the form. A new form is inserted as usual. An existing one is saved with an UPDATE of just the fields that
+        have changed since it was loaded, on condition that its version is still the one loaded, and the version is
+        moved on. If someone else has saved the form in the meantime their changes are kept: where they changed other
+        fields the two saves are merged, and where they changed the same fields to different values EditConflict is
+        raised, leaving their save in place.
+        """
+        if force_insert or self.pk is None or self._state.adding:
+            super(CapsForm, self).save(force_insert, force_update, using)
+            self.remember_values()
+            return
+        using = using or router.db_for_write(CapsForm, instance=self)
+        pre_save.send(sender=CapsForm, instance=self, raw=False, using=using)
+        changed = self.changed_fields()
+        values = dict((field.name, getattr(self, field.attname)) for field in changed)
+        for field in self._meta.fields:
+            if getattr(field, 'auto_now', False):
+                values[field.name] = field.pre_save(self, False)
+        forms = CapsForm._default_manager.using(using)
+        version = self.version
+        while not forms.filter(pk=self.pk, version=version).update(version=version + 1, **values):
+            version = self.merge(forms.get, changed)
+        self.version = version + 1
+        # (field, old value, new value) of each field the save changed, for the audit trail
+        self.saved_changes = [(field, self._saved_values.get(field.attname), self.__dict__[field.attname])
+                              for field in changed]
+        self.remember_values()
+        post_save.send(sender=CapsForm, instance=self, created=False, raw=False, using=using)
+    save.alters_data = True
+
+    def merge(self, get, changed):
+        """
+        Take in the changes saved by someone else since the form was loaded, and return the version they saved. Raises
+        EditConflict if they gave any of the changed fields a different value to ours.
+        """
+        try:
+            current = get(pk=self.pk)
+        except CapsForm.DoesNotExist:
+            raise EditConflict(self, [])
+        ours = set(field.attname for field in changed)
+        conflicts = []
+        for field in current.compared_fields():
+            theirs = current.__dict__[field.attname]
+            if field.attname not in self._saved_values or same_value(theirs, self._saved_values[field.attname]):
+                continue
+            if field.attname not in ours:
+                setattr(self, field.attname, theirs)
+                # Drop the related object cached for a foreign key, which may no longer be the one it points to
+                self.__dict__.pop(field.get_cache_name(), None)
+            elif not same_value(theirs, self.__dict__[field.attname]):
+                conflicts.append((field.name, self.__dict__[field.attname], theirs))
+        if conflicts:
+            raise EditConflict(self, conflicts)
+        # Their save is what ours is now compared with, if it has to be merged with another
+        self._saved_values.update((field.attname, current.__dict__[field.attname])
+                                  for field in current.compared_fields() if field.attname in self._saved_values)
+        return current.version
+
 
 class PregnancyProblem(models.Model):
     """
@@ -352,16 +422,7 @@ class PregnancyProblem(models.Model):
         return smart_unicode("Case {} with pregnancy problem of {}".format(self.form.case_id, self.type_string()))
 
     def type_string(self):
-        for k,v in self.TYPE_CHOICES:
-            if k == self.type:
-                return v
-        return ''
-
-    def clean(self):
-        # Autocorrect form if pregnancy issues have been added.
-        if self.type is not None:
-            self.form.previous_pregnancy_problem = True
-        return None
+        return choices.label(self, 'type')
 
 
 class HeartDisease(models.Model):
@@ -404,20 +465,7 @@ class HeartDisease(models.Model):
         return smart_unicode("Case {} with heart disease history of {}".format(self.form.case_id, self.type_string()))
 
     def type_string(self):
-        for k,v in self.TYPE_CHOICES:
-            if k == self.type:
-                return v
-        return ''
-
-    def clean(self):
-#        This test is never executed because if there is no data entered at all on this inline, then there's no model to clean...
-#        # Check that at least one factor has been added for heart disease history
-#        if self.form.heart_disease and self.type is None:
-#            raise ValidationError("Section 3: Please specify more information about pre-disposing factors for heart disease.")
-        # Autocorrect form if heart diseases issues have been added.
-        if self.type is not None:
-            self.form.heart_disease = True
-        return None
+        return choices.label(self, 'type')
 
 
 class MedicalProblem(models.Model):
@@ -448,13 +496,182 @@ class MedicalProblem(models.Model):
         return smart_unicode("Case {} with pre-existing medical problem of {}".format(self.form.case_id, self.type_string()))
 
     def type_string(self):
-        for k,v in self.TYPE_CHOICES:
-            if k == self.type:
-                return v
-        return ''
+        return choices.label(self, 'type')
 
-    def clean(self):
-        # Autocorrect the answer to previous medical problems if data entered here
-        if self.type is not None:
-            self.form.previous_medical_problem = True
-        return None
+
+class SummaryCount(models.Model):
+    """
+    Materialised counts behind the on screen summary of the form data, one row per bucket of each summary dimension
+    (e.g. dimension "smoking", bucket "current"). Kept up to date as forms are saved and deleted by caps.summary, so
+    the summary page reads one row per bucket rather than aggregating the whole of the form and history tables.
+    """
+    dimension = models.CharField(max_length=30)
+    bucket = models.CharField(max_length=40)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('dimension', 'bucket')
+        ordering = ('dimension', 'bucket')
+
+    def __unicode__(self):
+        return smart_unicode("{0} {1}: {2}".format(self.dimension, self.bucket, self.count))
+
+
+class PdfBatch(models.Model):
+    """
+    A request to print a set of forms as PDF. The forms are rendered in a separate process (see caps.pdf) which records
+    its progress here as it goes, so the admin can poll for it, and leaves a zip of the PDFs behind when it is done.
+    """
+    STATUS_CHOICES = (
+        (u'pending', u'Waiting to start'),
+        (u'running', u'Rendering'),
+        (u'done', u'Complete'),
+        (u'failed', u'Failed'),
+    )
+    created_by = models.ForeignKey(User, related_name='+', verbose_name='Requested by')
+    created_on = models.DateTimeField(auto_now_add=True, editable=False)
+    finished_on = models.DateTimeField(blank=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=u'pending')
+    form_ids = models.TextField(blank=True, help_text="Comma separated ids of the forms to print")
+    total = models.IntegerField(default=0)
+    done = models.IntegerField(default=0)
+    archive = models.CharField(max_length=255, blank=True, help_text="Zip of the PDFs, relative to CAPS_PDF_ROOT")
+    error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = 'PDF batch'
+        verbose_name_plural = 'PDF batches'
+        ordering = ('-created_on',)
+
+    def __unicode__(self):
+        return smart_unicode("PDF batch {0} ({1} of {2} forms)".format(self.pk, self.done, self.total))
+
+    def get_form_ids(self):
+        return [int(pk) for pk in self.form_ids.split(',') if pk.strip()]
+
+    def set_form_ids(self, ids):
+        self.form_ids = u','.join(str(pk) for pk in ids)
+        self.total = len(ids)
+
+    def percent(self):
+        if not self.total:
+            return 100 if self.status == u'done' else 0
+        return int(100 * self.done / self.total)
+
+
+class FollowUp(models.Model):
+    """
+    A reminder to the person who completed a form to follow the case up, two weeks after the expected due date. The
+    follow-ups are a queue ordered by when they are due, worked through in batches by the caps_send_followups command
+    (see caps.followup), so sending them never has to look at the forms themselves.
+    """
+    STATUS_CHOICES = (
+        (u'pending', u'Waiting'),
+        (u'claimed', u'Sending'),
+        (u'sent', u'Sent'),
+        (u'failed', u'Failed'),
+        (u'cancelled', u'Cancelled'),
+    )
+    form = models.ForeignKey(CapsForm, related_name='follow_ups')
+    recipient = models.ForeignKey(User, related_name='+')
+    # The form's expected due date the follow-up was queued for. due_on starts from it, but is put back by retries.
+    expected_due_date = models.DateField(verbose_name='Expected due date')
+    # Indexed with the status by caps/sql/followup.sql, as the queue is read by status and due time
+    due_on = models.DateTimeField(verbose_name='Due')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=u'pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # The worker sending the reminder, and when its claim runs out if it stops before finishing
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_until = models.DateTimeField(blank=True, null=True)
+    sent_on = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = 'follow-up'
+        verbose_name_plural = 'follow-ups'
+        ordering = ('due_on',)
+
+    def __unicode__(self):
+        return smart_unicode("Follow-up of case {0} due {1}".format(self.form.case_id, self.due_on))
+
+
+class FieldChange(models.Model):
+    """
+    A change to one field of a CapsForm or one of its histories, in the audit trail kept by caps.audit. Adding an entry
+    is recorded as a single row without a field, and deleting one as a row for each field holding the value it had.
+    """
+    ACTION_CHOICES = (
+        (u'c', u'Added'),
+        (u'u', u'Changed'),
+        (u'd', u'Deleted'),
+    )
+    # The form the change belongs to, which for a history is the form it is part of. Not a foreign key, so that the
+    # trail of a form outlives the form.
+    form_id = models.PositiveIntegerField()
+    model = models.CharField(max_length=20)
+    object_id = models.PositiveIntegerField()
+    # The field's attname, e.g. created_by_id
+    field = models.CharField(max_length=50, blank=True)
+    action = models.CharField(max_length=1, choices=ACTION_CHOICES)
+    old_value = models.TextField(blank=True, null=True)
+    new_value = models.TextField(blank=True, null=True)
+    # Indexed with changed_on, along with form_id, by caps/sql/fieldchange.sql
+    changed_by = models.ForeignKey(User, blank=True, null=True, related_name='+', db_index=False,
+                                   on_delete=models.SET_NULL)
+    changed_on = models.DateTimeField()
+
+    class Meta:
+        verbose_name = 'field change'
+        verbose_name_plural = 'field changes'
+        ordering = ('changed_on', 'id')
+
+    def __unicode__(self):
+        return smart_unicode("{0} {1} {2}.{3} of form {4}".format(
+            self.get_action_display(), self.model, self.object_id, self.field, self.form_id))
+
+
+class SearchDocument(models.Model):
+    """
+    The free text of a form and its histories, as indexed for searching (see caps.search). On PostgreSQL the table also
+    has a tsvector column of the text, kept up to date by a trigger (caps/sql/searchdocument.postgresql_psycopg2.sql).
+    """
+    # Not a foreign key, so that the text can be replaced while the form's histories are being deleted along with it
+    form_id = models.PositiveIntegerField(primary_key=True)
+    text = models.TextField()
+
+
+class SearchTerm(models.Model):
+    """
+    A word in the text of a form, and the number of times it appears there, in the inverted index used for searching
+    on databases other than PostgreSQL (see caps.search)
+    """
+    # Indexed along with the form by caps/sql/searchterm.sql
+    term = models.CharField(max_length=50)
+    form_id = models.PositiveIntegerField(db_index=True)
+    count = models.PositiveIntegerField()
+
+
+class RiskProfile(models.Model):
+    """
+    Every coded condition in a form's pregnancy problem, heart disease, medical problem and drug histories, each as one
+    bit of an integer, so that cohort queries combining conditions need no joins (see caps.profiles)
+    """
+    # Not a foreign key, so that the profile can be updated while the form's histories are being deleted along with it
+    form_id = models.PositiveIntegerField(primary_key=True)
+    bits = models.BigIntegerField(default=0)
+
+
+# Build the code/label lookups for every choice field once, now that all the models are defined
+for model in (Drug, DrugUse, CapsForm, PregnancyProblem, HeartDisease, MedicalProblem):
+    choices.register_model(model)
+
+# Connect the signal handlers that keep the derived data (the drug index, summary counts, API modification times,
+# follow-ups and risk profiles), the audit trail and the search index up to date. Imported as modules rather than from
+# the package, as any of them may be the one importing this.
+import caps.api
+import caps.audit
+import caps.drugs
+import caps.followup
+import caps.profiles
+import caps.search
+import caps.summary
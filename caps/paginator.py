@@ -0,0 +1,177 @@
+"""
+Seek (keyset) pagination for the CapsForm changelist.
+
+The default admin pagination uses OFFSET, so showing page n means the database reads and throws away every row on
+the pages before it, and a full COUNT(*) is run on every page view. Here each page is fetched with a condition on the
+(created_on, id) of the last row shown, which can be answered straight from the index no matter how deep into the list
+we are, and unfiltered lists use the PostgreSQL planner statistics for the row count instead of counting.
+"""
+from datetime import datetime
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ALL_VAR, ORDER_VAR
+from django.core.paginator import Paginator, Page, InvalidPage
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+# Query string parameters holding the cursor for the page after or before the one being shown
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+
+# Tables with fewer rows than this (by the planner's estimate) are counted exactly, as the estimate is less reliable
+# for small tables and an exact count is cheap anyway.
+ESTIMATE_THRESHOLD = 10000
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def estimated_count(queryset):
+    """
+    Return the number of rows in the queryset, using the planner's estimate of the table size when the queryset is
+    unfiltered and the database is PostgreSQL. Everything else falls back to an exact count.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql' and not queryset.query.where:
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [connection.ops.quote_name(queryset.model._meta.db_table)]
+        )
+        row = cursor.fetchone()
+        if row and row[0] >= ESTIMATE_THRESHOLD:
+            return int(row[0])
+    return queryset.count()
+
+
+def encode_cursor(obj):
+    """
+    Encode the (created_on, id) position of an object as a short query string value, e.g. 20120701093000000000-42
+    """
+    created_on = obj.created_on
+    if timezone.is_aware(created_on):
+        created_on = timezone.make_naive(created_on, timezone.utc)
+    return '{0}-{1}'.format(created_on.strftime(CURSOR_DATE_FORMAT), obj.pk)
+
+
+def decode_cursor(value):
+    """
+    Reverse of encode_cursor, returning a (created_on, id) tuple. Raises InvalidPage for anything malformed.
+    """
+    try:
+        created_on, pk = value.split('-')
+        created_on = datetime.strptime(created_on, CURSOR_DATE_FORMAT)
+        pk = int(pk)
+    except (ValueError, AttributeError):
+        raise InvalidPage('Invalid page cursor')
+    return timezone.make_aware(created_on, timezone.utc), pk
+
+
+class KeysetPage(Page):
+    """
+    A page of results, which knows the cursors for the pages either side of it rather than its page number
+    """
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        super(KeysetPage, self).__init__(object_list, 1, paginator)
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return encode_cursor(self.object_list[-1])
+        return None
+
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return encode_cursor(self.object_list[0])
+        return None
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator over a queryset ordered by newest first, i.e. ('-created_on', '-id'). Pages are addressed by the cursor
+    of the row before (after=) or after (before=) them rather than by number, and each page costs a single query
+    reading per_page + 1 rows from the index.
+    """
+    def __init__(self, object_list, per_page, after=None, before=None, **kwargs):
+        super(KeysetPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.after = after
+        self.before = before
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+    def page(self, number=None):
+        queryset = self.object_list
+        if self.before:
+            created_on, pk = decode_cursor(self.before)
+            rows = list(queryset.filter(
+                Q(created_on__gt=created_on) | Q(created_on=created_on, pk__gt=pk)
+            ).order_by('created_on', 'pk')[:self.per_page + 1])
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            rows.reverse()
+            return KeysetPage(rows, self, has_next=True, has_previous=has_previous)
+        if self.after:
+            created_on, pk = decode_cursor(self.after)
+            queryset = queryset.filter(Q(created_on__lt=created_on) | Q(created_on=created_on, pk__lt=pk))
+        rows = list(queryset.order_by('-created_on', '-pk')[:self.per_page + 1])
+        has_next = len(rows) > self.per_page
+        return KeysetPage(rows[:self.per_page], self, has_next=has_next, has_previous=bool(self.after))
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList that pages through the default newest-first ordering with a KeysetPaginator. When the list has been
+    sorted by a column, or "show all" has been requested, it falls back to the standard admin pagination. If the model
+    admin has a full_text_search(queryset, text) method, the search box is answered by it.
+    """
+    def get_query_set(self, request):
+        # Take the cursor out of the parameters before the filters see it, or it would be treated as a field lookup
+        # (this is called again when running actions, by which time they have already been removed)
+        self.after = self.params.pop(AFTER_VAR, getattr(self, 'after', None))
+        self.before = self.params.pop(BEFORE_VAR, getattr(self, 'before', None))
+        search = getattr(self.model_admin, 'full_text_search', None)
+        if search is None or not self.query:
+            return super(KeysetChangeList, self).get_query_set(request)
+        # The model admin answers the search box from its own index, rather than with LIKE lookups of search_fields
+        query, self.query = self.query, u''
+        try:
+            queryset = super(KeysetChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        return search(queryset, query)
+
+    def uses_keyset(self):
+        return ORDER_VAR not in self.params and ALL_VAR not in self.params
+
+    def get_results(self, request):
+        self.keyset_page = None
+        if not self.uses_keyset():
+            return super(KeysetChangeList, self).get_results(request)
+        paginator = KeysetPaginator(self.query_set, self.list_per_page, after=self.after, before=self.before)
+        try:
+            page = paginator.page()
+        except InvalidPage:
+            raise IncorrectLookupParameters
+        self.result_count = paginator.count
+        if not self.query_set.query.where:
+            self.full_result_count = self.result_count
+        else:
+            self.full_result_count = estimated_count(self.root_query_set)
+        self.result_list = page.object_list
+        self.can_show_all = False
+        self.multi_page = page.has_next() or page.has_previous()
+        self.paginator = paginator
+        self.keyset_page = page
+        self.first_page_url = self.get_query_string()
+        self.next_page_url = page.has_next() and self.get_query_string({AFTER_VAR: page.next_cursor()})
+        self.previous_page_url = page.has_previous() and self.get_query_string({BEFORE_VAR: page.previous_cursor()})
@@ -0,0 +1,221 @@
+# coding=utf-8
+"""
+PDF print out of CAPS forms, laid out section by section as in the admin, with each inline history printed after the
+question it belongs to.
+
+Printing many forms (e.g. the whole study for an audit) is done as a PdfBatch. The admin only records the batch and
+starts the caps_render_pdfs command in a separate process, so the web worker returns straight away. The command splits
+the forms into chunks and renders them across a pool of processes, adding each PDF to a single zip as the chunks come
+back and recording how many are done, which the admin polls to show progress.
+
+ReportLab is an optional dependency, only needed for the PDF print out.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import traceback
+import zipfile
+from multiprocessing import Pool
+from xml.sax.saxutils import escape
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from django.utils.encoding import force_unicode
+from caps import choices
+from caps.export import export_queryset
+from caps.models import CapsForm, PdfBatch
+
+try:
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import mm
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+except ImportError:
+    A4 = None
+
+MISSING_REPORTLAB = u'The PDF print out needs ReportLab, see requirements_optional.txt'
+
+# Number of forms each pool process renders at a time
+CHUNK_SIZE = 50
+
+# The inline history printed after each question, as in the commented out placeholders in CapsFormAdmin.fieldsets
+HISTORIES = {
+    'previous_pregnancy_problem': ('previous_pregnancy_history', 'Previous pregnancy problems'),
+    'heart_disease': ('heart_disease_history', 'Heart disease'),
+    'drug_use': ('drug_history', 'Drugs used'),
+    'previous_medical_problem': ('previous_medical_history', 'Previous medical problems'),
+}
+
+NO_ANSWER = u'-'
+
+
+def format_date(value):
+    """
+    A date, or a date and time in local time, as printed on the form
+    """
+    if value is None:
+        return u''
+    if hasattr(value, 'hour'):
+        if timezone.is_aware(value):
+            value = timezone.localtime(value)
+        return value.strftime('%d-%m-%Y %H:%M')
+    return value.strftime('%d-%m-%Y')
+
+
+def fieldsets():
+    # Imported here, as the admin module imports the models and registers them with the admin site
+    from caps.admin import CapsFormAdmin
+    return [(name or u'Case details', options['fields']) for name, options in CapsFormAdmin.fieldsets]
+
+
+def display_value(form, name):
+    """
+    The answer to a question as it should be printed, e.g. the label for a choice and Yes/No for a Yes/No question
+    """
+    field = CapsForm._meta.get_field(name)
+    if name == 'created_by':
+        return u'{0} {1}'.format(form.created_by.first_name, form.created_by.last_name).strip()
+    value = getattr(form, name)
+    if field.choices:
+        return choices.label(form, name) or NO_ANSWER
+    if value is None or value == u'':
+        return NO_ANSWER
+    if hasattr(value, 'strftime'):
+        return format_date(value)
+    return force_unicode(value)
+
+
+def history_rows(form, related_name):
+    """
+    One (entry, details) pair for each entry in an inline history, read from the prefetched entries where there are any
+    """
+    rows = []
+    for entry in getattr(form, related_name).all():
+        if related_name == 'drug_history':
+            rows.append((entry.drug.name, u'Unknown' if entry.last_use_unknown else format_date(entry.last_use)))
+        else:
+            rows.append((choices.label(entry, 'type'), entry.details or u''))
+    return rows
+
+
+def render_form(form, fileobj):
+    """
+    Write a print out of a single form to fileobj
+    """
+    if A4 is None:
+        raise ImportError(MISSING_REPORTLAB)
+    styles = getSampleStyleSheet()
+    cell = styles['BodyText']
+    grid = TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('BACKGROUND', (0, 0), (0, -1), colors.whitesmoke),
+    ])
+    story = [
+        Paragraph(escape(u'Cardiac Arrest in Pregnancy Study (CAPS): {0}'.format(form.case_id)), styles['Title']),
+        Paragraph(u'Entered {0}'.format(format_date(form.created_on)), styles['Normal']),
+    ]
+    for heading, names in fieldsets():
+        story.append(Paragraph(escape(heading), styles['Heading2']))
+        rows = []
+        for name in names:
+            label = force_unicode(CapsForm._meta.get_field(name).verbose_name)
+            rows.append([Paragraph(escape(label), cell), Paragraph(escape(display_value(form, name)), cell)])
+        story.append(Table(rows, colWidths=(80 * mm, 90 * mm), style=grid))
+        for name in names:
+            if name in HISTORIES:
+                related_name, title = HISTORIES[name]
+                entries = history_rows(form, related_name)
+                if entries:
+                    story.append(Spacer(0, 3 * mm))
+                    story.append(Paragraph(title, styles['Heading4']))
+                    rows = [[Paragraph(escape(entry), cell), Paragraph(escape(details), cell)]
+                            for entry, details in entries]
+                    story.append(Table(rows, colWidths=(80 * mm, 90 * mm), style=grid))
+    document = SimpleDocTemplate(fileobj, pagesize=A4, title=u'CAPS form {0}'.format(form.case_id),
+                                 leftMargin=20 * mm, rightMargin=20 * mm, topMargin=20 * mm, bottomMargin=20 * mm)
+    document.build(story)
+
+
+def form_filename(form):
+    return u'caps-{0}-{1}.pdf'.format(form.case_id, form.pk).replace(u'/', u'-')
+
+
+def render_chunk(args):
+    """
+    Render the forms with the given ids into directory, returning the names of the files written. Run in the pool
+    processes, so it takes a single tuple of arguments.
+    """
+    ids, directory = args
+    names = []
+    for form in export_queryset().filter(pk__in=ids).order_by('pk'):
+        name = form_filename(form)
+        with open(os.path.join(directory, name), 'wb') as f:
+            render_form(form, f)
+        names.append(name)
+    return names
+
+
+def start_batch(batch):
+    """
+    Start rendering a batch in a separate process, returning without waiting for it
+    """
+    manage = os.path.join(settings.PROJECT_ROOT, '..', 'manage.py')
+    # Not sys.executable, which is the server binary under uwsgi or mod_wsgi
+    python = getattr(settings, 'CAPS_PDF_PYTHON', None) or sys.executable
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.Popen([python, manage, 'caps_render_pdfs', str(batch.pk)], close_fds=True,
+                         stdin=devnull, stdout=devnull, stderr=devnull, cwd=os.path.dirname(manage))
+
+
+def fail_batch(batch, error):
+    PdfBatch.objects.filter(pk=batch.pk).update(status=u'failed', error=error, finished_on=timezone.now())
+
+
+def run_batch(batch, processes=None):
+    """
+    Render every form in a batch into a zip, spreading the work across processes (None for one per CPU, and 1 to
+    render in this process), and record progress and the result on the batch
+    """
+    PdfBatch.objects.filter(pk=batch.pk).update(status=u'running', done=0)
+    root = settings.CAPS_PDF_ROOT
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    archive = u'caps-forms-{0}.zip'.format(batch.pk)
+    workspace = tempfile.mkdtemp(prefix='caps-pdf-')
+    ids = batch.get_form_ids()
+    chunks = [(ids[start:start + CHUNK_SIZE], workspace) for start in range(0, len(ids), CHUNK_SIZE)]
+    pool = None
+    try:
+        if processes == 1:
+            results = (render_chunk(chunk) for chunk in chunks)
+        else:
+            # Each process opens its own database connection, rather than sharing this one across the fork
+            connection.close()
+            pool = Pool(processes)
+            results = pool.imap_unordered(render_chunk, chunks)
+        # PDFs are already compressed, so they are stored in the zip as they are
+        with zipfile.ZipFile(os.path.join(root, archive + '.tmp'), 'w', zipfile.ZIP_STORED) as zf:
+            for names in results:
+                for name in names:
+                    zf.write(os.path.join(workspace, name), name)
+                    os.remove(os.path.join(workspace, name))
+                PdfBatch.objects.filter(pk=batch.pk).update(done=F('done') + len(names))
+        os.rename(os.path.join(root, archive + '.tmp'), os.path.join(root, archive))
+        PdfBatch.objects.filter(pk=batch.pk).update(status=u'done', archive=archive, finished_on=timezone.now())
+    except Exception:
+        fail_batch(batch, traceback.format_exc())
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def archive_path(batch):
+    return os.path.join(settings.CAPS_PDF_ROOT, batch.archive)
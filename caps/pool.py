@@ -0,0 +1,271 @@
+"""
+A pool of database connections shared by the threads of a process, for the pooled PostgreSQL backend
+(caps.backends.pooled.postgresql_psycopg2), so that a request takes a connection that is already open rather than
+connecting to the database and closing the connection again afterwards.
+
+A connection is taken with get() and given back with put(), which resets it (e.g. rolls back anything left open) so
+nothing carries over to whoever takes it next. The most recently used idle connection is handed out first, so when
+the pool is busier than it needs to be the extra connections are left idle and are closed after max_idle, down to
+min_size. A connection is closed for good once it is max_lifetime old, so that none lives long enough to hold on to
+memory on the server indefinitely, and one that has been idle for longer than check_interval is checked before it is
+handed out. At most max_size connections are open at once, and get() waits up to timeout for one to be given back,
+raising PoolTimeout if none is.
+
+Each pool counts its connections, checkouts and the time spent waiting for a connection, for sizing it, and stats()
+returns them for every pool in the process.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the settings of a pool
+MIN_SIZE = 0
+MAX_SIZE = 10
+TIMEOUT = 30
+MAX_LIFETIME = 60 * 60
+MAX_IDLE = 10 * 60
+CHECK_INTERVAL = 30
+
+COUNTERS = ('connects', 'closes', 'checkouts', 'waits', 'timeouts', 'failed_checks', 'failed_resets')
+
+# Every pool in the process, by key
+_pools = OrderedDict()
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    """
+    Raised by Pool.get() when no connection was given back in time
+    """
+
+
+class Entry(object):
+    def __init__(self, connection, generation):
+        self.connection = connection
+        self.generation = generation
+        self.created = self.last_used = time.time()
+
+
+class Pool(object):
+    """
+    Up to max_size connections made by connect(). check(connection) raises an exception if the connection can no
+    longer be used, and reset(connection) makes it fit for the next user, raising an exception if it can't.
+    """
+    def __init__(self, connect, check=None, reset=None, min_size=MIN_SIZE, max_size=MAX_SIZE, timeout=TIMEOUT,
+                 max_lifetime=MAX_LIFETIME, max_idle=MAX_IDLE, check_interval=CHECK_INTERVAL):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('A pool needs a max_size of at least 1 and no less than its min_size')
+        self.connect = connect
+        self.check = check
+        self.reset = reset
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.condition = threading.Condition()
+        # Idle connections, most recently used last, and those handed out by id
+        self.idle = []
+        self.in_use = {}
+        # Connections open or being opened
+        self.size = 0
+        # Moved on by close(), so that the connections handed out before then are closed when they are given back
+        self.generation = 0
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def expired(self, entry, now):
+        return entry.generation != self.generation or now - entry.created >= self.max_lifetime
+
+    def discard(self, entry):
+        """
+        Close a connection that is no longer counted in the pool
+        """
+        self.counts['closes'] += 1
+        try:
+            entry.connection.close()
+        except Exception:
+            logger.warning('Error closing a pooled connection', exc_info=True)
+
+    def get(self):
+        """
+        Take a connection, waiting for one to be given back if max_size are already in use
+        """
+        start = time.time()
+        while True:
+            entry, stale, waited = self.take(start)
+            for old in stale:
+                self.discard(old)
+            if waited:
+                self.record_wait(time.time() - start)
+            if entry is None:
+                # Room for a new connection
+                try:
+                    entry = Entry(self.connect(), self.generation)
+                except Exception:
+                    with self.condition:
+                        self.size -= 1
+                        self.condition.notify()
+                    raise
+                with self.condition:
+                    self.counts['connects'] += 1
+            elif self.check is not None and time.time() - entry.last_used >= self.check_interval:
+                try:
+                    self.check(entry.connection)
+                except Exception:
+                    logger.warning('A pooled connection failed its check', exc_info=True)
+                    with self.condition:
+                        self.counts['failed_checks'] += 1
+                        self.size -= 1
+                        self.condition.notify()
+                    self.discard(entry)
+                    continue
+            with self.condition:
+                self.counts['checkouts'] += 1
+                self.in_use[id(entry.connection)] = entry
+            return entry.connection
+
+    def take(self, start):
+        """
+        Take an idle connection, or room for a new one (None), waiting until start + timeout for either. Returns it
+        with the expired connections found on the way, for closing, and whether it had to wait.
+        """
+        stale = []
+        waited = False
+        with self.condition:
+            while True:
+                now = time.time()
+                while self.idle:
+                    entry = self.idle.pop()
+                    if not self.expired(entry, now):
+                        return entry, stale, waited
+                    self.size -= 1
+                    stale.append(entry)
+                if self.size < self.max_size:
+                    self.size += 1
+                    return None, stale, waited
+                remaining = start + self.timeout - now
+                if remaining <= 0:
+                    self.counts['timeouts'] += 1
+                    self.record_wait(now - start)
+                    raise PoolTimeout('No database connection was free after {0} seconds ({1} in use)'.format(
+                        self.timeout, len(self.in_use)))
+                waited = True
+                self.condition.wait(remaining)
+
+    def record_wait(self, seconds):
+        self.counts['waits'] += 1
+        self.wait_seconds += seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def put(self, connection):
+        """
+        Give back a connection taken with get(), resetting it for the next user
+        """
+        with self.condition:
+            entry = self.in_use.pop(id(connection))
+        keep = not self.expired(entry, time.time())
+        if keep and self.reset is not None:
+            try:
+                self.reset(connection)
+            except Exception:
+                logger.warning('A pooled connection could not be reset', exc_info=True)
+                keep = False
+                with self.condition:
+                    self.counts['failed_resets'] += 1
+        idle = []
+        with self.condition:
+            now = time.time()
+            if keep:
+                entry.last_used = now
+                self.idle.append(entry)
+            else:
+                self.size -= 1
+                idle.append(entry)
+            # Close the connections that have been idle for too long, least recently used first, down to min_size
+            while self.idle and self.size > self.min_size and now - self.idle[0].last_used >= self.max_idle:
+                idle.append(self.idle.pop(0))
+                self.size -= 1
+            self.condition.notify()
+        for entry in idle:
+            self.discard(entry)
+
+    def fill(self):
+        """
+        Open connections until there are min_size
+        """
+        while True:
+            with self.condition:
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                entry = Entry(self.connect(), self.generation)
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                raise
+            with self.condition:
+                self.counts['connects'] += 1
+                self.idle.insert(0, entry)
+                self.condition.notify()
+
+    def close(self):
+        """
+        Close the idle connections, and those in use as they are given back
+        """
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.generation += 1
+            self.condition.notify_all()
+        for entry in idle:
+            self.discard(entry)
+
+    def stats(self):
+        with self.condition:
+            result = dict(self.counts)
+            result.update({
+                'size': self.size,
+                'idle': len(self.idle),
+                'in_use': len(self.in_use),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'wait_seconds': round(self.wait_seconds, 4),
+                'max_wait_seconds': round(self.max_wait_seconds, 4),
+            })
+        return result
+
+
+def get_pool(key, create):
+    """
+    The pool for key, calling create() to make it the first time
+    """
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = create()
+        return _pools[key]
+
+
+def close_pool(key):
+    """
+    Close and forget the pool for key, if there is one
+    """
+    with _pools_lock:
+        pool = _pools.pop(key, None)
+    if pool is not None:
+        pool.close()
+
+
+def stats():
+    """
+    The counters of every pool in the process, by key
+    """
+    with _pools_lock:
+        pools = list(_pools.items())
+    return OrderedDict((key, pool.stats()) for key, pool in pools)
@@ -0,0 +1,420 @@
+"""
+Risk profiles: every coded condition in a form's histories (the types of its pregnancy problems, heart diseases and
+medical problems, and of the drugs it used) as one bit of an integer, kept in a RiskProfile per form.
+
+Cohort questions such as "eclampsia and previous cardiac surgery and cocaine use but no cancer" would otherwise need a
+join or subquery per condition across the history tables. With the profiles they are a single scan of a narrow table,
+testing each row with bitwise operations. Conditions are named by history and code, e.g. pregnancy.eclampsia,
+heart.prevcardsurg, medical.cancer and drug.erythroxylum, and combined with &, | and ~ (or parsed from text by
+parse()).
+
+cohort() runs a combination as SQL, returning a queryset of the matching forms that can be filtered further.
+Profiles loads every profile into a NumPy array and evaluates combinations in memory, which is quicker for running
+many queries in turn, and builds the co-occurrence matrix of every pair of conditions. cooccurrence() builds the same
+matrix without NumPy, from a single GROUP BY of the distinct profiles.
+
+The profiles are updated whenever a history entry is saved or deleted or a drug's type changes, and written by the
+importer for the forms it adds. The bits are given out in the order of the TYPE_CHOICES, so changing the choices needs
+the profiles rebuilding with the caps_rebuild_profiles command.
+"""
+import re
+from collections import defaultdict
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models.signals import pre_save, post_save, post_delete
+from caps import validation
+from caps.models import CapsForm, Drug, DrugUse, HeartDisease, MedicalProblem, PregnancyProblem, RiskProfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The histories in a profile, as (prefix of the condition names, model, name of the history, field of the model
+# pointing to the form, lookup of the code, choices of the code)
+HISTORIES = (
+    (u'pregnancy', PregnancyProblem, validation.PREGNANCY, 'form', 'type', PregnancyProblem.TYPE_CHOICES),
+    (u'heart', HeartDisease, validation.HEART, 'form', 'type', HeartDisease.TYPE_CHOICES),
+    (u'medical', MedicalProblem, validation.MEDICAL, 'form', 'type', MedicalProblem.TYPE_CHOICES),
+    (u'drug', DrugUse, validation.DRUGS, 'person', 'drug__type', Drug.TYPE_CHOICES),
+)
+
+# (name, label) of each condition, in order of its bit
+CONDITIONS = [(u'{0}.{1}'.format(history[0], code), label) for history in HISTORIES for code, label in history[5]]
+
+# The bit of each condition, by name
+BITS = dict((name, bit) for bit, (name, label) in enumerate(CONDITIONS))
+
+# The sign bit of a BigIntegerField is left alone, so that every profile is a positive number in any database
+if len(CONDITIONS) > 63:
+    raise ValueError('Too many conditions to fit in a risk profile')
+
+# Rows fetched from the cursor at a time when loading the profiles
+FETCH_SIZE = 10000
+
+# Forms read or written per query, under SQLite's limit on the number of parameters
+CHUNK_SIZE = 500
+
+
+class Condition(object):
+    """
+    A combination of conditions, which a form's profile either matches or not
+    """
+    def __and__(self, other):
+        return All(self, other)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def sql(self, column):
+        """
+        A (where clause, parameters) pair testing the profile in column
+        """
+        raise NotImplementedError
+
+    def array(self, bits):
+        """
+        A boolean NumPy array of which of an array of profiles match
+        """
+        raise NotImplementedError
+
+
+class Has(Condition):
+    """
+    Profiles with any one of the conditions named
+    """
+    def __init__(self, *names):
+        unknown = [name for name in names if name not in BITS]
+        if unknown:
+            raise ValueError(u'Unknown condition {0}'.format(u', '.join(unknown)))
+        self.names = names
+        self.mask = sum(1 << BITS[name] for name in set(names))
+
+    def sql(self, column):
+        return u'({0} & %s) <> 0'.format(column), [self.mask]
+
+    def array(self, bits):
+        return (bits & numpy.uint64(self.mask)) != 0
+
+
+class HasAll(Condition):
+    """
+    Profiles with every one of the conditions named
+    """
+    def __init__(self, *names):
+        self.mask = Has(*names).mask
+
+    def sql(self, column):
+        return u'({0} & %s) = %s'.format(column), [self.mask, self.mask]
+
+    def array(self, bits):
+        mask = numpy.uint64(self.mask)
+        return (bits & mask) == mask
+
+
+def join_sql(clauses, operator):
+    return (u'({0})'.format(operator.join(clause for clause, params in clauses)),
+            [param for clause, params in clauses for param in params])
+
+
+class All(Condition):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def sql(self, column):
+        return join_sql([condition.sql(column) for condition in self.conditions], u' AND ')
+
+    def array(self, bits):
+        result = self.conditions[0].array(bits)
+        for condition in self.conditions[1:]:
+            result &= condition.array(bits)
+        return result
+
+
+class Any(Condition):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def sql(self, column):
+        return join_sql([condition.sql(column) for condition in self.conditions], u' OR ')
+
+    def array(self, bits):
+        result = self.conditions[0].array(bits)
+        for condition in self.conditions[1:]:
+            result |= condition.array(bits)
+        return result
+
+
+class Not(Condition):
+    def __init__(self, condition):
+        self.condition = condition
+
+    def sql(self, column):
+        clause, params = self.condition.sql(column)
+        return u'NOT {0}'.format(clause), params
+
+    def array(self, bits):
+        return ~self.condition.array(bits)
+
+
+TOKEN = re.compile(r'\s*(\(|\)|[\w.]+)')
+
+
+def parse(text):
+    """
+    Parse a combination of conditions written out, e.g. "pregnancy.eclampsia and (heart.prevcardsurg or not
+    medical.cancer)", where not binds tightest and then and. Raises ValueError if it can't be parsed.
+    """
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise ValueError(u'Unable to read "{0}"'.format(text[position:].strip()))
+        tokens.append(match.group(1))
+        position = match.end()
+    tokens.append(None)
+    position = [0]
+
+    def peek():
+        token = tokens[position[0]]
+        return token.lower() if token else token
+
+    def take():
+        token = tokens[position[0]]
+        position[0] += 1
+        return token
+
+    def any_of():
+        conditions = [all_of()]
+        while peek() == u'or':
+            take()
+            conditions.append(all_of())
+        return conditions[0] if len(conditions) == 1 else Any(*conditions)
+
+    def all_of():
+        conditions = [factor()]
+        while peek() == u'and':
+            take()
+            conditions.append(factor())
+        return conditions[0] if len(conditions) == 1 else All(*conditions)
+
+    def factor():
+        token = take()
+        if token is None:
+            raise ValueError(u'Unexpected end of the conditions')
+        if token.lower() == u'not':
+            return Not(factor())
+        if token == u'(':
+            condition = any_of()
+            if take() != u')':
+                raise ValueError(u'Missing )')
+            return condition
+        return Has(token)
+
+    condition = any_of()
+    if peek() is not None:
+        raise ValueError(u'Unexpected "{0}"'.format(tokens[position[0]]))
+    return condition
+
+
+def entry_code(entry, lookup):
+    """
+    The code of a history entry in memory, following the lookup (e.g. drug__type) through its related objects
+    """
+    for name in lookup.split('__'):
+        entry = getattr(entry, name)
+    return entry
+
+
+def profile_bits(entries):
+    """
+    The profile of a form with the given history entries, as (history name, code) pairs
+    """
+    bits = 0
+    for prefix, code in entries:
+        bit = BITS.get(u'{0}.{1}'.format(prefix, code))
+        if bit is not None:
+            bits |= 1 << bit
+    return bits
+
+
+def chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+
+def bulk_create(profiles, using):
+    # SQLite limits the number of parameters in a statement, so keep each INSERT under that limit
+    size = 999 // 2 if connections[using].vendor == 'sqlite' else 1000
+    for start in range(0, len(profiles), size):
+        RiskProfile.objects.using(using).bulk_create(profiles[start:start + size])
+
+
+def update(form_ids, using=DEFAULT_DB_ALIAS):
+    """
+    Recalculate the profiles of the forms from their histories
+    """
+    for chunk in chunks(form_ids):
+        entries = defaultdict(list)
+        for prefix, model, history, form, lookup, choices in HISTORIES:
+            rows = model._default_manager.using(using).filter(**{form + '__in': chunk}).values_list(form, lookup)
+            for form_id, code in rows:
+                entries[form_id].append((prefix, code))
+        for form_id in chunk:
+            bits = profile_bits(entries[form_id])
+            if not RiskProfile.objects.using(using).filter(form_id=form_id).update(bits=bits):
+                # A form saved before the profiles were added
+                if CapsForm.objects.using(using).filter(pk=form_id).exists():
+                    RiskProfile.objects.using(using).create(form_id=form_id, bits=bits)
+
+
+def record_imported(batch, using=DEFAULT_DB_ALIAS):
+    """
+    Write the profiles of new forms saved without the model signals (i.e. by the importer's bulk_create), from the
+    (form, histories) pairs in memory
+    """
+    bulk_create([
+        RiskProfile(form_id=form.pk, bits=profile_bits(
+            (prefix, entry_code(entry, lookup))
+            for prefix, model, history, form_field, lookup, choices in HISTORIES for entry in histories[history]))
+        for form, histories in batch
+    ], using)
+
+
+def rebuild(using=DEFAULT_DB_ALIAS):
+    """
+    Recalculate every profile from the history tables, reading each of them once. Returns the number of forms.
+    """
+    entries = defaultdict(list)
+    for prefix, model, history, form, lookup, choices in HISTORIES:
+        for form_id, code in model._default_manager.using(using).values_list(form, lookup).iterator():
+            entries[form_id].append((prefix, code))
+    RiskProfile.objects.using(using).all().delete()
+    form_ids = list(CapsForm.objects.using(using).order_by('pk').values_list('pk', flat=True))
+    bulk_create([RiskProfile(form_id=form_id, bits=profile_bits(entries[form_id])) for form_id in form_ids], using)
+    return len(form_ids)
+
+
+def form_saved(sender, instance, created=False, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    if created and not raw:
+        RiskProfile.objects.using(using).create(form_id=instance.pk)
+
+
+def form_deleted(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    # A form's histories are deleted before it, and each of them updates the profile, so it is removed last
+    RiskProfile.objects.using(using).filter(form_id=instance.pk).delete()
+
+
+def history_changed(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    if not raw:
+        update([instance.person_id if sender is DrugUse else instance.form_id], using)
+
+
+def drug_pre_save(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    instance._profiles_type = None
+    if instance.pk and not raw:
+        for old_type in Drug.objects.using(using).filter(pk=instance.pk).values_list('type', flat=True):
+            instance._profiles_type = old_type
+
+
+def drug_post_save(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    # The forms that used a drug whose type has changed have the bit of the new type instead
+    old_type = getattr(instance, '_profiles_type', None)
+    if raw or old_type is None or old_type == instance.type:
+        return
+    update(DrugUse.objects.using(using).filter(drug=instance).values_list('person', flat=True).distinct(), using)
+
+post_save.connect(form_saved, sender=CapsForm, dispatch_uid='caps_profiles_form_save')
+post_delete.connect(form_deleted, sender=CapsForm, dispatch_uid='caps_profiles_form_delete')
+for history in HISTORIES:
+    post_save.connect(history_changed, sender=history[1], dispatch_uid='caps_profiles_history_save')
+    post_delete.connect(history_changed, sender=history[1], dispatch_uid='caps_profiles_history_delete')
+pre_save.connect(drug_pre_save, sender=Drug, dispatch_uid='caps_profiles_drug_pre_save')
+post_save.connect(drug_post_save, sender=Drug, dispatch_uid='caps_profiles_drug_post_save')
+
+
+def cohort(condition, using=DEFAULT_DB_ALIAS):
+    """
+    The forms whose profile matches condition, as a queryset
+    """
+    quote_name = connections[using].ops.quote_name
+    where, params = condition.sql(quote_name('bits'))
+    return CapsForm.objects.using(using).extra(
+        where=[u'{0}.{1} IN (SELECT form_id FROM {2} WHERE {3})'.format(
+            quote_name(CapsForm._meta.db_table), quote_name(CapsForm._meta.pk.column),
+            quote_name(RiskProfile._meta.db_table), where)],
+        params=params)
+
+
+def cooccurrence(using=DEFAULT_DB_ALIAS):
+    """
+    The number of forms with each pair of conditions, as a list of rows in the order of CONDITIONS, with the number of
+    forms with each condition on the diagonal. Worked out from the distinct profiles and how many forms have each,
+    which are far fewer than the forms themselves.
+    """
+    size = len(CONDITIONS)
+    matrix = [[0] * size for i in range(size)]
+    cursor = connections[using].cursor()
+    cursor.execute('SELECT bits, COUNT(*) FROM {0} WHERE bits <> 0 GROUP BY bits'.format(
+        connections[using].ops.quote_name(RiskProfile._meta.db_table)))
+    for bits, count in cursor.fetchall():
+        present = [bit for bit in range(size) if bits >> bit & 1]
+        for first in present:
+            row = matrix[first]
+            for second in present:
+                row[second] += count
+    return matrix
+
+
+class Profiles(object):
+    """
+    Every form's profile loaded into NumPy arrays, for evaluating combinations of conditions in memory. NumPy is an
+    optional dependency, only needed for this.
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS, fetch_size=FETCH_SIZE):
+        if numpy is None:
+            raise ImportError('Loading the risk profiles needs NumPy, see requirements_optional.txt')
+        connection = connections[using]
+        cursor = connection.cursor()
+        cursor.execute('SELECT form_id, bits FROM {0} ORDER BY form_id'.format(
+            connection.ops.quote_name(RiskProfile._meta.db_table)))
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            chunks.append(numpy.array(rows, dtype=numpy.int64))
+        data = numpy.concatenate(chunks) if chunks else numpy.zeros((0, 2), dtype=numpy.int64)
+        self.form_ids = data[:, 0]
+        self.bits = data[:, 1].astype(numpy.uint64)
+
+    def __len__(self):
+        return len(self.form_ids)
+
+    def matches(self, condition):
+        """
+        The ids of the forms whose profile matches condition
+        """
+        return self.form_ids[condition.array(self.bits)]
+
+    def count(self, condition):
+        return int(numpy.count_nonzero(condition.array(self.bits)))
+
+    def cooccurrence(self, chunk_size=50000):
+        """
+        The number of forms with each pair of conditions, as for cooccurrence(), as a NumPy array. Each chunk of
+        profiles is unpacked into a matrix of 0s and 1s, one column per condition, and multiplied by its transpose.
+        """
+        shifts = numpy.arange(len(CONDITIONS), dtype=numpy.uint64)
+        matrix = numpy.zeros((len(CONDITIONS), len(CONDITIONS)), dtype=numpy.int64)
+        for start in range(0, len(self.bits), chunk_size):
+            chunk = self.bits[start:start + chunk_size]
+            chunk = chunk[chunk != 0]
+            unpacked = ((chunk[:, numpy.newaxis] >> shifts) & numpy.uint64(1)).astype(numpy.int64)
+            matrix += numpy.dot(unpacked.T, unpacked)
+        return matrix
@@ -0,0 +1,204 @@
+"""
+Data quality report over the numeric measurements on every CapsForm.
+
+The model validators only catch values that are impossible (e.g. a height under 90cm). This looks for values that are
+possible but unusual compared with the rest of the study, using robust z-scores (based on the median and the median
+absolute deviation, so a handful of bad values can't hide themselves by shifting the mean), compares each reporter's
+entries with everyone else's, and reports how often optional answers are missing where they would be expected.
+
+The columns are read straight from a database cursor into NumPy arrays, a chunk at a time, without creating model
+instances, and everything after that is done on whole arrays at once. NumPy is an optional dependency, only needed
+for this report.
+"""
+from django.db import connections, DEFAULT_DB_ALIAS
+from caps.models import CapsForm
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Robust z-scores larger than this are reported as outliers (the cut off suggested by Iglewicz and Hoaglin)
+OUTLIER_Z = 3.5
+
+# Used in place of the MAD when that is zero: 1.2533 times the mean absolute deviation estimates the standard deviation
+# of normally distributed values, as MAD / 0.6745 does, so the z-scores are on the same scale
+MEAN_AD_SCALE = 1.2533
+
+# Number of rows fetched from the cursor at a time
+FETCH_SIZE = 10000
+
+# Maximum number of individual outliers listed in the report for each measure
+OUTLIER_LIMIT = 50
+
+# The columns loaded, as (name, SQL expression, NumPy type). Missing values are loaded as NaN (or -1 for the
+# tri-state previous_pregnancy_problem, which uses it for "Not Applicable").
+COLUMNS = (
+    ('id', 'id', 'i8'),
+    ('created_by', 'created_by_id', 'i8'),
+    ('created_year', None, 'f8'),
+    ('year_of_birth', 'year_of_birth', 'f8'),
+    ('height', 'height', 'f8'),
+    ('weight', 'CAST(weight AS DOUBLE PRECISION)', 'f8'),
+    ('gravidity_24plus', 'gravidity_24plus', 'f8'),
+    ('gravidity_24minus', 'gravidity_24minus', 'f8'),
+    ('employed', 'CASE WHEN employed THEN 1 ELSE 0 END', 'i1'),
+    ('occupation_missing', "CASE WHEN occupation IS NULL OR occupation = '' THEN 1 ELSE 0 END", 'i1'),
+    ('case_reported_missing', "CASE WHEN case_reported IS NULL OR case_reported = '' THEN 1 ELSE 0 END", 'i1'),
+    ('previous_pregnancy_problem',
+     'CASE WHEN previous_pregnancy_problem IS NULL THEN -1 WHEN previous_pregnancy_problem THEN 1 ELSE 0 END', 'i1'),
+    ('cardiac_arrest', 'CASE WHEN cardiac_arrest THEN 1 ELSE 0 END', 'i1'),
+    ('cardiac_arrest_date_missing', 'CASE WHEN cardiac_arrest_date IS NULL THEN 1 ELSE 0 END', 'i1'),
+    ('cardiac_arrest_cause_missing',
+     "CASE WHEN cardiac_arrest_cause IS NULL OR cardiac_arrest_cause = '' THEN 1 ELSE 0 END", 'i1'),
+)
+
+# Measures checked for outliers
+MEASURES = ('height', 'weight', 'bmi', 'age', 'gravidity_24plus', 'gravidity_24minus')
+
+
+def created_year_sql(connection):
+    if connection.vendor == 'sqlite':
+        return "CAST(strftime('%%Y', created_on) AS INTEGER)"
+    return 'CAST(EXTRACT(YEAR FROM created_on) AS INTEGER)'
+
+
+def load(using=DEFAULT_DB_ALIAS, fetch_size=FETCH_SIZE):
+    """
+    Load the columns of every form into a dictionary of NumPy arrays, one per column
+    """
+    if numpy is None:
+        raise ImportError('The data quality report needs NumPy, see requirements_optional.txt')
+    connection = connections[using]
+    expressions = [sql or created_year_sql(connection) for name, sql, dtype in COLUMNS]
+    dtype = numpy.dtype([(str(name), dtype) for name, sql, dtype in COLUMNS])
+    cursor = connection.cursor()
+    cursor.execute('SELECT {0} FROM {1} ORDER BY id'.format(
+        ', '.join(expressions), connection.ops.quote_name(CapsForm._meta.db_table)
+    ))
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        # None only turns into NaN for the float columns, so map it there and leave the flags as they are
+        chunks.append(numpy.array(
+            [tuple(numpy.nan if value is None else value for value in row) for row in rows], dtype=dtype
+        ))
+    if chunks:
+        data = numpy.concatenate(chunks)
+    else:
+        data = numpy.zeros(0, dtype=dtype)
+    return dict((name, data[name]) for name in data.dtype.names)
+
+
+def robust_z(values):
+    """
+    Robust z-score of each value, 0.6745 * (value - median) / MAD. Missing values (NaN) give NaN. When the MAD is zero
+    (more than half the values the same, e.g. the gravidities, where most women have none) it is
+    (value - median) / (1.2533 * mean absolute deviation) instead, and zero for every value if they are all the same.
+    """
+    present = values[~numpy.isnan(values)]
+    z = numpy.empty_like(values)
+    z.fill(numpy.nan)
+    if not len(present):
+        return z
+    median = numpy.median(present)
+    mad = numpy.median(numpy.abs(present - median))
+    deviation = values - median
+    if mad:
+        return 0.6745 * deviation / mad
+    mean_ad = numpy.mean(numpy.abs(present - median))
+    if mean_ad:
+        return deviation / (MEAN_AD_SCALE * mean_ad)
+    return numpy.where(numpy.isnan(values), numpy.nan, 0.0)
+
+
+def finite_or_none(value):
+    # JSON has no NaN or infinity
+    return float(value) if numpy.isfinite(value) else None
+
+
+def rate(flags, mask=None):
+    """
+    Share of the (masked) rows where flags is set, or None if there are no rows to take a share of
+    """
+    if mask is not None:
+        flags = flags[mask]
+    if not len(flags):
+        return None
+    return float(numpy.mean(flags))
+
+
+def report(data=None, using=DEFAULT_DB_ALIAS):
+    """
+    Build the data quality report as a dictionary of plain Python values, suitable for printing or dumping to JSON
+    """
+    if data is None:
+        data = load(using)
+    forms = len(data['id'])
+    metres = data['height'] / 100
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        data['bmi'] = data['weight'] / (metres * metres)
+    data['age'] = data['created_year'] - data['year_of_birth']
+
+    result = {'forms': forms, 'measures': {}, 'missing': {}, 'reporters': []}
+    scores = {}
+    for measure in MEASURES:
+        values = data[measure]
+        z = robust_z(values)
+        scores[measure] = z
+        present = values[~numpy.isnan(values)]
+        outliers = numpy.abs(z) > OUTLIER_Z
+        order = numpy.argsort(-numpy.abs(numpy.where(outliers, z, 0)))[:min(int(outliers.sum()), OUTLIER_LIMIT)]
+        result['measures'][measure] = {
+            'count': int(len(present)),
+            'median': float(numpy.median(present)) if len(present) else None,
+            'p05': float(numpy.percentile(present, 5)) if len(present) else None,
+            'p95': float(numpy.percentile(present, 95)) if len(present) else None,
+            'outliers': int(outliers.sum()),
+            'worst': [{'id': int(data['id'][i]), 'value': finite_or_none(values[i]), 'z': finite_or_none(z[i])}
+                      for i in order],
+        }
+
+    # Answers that were left out where they would be expected, compared with how often "Not Applicable" was chosen
+    had_pregnancies = (data['gravidity_24plus'] + data['gravidity_24minus']) > 0
+    not_applicable = data['previous_pregnancy_problem'] == -1
+    result['missing'] = {
+        'occupation_when_employed': rate(data['occupation_missing'], data['employed'] == 1),
+        'case_reported': rate(data['case_reported_missing']),
+        'cardiac_arrest_date_when_arrest': rate(data['cardiac_arrest_date_missing'], data['cardiac_arrest'] == 1),
+        'cardiac_arrest_cause_when_arrest': rate(data['cardiac_arrest_cause_missing'], data['cardiac_arrest'] == 1),
+        'pregnancy_problem_not_applicable': rate(not_applicable),
+        'pregnancy_problem_not_applicable_after_pregnancies': rate(not_applicable, had_pregnancies),
+    }
+
+    # Per reporter: how many forms, how far their entries sit from everyone else's on average, and how often their
+    # entries are outliers or have expected answers missing. Grouping is done with bincount over the reporter index.
+    if forms:
+        reporters, group = numpy.unique(data['created_by'], return_inverse=True)
+        counts = numpy.bincount(group, minlength=len(reporters)).astype('f8')
+        any_outlier = numpy.zeros(forms, dtype=bool)
+        mean_z = {}
+        for measure in MEASURES:
+            z = scores[measure]
+            finite = numpy.isfinite(z)
+            any_outlier |= finite & (numpy.abs(z) > OUTLIER_Z)
+            n = numpy.bincount(group, weights=finite, minlength=len(reporters))
+            total = numpy.bincount(group, weights=numpy.where(finite, z, 0), minlength=len(reporters))
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                mean_z[measure] = total / n
+        missing = (data['employed'] == 1) & (data['occupation_missing'] == 1)
+        missing |= (data['cardiac_arrest'] == 1) & (data['cardiac_arrest_date_missing'] == 1)
+        missing |= had_pregnancies & not_applicable
+        outlier_rate = numpy.bincount(group, weights=any_outlier, minlength=len(reporters)) / counts
+        missing_rate = numpy.bincount(group, weights=missing, minlength=len(reporters)) / counts
+        for i in numpy.argsort(-outlier_rate):
+            result['reporters'].append({
+                'created_by': int(reporters[i]),
+                'forms': int(counts[i]),
+                'outlier_rate': float(outlier_rate[i]),
+                'missing_rate': float(missing_rate[i]),
+                'mean_z': dict((measure, finite_or_none(mean_z[measure][i])) for measure in MEASURES),
+            })
+    return result
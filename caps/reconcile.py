@@ -0,0 +1,181 @@
+"""
+Consistency sweep of the summary flags on CapsForm against the histories.
+
+The validation rules correct some of the answers on a form from the rest of it: entering a history means its flag
+(previous_pregnancy_problem, heart_disease, previous_medical_problem or drug_use) must be True, and a date of the last
+cardiac arrest means cardiac_arrest must be True (see caps/validation.py). Forms changed without the rules (in the
+shell, directly in the database, or a history added on its own) can disagree with them, and sweep() puts them right.
+
+Each rule is fixed by a single UPDATE ... WHERE EXISTS over a range of form ids rather than by loading the forms, and
+each range is committed by itself, so the rows are only locked for as long as one range takes. The forms fixed have
+their version moved on, so that anyone editing one at the time is told, and their modification time brought forward
+for the API; a FieldChange row for each is written by an INSERT ... SELECT beforehand, so the fixes are in the audit
+trail. A flag that is True without any history is an error for the person completing the form rather than something
+that can be corrected, so those are only counted (see unanswered()).
+"""
+from collections import namedtuple
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Max, Min
+from django.utils import timezone
+from caps import audit, cache
+from caps.models import CapsForm, DrugUse, FieldChange, HeartDisease, MedicalProblem, PregnancyProblem
+
+# Form ids covered by each UPDATE
+CHUNK_SIZE = 5000
+
+# Each flag corrected from a history, with the model of the history
+HISTORY_FLAGS = (
+    ('previous_pregnancy_problem', PregnancyProblem),
+    ('heart_disease', HeartDisease),
+    ('previous_medical_problem', MedicalProblem),
+    ('drug_use', DrugUse),
+)
+
+Mismatch = namedtuple('Mismatch', 'pk case_id flag old_value')
+
+
+class Rule(object):
+    """
+    A flag that must be True for the forms matching a condition. where() gives the condition on the form table for
+    the forms breaking it, as SQL with its parameters.
+    """
+    def __init__(self, flag):
+        self.flag = flag
+
+    def where(self, quote_name, table):
+        raise NotImplementedError
+
+
+class HistoryRule(Rule):
+    """
+    The flag must be True for a form with any entries in the history
+    """
+    def __init__(self, flag, model):
+        super(HistoryRule, self).__init__(flag)
+        self.model = model
+
+    def exists(self, quote_name, table):
+        foreign_key = [field for field in self.model._meta.fields if getattr(field.rel, 'to', None) is CapsForm][0]
+        return u'EXISTS (SELECT 1 FROM {0} WHERE {0}.{1} = {2}.{3})'.format(
+            quote_name(self.model._meta.db_table), quote_name(foreign_key.column), table,
+            quote_name(CapsForm._meta.pk.column))
+
+    def where(self, quote_name, table):
+        return (u'({0} IS NULL OR {0} = %s) AND {1}'.format(quote_name(self.flag), self.exists(quote_name, table)),
+                [False])
+
+
+class DateRule(Rule):
+    """
+    The flag must be True for a form with a date in another field
+    """
+    def __init__(self, flag, date_field):
+        super(DateRule, self).__init__(flag)
+        self.date_field = date_field
+
+    def where(self, quote_name, table):
+        return u'{0} = %s AND {1} IS NOT NULL'.format(quote_name(self.flag), quote_name(self.date_field)), [False]
+
+
+RULES = ([HistoryRule(flag, model) for flag, model in HISTORY_FLAGS] +
+         [DateRule('cardiac_arrest', 'cardiac_arrest_date')])
+
+
+def id_ranges(chunk_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS):
+    """
+    The ranges of form ids to sweep, as [start, end) pairs
+    """
+    bounds = CapsForm.objects.using(using).aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return
+    for start in range(bounds['first'], bounds['last'] + 1, chunk_size):
+        yield start, start + chunk_size
+
+
+def breaking(rule, start, end, using):
+    """
+    The where clause and parameters for the forms with ids in [start, end) that break rule
+    """
+    quote_name = connections[using].ops.quote_name
+    table = quote_name(CapsForm._meta.db_table)
+    where, params = rule.where(quote_name, table)
+    return (u'{0}.{1} >= %s AND {0}.{1} < %s AND {2}'.format(table, quote_name(CapsForm._meta.pk.column), where),
+            [start, end] + params)
+
+
+def mismatches(start, end, using=DEFAULT_DB_ALIAS):
+    """
+    The forms with ids in [start, end) that break a rule, as Mismatch tuples in order of id and then rule, without
+    changing anything
+    """
+    found = []
+    for rule in RULES:
+        where, params = breaking(rule, start, end, using)
+        rows = CapsForm.objects.using(using).extra(where=[where], params=params).values_list('pk', 'case_id', rule.flag)
+        found.extend(Mismatch(pk, case_id, rule.flag, value) for pk, case_id, value in rows)
+    found.sort(key=lambda mismatch: (mismatch.pk, mismatch.flag))
+    return found
+
+
+def fix(start, end, using=DEFAULT_DB_ALIAS):
+    """
+    Correct the forms with ids in [start, end) that break a rule, in a single transaction. Returns the number of forms
+    fixed by each flag.
+    """
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    table = quote_name(CapsForm._meta.db_table)
+    pk = quote_name(CapsForm._meta.pk.column)
+    now = timezone.now()
+    fixed = {}
+    with transaction.commit_on_success(using=using):
+        cursor = connection.cursor()
+        for rule in RULES:
+            where, params = breaking(rule, start, end, using)
+            flag = quote_name(rule.flag)
+            cursor.execute(
+                u'INSERT INTO {0} (form_id, model, object_id, field, action, old_value, new_value, changed_by_id, '
+                u'changed_on) SELECT {1}, %s, {1}, %s, %s, CASE WHEN {2} IS NULL THEN NULL ELSE %s END, %s, NULL, %s '
+                u'FROM {3} WHERE {4}'.format(quote_name(FieldChange._meta.db_table), pk, flag, table, where),
+                [u'capsform', rule.flag, audit.CHANGED, audit.serialise(False), audit.serialise(True), now] + params)
+            cursor.execute(
+                u'UPDATE {0} SET {1} = %s, {2} = {2} + 1, {3} = %s WHERE {4}'.format(
+                    table, flag, quote_name('version'), quote_name('modified_on'), where),
+                [True, now] + params)
+            fixed[rule.flag] = cursor.rowcount
+    return fixed
+
+
+def unanswered(using=DEFAULT_DB_ALIAS):
+    """
+    The number of forms with each history flag True but no entries in the history, which can't be corrected
+    """
+    quote_name = connections[using].ops.quote_name
+    table = quote_name(CapsForm._meta.db_table)
+    counts = {}
+    for rule in RULES:
+        if isinstance(rule, HistoryRule):
+            counts[rule.flag] = CapsForm.objects.using(using).filter(**{rule.flag: True}).extra(
+                where=[u'NOT ' + rule.exists(quote_name, table)]).count()
+    return counts
+
+
+def sweep(dry_run=False, chunk_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS, found=None):
+    """
+    Check every form against the rules a range of ids at a time, fixing those that break them unless dry_run, when
+    found (if given) is called with each Mismatch instead. Returns the number of forms breaking each rule, by flag.
+    """
+    counts = dict((rule.flag, 0) for rule in RULES)
+    for start, end in id_ranges(chunk_size, using):
+        if dry_run:
+            for mismatch in mismatches(start, end, using):
+                counts[mismatch.flag] += 1
+                if found is not None:
+                    found(mismatch)
+        else:
+            for flag, count in fix(start, end, using).items():
+                counts[flag] += count
+    if not dry_run and any(counts.values()):
+        # The forms were changed without the model signals, so drop the cached values built from them
+        cache.invalidate_forms()
+    return counts
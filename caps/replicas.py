@@ -0,0 +1,199 @@
+"""
+Read replicas: sending the read-only workloads (the exports, the summary, the API and the forms list) to copies of the
+database kept up to date by replication, so that they don't compete with data entry on the primary.
+
+The replicas are the aliases in DATABASES listed by CAPS_REPLICAS. ReplicaRouter sends the reads made inside
+use_replica() to one of them, chosen at random and kept for the rest of the block so that its reads agree with each
+other. Everything else, including every write, goes to the primary ('default'), so code only reads from a replica
+where it has asked to.
+
+Replication runs behind the primary, so someone who has just saved a form must not be shown it as it was before. Any
+write pins the rest of the request (or thread) to the primary, and ReplicaMiddleware keeps the following requests of
+whoever made it on the primary for CAPS_REPLICA_STICKY_SECONDS with a cookie, e.g. the forms list they are sent back
+to after saving. The sticky window needs to be longer than the replicas usually lag.
+
+Each replica is checked with a trivial query before it is used, at most once every CAPS_REPLICA_CHECK_SECONDS in each
+process. One that fails is left out until it passes again, and with none left the reads go to the primary.
+"""
+import random
+import threading
+import time
+from functools import wraps
+from django.conf import settings
+
+DEFAULT_STICKY_SECONDS = 10
+DEFAULT_CHECK_SECONDS = 30
+
+# Alias of the primary, as django.db.DEFAULT_DB_ALIAS. This module is imported while django.db sets up the routers,
+# so it can't import anything from there until it is used.
+PRIMARY = 'default'
+
+# Cookie keeping a browser on the primary after it has made a change
+COOKIE_NAME = 'caps_primary'
+
+_local = threading.local()
+
+# alias -> (whether it answered, time of the check), shared by the threads of a process
+_health = {}
+
+
+def replica_aliases():
+    return list(getattr(settings, 'CAPS_REPLICAS', ()))
+
+
+def check(alias):
+    """
+    Whether the replica answers a trivial query
+    """
+    from django.db import connections
+    connection = connections[alias]
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+        return True
+    except Exception:
+        # Drop the broken connection, so the next check connects again
+        try:
+            connection.close()
+        except Exception:
+            pass
+        return False
+
+
+def healthy(alias):
+    """
+    Whether the replica passed its last check, checking it again if that was more than CAPS_REPLICA_CHECK_SECONDS ago
+    """
+    now = time.time()
+    state = _health.get(alias)
+    if state is None or now - state[1] >= getattr(settings, 'CAPS_REPLICA_CHECK_SECONDS', DEFAULT_CHECK_SECONDS):
+        state = _health[alias] = (check(alias), now)
+    return state[0]
+
+
+def reset_health():
+    _health.clear()
+
+
+def pin():
+    """
+    Keep the reads of this thread on the primary, and whoever made the request on it for the sticky window
+    """
+    _local.pinned = True
+    _local.wrote = True
+
+
+def is_pinned():
+    return getattr(_local, 'pinned', False)
+
+
+def choose_replica():
+    """
+    The replica for the reads of the current use_replica() block, or None to read from the primary
+    """
+    if not getattr(_local, 'depth', 0) or getattr(_local, 'primary', 0) or is_pinned():
+        return None
+    alias = getattr(_local, 'replica', None)
+    if alias is None or not healthy(alias):
+        aliases = [alias for alias in replica_aliases() if healthy(alias)]
+        alias = _local.replica = random.choice(aliases) if aliases else None
+    return alias
+
+
+class Scope(object):
+    """
+    A block of code reading from a replica or the primary, as a context manager or a decorator
+    """
+    attribute = None
+
+    def __enter__(self):
+        setattr(_local, self.attribute, getattr(_local, self.attribute, 0) + 1)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        setattr(_local, self.attribute, getattr(_local, self.attribute, 1) - 1)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapped
+
+
+class use_replica(Scope):
+    """
+    Send the reads made inside it to a replica, unless the thread is pinned to the primary
+    """
+    attribute = 'depth'
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(use_replica, self).__exit__(exc_type, exc_value, traceback)
+        if not _local.depth:
+            # The next block may choose another
+            _local.replica = None
+
+
+class use_primary(Scope):
+    """
+    Send the reads made inside it to the primary, even inside use_replica()
+    """
+    attribute = 'primary'
+
+
+def iterate_on_replica(iterable):
+    """
+    Iterate inside use_replica(), for a streamed response whose rows are read after the view has returned
+    """
+    with use_replica():
+        for item in iterable:
+            yield item
+
+
+class ReplicaRouter(object):
+    """
+    Database router sending the reads inside use_replica() to a replica, and everything else to the primary
+    """
+    def db_for_read(self, model, **hints):
+        alias = choose_replica()
+        if alias is not None:
+            return alias
+        # An instance read from a replica goes back to the primary for its related objects outside the block
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in replica_aliases():
+            return PRIMARY
+        return None
+
+    def db_for_write(self, model, **hints):
+        if not replica_aliases():
+            return None
+        pin()
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = [PRIMARY] + replica_aliases()
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        # The replicas get their tables from the primary
+        if db in replica_aliases():
+            return False
+        return None
+
+
+class ReplicaMiddleware(object):
+    """
+    Keeps a browser on the primary for CAPS_REPLICA_STICKY_SECONDS after a request of theirs has written to it. The
+    thread stays pinned until the next request starts, as a streamed response is read after this has finished.
+    """
+    def process_request(self, request):
+        _local.pinned = COOKIE_NAME in request.COOKIES
+        _local.wrote = False
+
+    def process_response(self, request, response):
+        if getattr(_local, 'wrote', False):
+            response.set_cookie(COOKIE_NAME, '1', max_age=getattr(settings, 'CAPS_REPLICA_STICKY_SECONDS',
+                                                                   DEFAULT_STICKY_SECONDS), httponly=True)
+        return response
@@ -0,0 +1,230 @@
+"""
+Full-text search over the free text of the forms: the case ID, where the case was reported, the occupation and cause
+of cardiac arrest, and the details given with the pregnancy problems, heart diseases and medical problems.
+
+The text of each form and its histories is kept in a SearchDocument, rewritten whenever the form or one of its
+histories is saved or deleted (and by the importer for the forms it adds), so the index is always up to date without
+ever being rebuilt. On PostgreSQL a trigger turns the text into a tsvector, and searches are answered by the built in
+full-text search with its stemming (e.g. "infections" matches "infection") and ts_rank ranking. Elsewhere, e.g. SQLite
+for local testing, each document's words are kept in an inverted index of SearchTerm rows, and searches find every
+word given, ranked by tf-idf. In both cases a form matches if its text has all of the words searched for.
+
+search() returns the best matches ranked, and matching() narrows a queryset of forms, which is how the CapsForm
+changelist answers its search box (see KeysetChangeList). The caps_search_index command builds the index for forms
+saved before it existed.
+"""
+import math
+import re
+from collections import defaultdict
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+from caps import validation
+from caps.models import CapsForm, HeartDisease, MedicalProblem, PregnancyProblem, SearchDocument, SearchTerm
+
+# Fields of the form itself that are searched
+FORM_FIELDS = ('case_id', 'case_reported', 'occupation', 'cardiac_arrest_cause')
+
+# The histories whose details are searched, by name
+HISTORIES = (
+    (validation.PREGNANCY, PregnancyProblem),
+    (validation.HEART, HeartDisease),
+    (validation.MEDICAL, MedicalProblem),
+)
+
+# PostgreSQL text search configuration, which must match the trigger in caps/sql/searchdocument.postgresql_psycopg2.sql
+CONFIG = 'english'
+
+# Most results returned by search()
+SEARCH_LIMIT = 100
+
+# Forms read or written per query, under SQLite's limit on the number of parameters
+CHUNK_SIZE = 500
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Words too common to be worth indexing by themselves, for the inverted index
+STOP_WORDS = frozenset([u'a', u'an', u'and', u'are', u'as', u'at', u'be', u'by', u'for', u'from', u'in', u'is', u'it',
+                        u'of', u'on', u'or', u'the', u'to', u'was', u'were', u'with'])
+
+
+def uses_postgres(using):
+    return connections[using].vendor == 'postgresql'
+
+
+def words(text):
+    """
+    The words of text as indexed, lower cased and without the stop words
+    """
+    return [word[:50] for word in WORD.findall(text.lower()) if word not in STOP_WORDS]
+
+
+def chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+
+def join(parts):
+    return u'\n'.join(part for part in parts if part)
+
+
+def documents(form_ids, using=DEFAULT_DB_ALIAS):
+    """
+    The text of each of the forms by id, leaving out any that no longer exist
+    """
+    parts = {}
+    for chunk in chunks(form_ids):
+        for row in CapsForm.objects.using(using).filter(pk__in=chunk).values_list('pk', *FORM_FIELDS):
+            parts[row[0]] = list(row[1:])
+        for name, model in HISTORIES:
+            entries = model._default_manager.using(using).filter(form__in=chunk).order_by('pk')
+            for form_id, details in entries.values_list('form', 'details'):
+                if form_id in parts:
+                    parts[form_id].append(details)
+    return dict((pk, join(values)) for pk, values in parts.items())
+
+
+def bulk_create(model, objs, using):
+    # SQLite limits the number of parameters in a statement, so keep each INSERT under that limit
+    size = max(1, 999 // len(model._meta.local_fields)) if connections[using].vendor == 'sqlite' else 1000
+    for start in range(0, len(objs), size):
+        model._default_manager.using(using).bulk_create(objs[start:start + size])
+
+
+def write(texts, using=DEFAULT_DB_ALIAS, new=False):
+    """
+    Index the text of each of the forms, given as a dictionary by id. A form whose text is None is removed from the
+    index. If the forms are new there is nothing to replace.
+    """
+    postgres = uses_postgres(using)
+    if not new:
+        for chunk in chunks(texts):
+            SearchDocument.objects.using(using).filter(form_id__in=chunk).delete()
+            if not postgres:
+                SearchTerm.objects.using(using).filter(form_id__in=chunk).delete()
+    texts = dict((pk, text) for pk, text in texts.items() if text)
+    bulk_create(SearchDocument, [SearchDocument(form_id=pk, text=text) for pk, text in texts.items()], using)
+    if not postgres:
+        terms = []
+        for pk, text in texts.items():
+            counts = defaultdict(int)
+            for word in words(text):
+                counts[word] += 1
+            terms.extend(SearchTerm(term=word, form_id=pk, count=count) for word, count in counts.items())
+        bulk_create(SearchTerm, terms, using)
+
+
+def update(form_ids, using=DEFAULT_DB_ALIAS):
+    """
+    Bring the index up to date for the forms, reading their text from the database
+    """
+    texts = documents(form_ids, using)
+    write(dict((pk, texts.get(pk)) for pk in form_ids), using)
+
+
+def index_imported(batch, using=DEFAULT_DB_ALIAS):
+    """
+    Index new forms saved without the model signals (i.e. by the importer's bulk_create), from the (form, histories)
+    pairs in memory
+    """
+    texts = {}
+    for form, histories in batch:
+        texts[form.pk] = join([getattr(form, name) for name in FORM_FIELDS] +
+                              [entry.details for name, model in HISTORIES for entry in histories[name]])
+    write(texts, using, new=True)
+
+
+def rebuild(using=DEFAULT_DB_ALIAS):
+    """
+    Index every form from scratch, a chunk at a time. Returns the number of forms indexed.
+    """
+    SearchDocument.objects.using(using).all().delete()
+    SearchTerm.objects.using(using).all().delete()
+    count = 0
+    last_pk = 0
+    while True:
+        form_ids = list(CapsForm.objects.using(using).filter(pk__gt=last_pk).order_by('pk')
+                        .values_list('pk', flat=True)[:CHUNK_SIZE])
+        if not form_ids:
+            return count
+        write(documents(form_ids, using), using, new=True)
+        count += len(form_ids)
+        last_pk = form_ids[-1]
+
+
+def form_saved(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    if not raw:
+        update([instance.pk if sender is CapsForm else instance.form_id], using)
+
+
+def form_deleted(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    # A form's histories are deleted before it, and each of them updates the index, so the form is removed from it last
+    write({instance.pk: None}, using)
+
+post_save.connect(form_saved, sender=CapsForm, dispatch_uid='caps_search_form_save')
+post_delete.connect(form_deleted, sender=CapsForm, dispatch_uid='caps_search_form_delete')
+for name, model in HISTORIES:
+    post_save.connect(form_saved, sender=model, dispatch_uid='caps_search_history_save')
+    post_delete.connect(form_saved, sender=model, dispatch_uid='caps_search_history_delete')
+
+
+def ranked_postgres(text, limit, using):
+    connection = connections[using]
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT form_id, ts_rank(vector, query) AS rank FROM {0}, plainto_tsquery(%s, %s) query '
+        'WHERE vector @@ query ORDER BY rank DESC, form_id LIMIT %s'.format(
+            connection.ops.quote_name(SearchDocument._meta.db_table)),
+        [CONFIG, text, limit])
+    return [(form_id, float(rank)) for form_id, rank in cursor.fetchall()]
+
+
+def ranked_terms(text, limit, using):
+    terms = set(words(text))
+    if not terms:
+        return []
+    found = defaultdict(dict)
+    frequency = defaultdict(int)
+    for term, form_id, count in SearchTerm.objects.using(using).filter(term__in=terms).values_list(
+            'term', 'form_id', 'count'):
+        found[form_id][term] = count
+        frequency[term] += 1
+    total = SearchDocument.objects.using(using).count()
+    scores = [(sum(count * math.log(1.0 + float(total) / frequency[term]) for term, count in counts.items()), form_id)
+              for form_id, counts in found.items() if len(counts) == len(terms)]
+    scores.sort(key=lambda score: (-score[0], score[1]))
+    return [(form_id, round(score, 4)) for score, form_id in scores[:limit]]
+
+
+def search(text, limit=SEARCH_LIMIT, using=DEFAULT_DB_ALIAS):
+    """
+    The forms whose text has every word of text, best match first, as a list of (id, case ID, rank)
+    """
+    if uses_postgres(using):
+        ranked = ranked_postgres(text, limit, using)
+    else:
+        ranked = ranked_terms(text, limit, using)
+    case_ids = dict(CapsForm.objects.using(using).filter(pk__in=[pk for pk, rank in ranked])
+                    .values_list('pk', 'case_id'))
+    return [(pk, case_ids[pk], rank) for pk, rank in ranked if pk in case_ids]
+
+
+def matching(queryset, text):
+    """
+    Narrow a queryset of forms to those whose text has every word of text, with a subquery of the index, so any number
+    of forms can match
+    """
+    using = queryset.db
+    if uses_postgres(using):
+        quote_name = connections[using].ops.quote_name
+        return queryset.extra(
+            where=['{0}.{1} IN (SELECT form_id FROM {2} WHERE vector @@ plainto_tsquery(%s, %s))'.format(
+                quote_name(CapsForm._meta.db_table), quote_name(CapsForm._meta.pk.column),
+                quote_name(SearchDocument._meta.db_table))],
+            params=[CONFIG, text])
+    terms = set(words(text))
+    if not terms:
+        return queryset.none()
+    for term in terms:
+        queryset = queryset.filter(pk__in=SearchTerm.objects.using(using).filter(term=term).values('form_id'))
+    return queryset
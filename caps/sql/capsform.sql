@@ -0,0 +1,11 @@
+-- Composite indexes for the CapsFormAdmin changelist. The admin always orders newest first by (created_on, id), so
+-- each list_filter column leads an index that ends in the ordering columns. A filtered page can then be read straight
+-- from the index in order, and the keyset paginator's seek condition is answered from the same index.
+CREATE INDEX caps_capsform_created_on_id ON caps_capsform (created_on, id);
+CREATE INDEX caps_capsform_created_by_created_on ON caps_capsform (created_by_id, created_on, id);
+CREATE INDEX caps_capsform_smoking_created_on ON caps_capsform (smoking, created_on, id);
+CREATE INDEX caps_capsform_prev_preg_created_on ON caps_capsform (previous_pregnancy_problem, created_on, id);
+CREATE INDEX caps_capsform_heart_disease_created_on ON caps_capsform (heart_disease, created_on, id);
+CREATE INDEX caps_capsform_cardiac_arrest_created_on ON caps_capsform (cardiac_arrest, created_on, id);
+CREATE INDEX caps_capsform_drug_use_created_on ON caps_capsform (drug_use, created_on, id);
+CREATE INDEX caps_capsform_prev_med_created_on ON caps_capsform (previous_medical_problem, created_on, id);
@@ -0,0 +1,6 @@
+-- DrugAdmin.search_fields runs "name__icontains" and "alternative_names__icontains", which Django turns into
+-- UPPER("caps_drug"."name"::text) LIKE UPPER('%term%'). A leading wildcard can't use a btree index, so index the
+-- upper cased values with trigrams instead, which lets PostgreSQL answer the LIKE from the index.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX caps_drug_name_upper_trgm ON caps_drug USING gin (UPPER(name::text) gin_trgm_ops);
+CREATE INDEX caps_drug_alternative_names_upper_trgm ON caps_drug USING gin (UPPER(alternative_names::text) gin_trgm_ops);
@@ -0,0 +1,4 @@
+-- The audit trail is read a form at a time (its history, or the changes since a date to rebuild it as it was then) and
+-- a user at a time over a range of dates, so each is a range scan of one of these.
+CREATE INDEX caps_fieldchange_form_id_changed_on ON caps_fieldchange (form_id, changed_on);
+CREATE INDEX caps_fieldchange_changed_by_id_changed_on ON caps_fieldchange (changed_by_id, changed_on);
@@ -0,0 +1,3 @@
+-- The follow-up queue is read by status and due time: the worker looks for waiting follow-ups due before now, earliest
+-- first, so this index answers it with a range scan however many follow-ups have already been sent.
+CREATE INDEX caps_followup_status_due_on ON caps_followup (status, due_on);
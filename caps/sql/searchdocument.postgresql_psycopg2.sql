@@ -0,0 +1,7 @@
+-- On PostgreSQL the search is answered by the built in full-text search. The tsvector of each form's text is kept up
+-- to date by a trigger whenever caps.search writes the text, and a GIN index finds the forms matching a query. The
+-- configuration must match caps.search.CONFIG.
+ALTER TABLE caps_searchdocument ADD COLUMN vector tsvector;
+CREATE INDEX caps_searchdocument_vector ON caps_searchdocument USING gin (vector);
+CREATE TRIGGER caps_searchdocument_vector BEFORE INSERT OR UPDATE ON caps_searchdocument
+    FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(vector, 'pg_catalog.english', text);
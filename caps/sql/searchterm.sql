@@ -0,0 +1,3 @@
+-- A search looks up each of its words in the inverted index, and the forms it finds for each word are read from the
+-- index without visiting the table.
+CREATE INDEX caps_searchterm_term_form_id ON caps_searchterm (term, form_id);
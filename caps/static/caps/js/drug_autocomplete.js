@@ -0,0 +1,80 @@
+/*
+ * Type-ahead for the drug used inline. Each text box with the drug-autocomplete class sits next to the hidden input
+ * holding the drug id, and looks up matching drugs from the URL in its data-url attribute as the user types. Events are
+ * bound to the document so rows added with "Add another" work too.
+ */
+(function($) {
+    var DELAY = 200, timer = null;
+
+    function hideResults(input) {
+        input.siblings('ul.drug-results').remove();
+    }
+
+    function showResults(input, results) {
+        hideResults(input);
+        if (!results.length) {
+            return;
+        }
+        var list = $('<ul class="drug-results"></ul>').css({
+            position: 'absolute', background: '#fff', border: '1px solid #ccc', margin: 0, padding: 0,
+            listStyle: 'none', zIndex: 100, minWidth: input.outerWidth()
+        });
+        $.each(results, function(i, result) {
+            $('<li></li>').text(result.label).data('id', result.id).css({padding: '2px 4px', cursor: 'pointer'})
+                .appendTo(list);
+        });
+        list.insertAfter(input);
+    }
+
+    $(document).delegate('input.drug-autocomplete', 'keyup', function(e) {
+        var input = $(this);
+        if (e.which === 27) {
+            hideResults(input);
+            return;
+        }
+        // Typing over a chosen drug clears the choice until a new one is picked
+        input.prev('input[type=hidden]').val('');
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+            var text = $.trim(input.val());
+            if (!text) {
+                hideResults(input);
+                return;
+            }
+            $.getJSON(input.attr('data-url'), {q: text}, function(data) {
+                if ($.trim(input.val()) === text) {
+                    showResults(input, data.results);
+                }
+            });
+        }, DELAY);
+    });
+
+    $(document).delegate('ul.drug-results li', 'mousedown', function() {
+        var item = $(this), input = item.closest('ul').prev('input.drug-autocomplete');
+        input.val(item.text());
+        input.prev('input[type=hidden]').val(item.data('id'));
+        hideResults(input);
+    });
+
+    $(document).delegate('input.drug-autocomplete', 'focusout', function() {
+        hideResults($(this));
+    });
+
+    // The admin's "add another" popup only sets the hidden input, so show the name of the drug added in the text box
+    // too. Wrapped once the page has loaded, as the admin's script may come after this one.
+    $(function() {
+        var dismiss = window.dismissAddAnotherPopup;
+        if (!dismiss) {
+            return;
+        }
+        window.dismissAddAnotherPopup = function(win, newId, newRepr) {
+            var hidden = $(document.getElementById(windowname_to_id(win.name)));
+            dismiss(win, newId, newRepr);
+            var input = hidden.next('input.drug-autocomplete');
+            if (input.length) {
+                input.val(html_unescape(newRepr));
+                hideResults(input);
+            }
+        };
+    });
+})(django.jQuery);
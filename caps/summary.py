@@ -0,0 +1,272 @@
+"""
+On screen summary of the form data: counts of forms by ethnic group, smoking and marital status, counts of each type
+of history entry, height/weight/BMI distributions and monthly accrual.
+
+The counts are materialised in SummaryCount and updated incrementally from the save and delete signals of the forms
+and their histories, so reading the summary costs one row per bucket however many forms there are. rebuild() (and the
+caps_rebuild_summary command) recalculates everything from scratch, e.g. after changes made directly in the database.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.utils import timezone
+from caps import choices
+from caps.models import CapsForm, Drug, PregnancyProblem, HeartDisease, MedicalProblem, DrugUse, SummaryCount
+
+TOTAL = 'total'
+ETHNIC_GROUP = 'ethnic_group'
+SMOKING = 'smoking'
+MARITAL_STATUS = 'marital_status'
+HEIGHT = 'height'
+WEIGHT = 'weight'
+BMI = 'bmi'
+ACCRUAL = 'accrual'
+DRUG_TYPE = 'drug_type'
+
+# History models and the dimension their entries are counted under, by type
+HISTORY_DIMENSIONS = (
+    (PregnancyProblem, 'pregnancy_problem'),
+    (HeartDisease, 'heart_disease'),
+    (MedicalProblem, 'medical_problem'),
+)
+
+# The CapsForm fields the summary is built from
+FORM_FIELDS = ('ethnic_group', 'smoking', 'marital_status', 'height', 'weight', 'created_on')
+
+# Upper bound (exclusive) and label of each BMI category, based on the WHO classification
+BMI_CATEGORIES = (
+    (Decimal('18.5'), u'Underweight (under 18.5)'),
+    (Decimal('25'), u'Normal (18.5 to 24.9)'),
+    (Decimal('30'), u'Overweight (25 to 29.9)'),
+    (Decimal('35'), u'Obese I (30 to 34.9)'),
+    (Decimal('40'), u'Obese II (35 to 39.9)'),
+    (None, u'Obese III (40 and over)'),
+)
+
+# Width of the height (cm) and weight (kg) distribution buckets
+HEIGHT_STEP = 10
+WEIGHT_STEP = 10
+
+
+def range_bucket(value, step):
+    """
+    Bucket a measurement into a range, e.g. 163 with a step of 10 gives u'160-169'. Buckets are zero padded so that
+    they sort in numeric order.
+    """
+    start = int(value) // step * step
+    return u'{0:03d}-{1:03d}'.format(start, start + step - 1)
+
+
+def bmi(height, weight):
+    """
+    Body mass index from a height in cm and weight in kg
+    """
+    metres = Decimal(height) / 100
+    return Decimal(weight) / (metres * metres)
+
+
+def bmi_bucket(height, weight):
+    value = bmi(height, weight)
+    for limit, label in BMI_CATEGORIES:
+        if limit is None or value < limit:
+            return label
+
+
+def form_buckets(values):
+    """
+    Return the (dimension, bucket) pairs a form is counted under, given a dictionary of its FORM_FIELDS
+    """
+    buckets = [(TOTAL, u'all')]
+    for dimension in (ETHNIC_GROUP, SMOKING, MARITAL_STATUS):
+        if values[dimension] is not None:
+            buckets.append((dimension, unicode(values[dimension])))
+    if values['height']:
+        buckets.append((HEIGHT, range_bucket(values['height'], HEIGHT_STEP)))
+    if values['weight']:
+        buckets.append((WEIGHT, range_bucket(values['weight'], WEIGHT_STEP)))
+    if values['height'] and values['weight']:
+        buckets.append((BMI, bmi_bucket(values['height'], values['weight'])))
+    if values['created_on']:
+        buckets.append((ACCRUAL, timezone.localtime(values['created_on']).strftime('%Y-%m')
+                        if timezone.is_aware(values['created_on']) else values['created_on'].strftime('%Y-%m')))
+    return buckets
+
+
+def history_bucket(entry):
+    """
+    Return the (dimension, bucket) pair a history entry is counted under
+    """
+    if isinstance(entry, DrugUse):
+        return DRUG_TYPE, entry.drug.type
+    for model, dimension in HISTORY_DIMENSIONS:
+        if isinstance(entry, model):
+            return dimension, entry.type
+
+
+def apply(deltas):
+    """
+    Add a dictionary of (dimension, bucket) -> change in count to the stored counts
+    """
+    for (dimension, bucket), delta in deltas.items():
+        if not delta:
+            continue
+        updated = SummaryCount.objects.filter(dimension=dimension, bucket=bucket).update(count=F('count') + delta)
+        if not updated:
+            try:
+                sid = transaction.savepoint()
+                SummaryCount.objects.create(dimension=dimension, bucket=bucket, count=delta)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Someone else created the bucket in the meantime, so add to theirs
+                transaction.savepoint_rollback(sid)
+                SummaryCount.objects.filter(dimension=dimension, bucket=bucket).update(count=F('count') + delta)
+
+
+def record_imported(batch):
+    """
+    Count a batch of (form, histories) pairs saved by the importer, which uses bulk_create and so bypasses the signals
+    """
+    deltas = defaultdict(int)
+    for form, histories in batch:
+        for key in form_buckets(dict((field, getattr(form, field)) for field in FORM_FIELDS)):
+            deltas[key] += 1
+        for entries in histories.values():
+            for entry in entries:
+                deltas[history_bucket(entry)] += 1
+    apply(deltas)
+
+
+def rebuild():
+    """
+    Recalculate every count from the form and history tables
+    """
+    deltas = defaultdict(int)
+    # The forms are read as plain values in chunks, rather than as model instances all at once
+    last_pk = 0
+    while True:
+        rows = list(CapsForm.objects.filter(pk__gt=last_pk).order_by('pk').values('pk', *FORM_FIELDS)[:1000])
+        if not rows:
+            break
+        for row in rows:
+            for key in form_buckets(row):
+                deltas[key] += 1
+        last_pk = rows[-1]['pk']
+    for model, dimension in HISTORY_DIMENSIONS:
+        for row in model.objects.values('type').annotate(n=Count('id')).order_by():
+            deltas[(dimension, row['type'])] += row['n']
+    for row in DrugUse.objects.values('drug__type').annotate(n=Count('id')).order_by():
+        deltas[(DRUG_TYPE, row['drug__type'])] += row['n']
+    with transaction.commit_on_success():
+        SummaryCount.objects.all().delete()
+        SummaryCount.objects.bulk_create(
+            [SummaryCount(dimension=dimension, bucket=bucket, count=n) for (dimension, bucket), n in deltas.items()]
+        )
+
+
+def summary():
+    """
+    Return the summary as a dictionary of dimension -> list of (label, count), with the labels of coded buckets looked
+    up from their choices
+    """
+    labels = {
+        ETHNIC_GROUP: lambda bucket: choices.get(CapsForm, 'ethnic_group').label(int(bucket), bucket),
+        SMOKING: lambda bucket: choices.get(CapsForm, 'smoking').label(bucket, bucket),
+        MARITAL_STATUS: lambda bucket: choices.get(CapsForm, 'marital_status').label(bucket, bucket),
+        DRUG_TYPE: lambda bucket: choices.get(Drug, 'type').label(bucket, bucket),
+    }
+    for model, dimension in HISTORY_DIMENSIONS:
+        labels[dimension] = lambda bucket, model=model: choices.get(model, 'type').label(bucket, bucket)
+    result = defaultdict(list)
+    for row in SummaryCount.objects.filter(count__gt=0):
+        label = labels.get(row.dimension, lambda bucket: bucket)(row.bucket)
+        result[row.dimension].append((label, row.count))
+    return result
+
+
+# Signal handlers. The buckets a form or history entry was counted under before a change are read from the database
+# in pre_save, and the difference between those and its new buckets applied in post_save.
+
+def form_pre_save(sender, instance, raw=False, **kwargs):
+    instance._summary_buckets = []
+    if instance.pk and not raw:
+        for row in CapsForm.objects.filter(pk=instance.pk).values(*FORM_FIELDS):
+            instance._summary_buckets = form_buckets(row)
+
+
+def form_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    deltas = defaultdict(int)
+    for key in getattr(instance, '_summary_buckets', []):
+        deltas[key] -= 1
+    for key in form_buckets(dict((field, getattr(instance, field)) for field in FORM_FIELDS)):
+        deltas[key] += 1
+    apply(deltas)
+
+
+def form_post_delete(sender, instance, **kwargs):
+    apply(dict((key, -1) for key in form_buckets(dict((field, getattr(instance, field)) for field in FORM_FIELDS))))
+
+
+def history_pre_save(sender, instance, raw=False, **kwargs):
+    instance._summary_bucket = None
+    if instance.pk and not raw:
+        if sender is DrugUse:
+            rows = DrugUse.objects.filter(pk=instance.pk).values_list('drug__type', flat=True)
+            dimension = DRUG_TYPE
+        else:
+            rows = sender.objects.filter(pk=instance.pk).values_list('type', flat=True)
+            dimension = dict(HISTORY_DIMENSIONS)[sender]
+        for bucket in rows:
+            instance._summary_bucket = (dimension, bucket)
+
+
+def history_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old, new = getattr(instance, '_summary_bucket', None), history_bucket(instance)
+    if old != new:
+        deltas = {new: 1}
+        if old is not None:
+            deltas[old] = -1
+        apply(deltas)
+
+
+def drug_pre_save(sender, instance, raw=False, **kwargs):
+    instance._summary_type = None
+    if instance.pk and not raw:
+        for old_type in Drug.objects.filter(pk=instance.pk).values_list('type', flat=True):
+            instance._summary_type = old_type
+
+
+def drug_post_save(sender, instance, raw=False, **kwargs):
+    # The uses of a drug whose type has changed move to the bucket of the new type
+    old_type = getattr(instance, '_summary_type', None)
+    if raw or old_type is None or old_type == instance.type:
+        return
+    uses = DrugUse.objects.filter(drug=instance).count()
+    if uses:
+        apply({(DRUG_TYPE, old_type): -uses, (DRUG_TYPE, instance.type): uses})
+
+
+def history_pre_delete(sender, instance, **kwargs):
+    # Work out the bucket while the entry's drug is still there to look at, as it may be being deleted along with it
+    instance._summary_bucket = history_bucket(instance)
+
+
+def history_post_delete(sender, instance, **kwargs):
+    apply({instance._summary_bucket: -1})
+
+
+pre_save.connect(form_pre_save, sender=CapsForm, dispatch_uid='caps_summary_form_pre_save')
+post_save.connect(form_post_save, sender=CapsForm, dispatch_uid='caps_summary_form_post_save')
+post_delete.connect(form_post_delete, sender=CapsForm, dispatch_uid='caps_summary_form_post_delete')
+pre_save.connect(drug_pre_save, sender=Drug, dispatch_uid='caps_summary_drug_pre_save')
+post_save.connect(drug_post_save, sender=Drug, dispatch_uid='caps_summary_drug_post_save')
+for model in (PregnancyProblem, HeartDisease, MedicalProblem, DrugUse):
+    pre_save.connect(history_pre_save, sender=model, dispatch_uid='caps_summary_history_pre_save')
+    post_save.connect(history_post_save, sender=model, dispatch_uid='caps_summary_history_post_save')
+    pre_delete.connect(history_pre_delete, sender=model, dispatch_uid='caps_summary_history_pre_delete')
+    post_delete.connect(history_post_delete, sender=model, dispatch_uid='caps_summary_history_post_delete')
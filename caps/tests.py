@@ -5,7 +5,49 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import base64
+import os
+import re
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection, connections, load_backend, models
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.http import HttpResponse
+from django.template import Context, Template
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.unittest import skipUnless
+from StringIO import StringIO
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zipfile
+from xml.etree import ElementTree
+from caps import (audit, benchmark, cache as caps_cache, choices, columnar, drugs, export, filters, followup, pdf,
+                  pool, profiles, quality, reconcile, replicas, search, summary, xlsx)
+from caps.middleware import InstrumentationMiddleware
+from caps.export import export_queryset
+from caps.importer import Importer, read_csv, read_json
+from caps.widgets import DrugAutocompleteWidget
+from caps.paginator import KeysetPaginator, encode_cursor
+from caps.models import (EditConflict, CapsForm, Drug, DrugUse, FieldChange, FollowUp, PregnancyProblem, HeartDisease,
+                         MedicalProblem, PdfBatch, RiskProfile, SearchDocument, SummaryCount)
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
 
 
 class SimpleTest(TestCase):
@@ -14,3 +56,1586 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def make_user(username='reporter', **kwargs):
+    kwargs.setdefault('first_name', 'Ann')
+    kwargs.setdefault('last_name', 'Reporter')
+    return User.objects.create(username=username, **kwargs)
+
+
+def make_form(user, **kwargs):
+    """
+    Create a valid CapsForm with sensible defaults for anything not given
+    """
+    values = {
+        'case_id': 'C0001',
+        'created_by': user,
+        'year_of_birth': 1980,
+        'ethnic_group': 1,
+        'marital_status': 'married',
+        'employed': False,
+        'height': 165,
+        'weight': Decimal('70.5'),
+        'smoking': 'never',
+        'heart_disease': False,
+        'cardiac_arrest': False,
+        'drug_use': False,
+        'previous_medical_problem': False,
+    }
+    values.update(kwargs)
+    return CapsForm.objects.create(**values)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.user = make_user()
+
+    def test_iter_chunks_covers_every_row_once(self):
+        ids = [make_form(self.user, case_id='C{0:04d}'.format(i)).pk for i in range(7)]
+        chunks = list(export.iter_chunks(CapsForm.objects.all(), chunk_size=3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual([form.pk for chunk in chunks for form in chunk], ids)
+
+    def test_csv_rows_include_flattened_histories(self):
+        form = make_form(self.user, previous_pregnancy_problem=True, gravidity_24plus=1, drug_use=True)
+        PregnancyProblem.objects.create(form=form, type='eclampsia')
+        PregnancyProblem.objects.create(form=form, type='other', details='Twins')
+        drug = Drug.objects.create(name='Cocaine', alternative_names='')
+        DrugUse.objects.create(drug=drug, person=form, last_use_unknown=True)
+        rows = list(export.iter_csv_rows(export.iter_forms()))
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(rows[0].startswith('Case ID,Reported In,Created By'))
+        self.assertIn('Eclampsia | Other: Twins', rows[1])
+        self.assertIn('Cocaine (unknown)', rows[1])
+        self.assertIn('Ann Reporter', rows[1])
+
+    @override_settings(TIME_ZONE='Europe/London')
+    def test_times_are_in_local_time(self):
+        form = make_form(self.user)
+        summer = timezone.make_aware(datetime(2012, 7, 1, 9, 30), timezone.utc)
+        CapsForm.objects.filter(pk=form.pk).update(created_on=summer)
+        drug = Drug.objects.create(name='Cocaine', alternative_names='')
+        DrugUse.objects.create(drug=drug, person=form, last_use=summer)
+        row = list(export.iter_csv_rows(export.iter_forms()))[1]
+        self.assertIn('01-07-2012 10:30:00', row)
+        self.assertIn('Cocaine (2012-07-01 10:30)', row)
+
+    def test_export_query_count_is_per_chunk(self):
+        for i in range(5):
+            make_form(self.user, case_id='C{0:04d}'.format(i))
+        # One query for the forms and four for the prefetched histories per chunk, plus the final empty chunk
+        with self.assertNumQueries(5 + 1):
+            list(export.iter_csv_rows(export.iter_forms(chunk_size=10)))
+
+
+class XlsxExportTest(TestCase):
+    NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+    def setUp(self):
+        self.user = make_user()
+
+    def read_workbook(self):
+        return zipfile.ZipFile(StringIO(''.join(xlsx.caps_workbook().stream())))
+
+    def sheet_rows(self, archive, number):
+        strings = [si.find(self.NS + 't').text
+                   for si in ElementTree.fromstring(archive.read('xl/sharedStrings.xml')).iter(self.NS + 'si')]
+        sheet = ElementTree.fromstring(archive.read('xl/worksheets/sheet{0}.xml'.format(number)))
+        rows = []
+        for row in sheet.iter(self.NS + 'row'):
+            cells = {}
+            for cell in row.iter(self.NS + 'c'):
+                if cell.get('t') == 's':
+                    cells[cell.get('r').rstrip('0123456789')] = strings[int(cell.find(self.NS + 'v').text)]
+                elif cell.get('t') == 'inlineStr':
+                    cells[cell.get('r').rstrip('0123456789')] = cell.find(self.NS + 'is/' + self.NS + 't').text
+                else:
+                    cells[cell.get('r').rstrip('0123456789')] = cell.find(self.NS + 'v').text
+            rows.append(cells)
+        return rows
+
+    def test_workbook_is_a_valid_zip_with_a_sheet_per_entity(self):
+        form = make_form(self.user, case_id='C0001', previous_pregnancy_problem=True, gravidity_24plus=1,
+                         drug_use=True, occupation=u'Midwife & <nurse>')
+        PregnancyProblem.objects.create(form=form, type='eclampsia')
+        PregnancyProblem.objects.create(form=form, type='other', details='Twins')
+        DrugUse.objects.create(drug=Drug.objects.create(name='Cocaine', alternative_names=''), person=form,
+                               last_use_unknown=True)
+        archive = self.read_workbook()
+        self.assertIsNone(archive.testzip())
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        self.assertEqual([sheet.get('name') for sheet in workbook.iter(self.NS + 'sheet')],
+                         ['CAPS Forms', 'Pregnancy Problems', 'Heart Disease', 'Medical Problems', 'Drug Use'])
+        forms = self.sheet_rows(archive, 1)
+        self.assertEqual(forms[0]['B'], 'Case ID')
+        self.assertEqual(forms[1]['B'], 'C0001')
+        self.assertEqual(forms[1]['D'], 'Ann Reporter')
+        self.assertEqual(forms[1]['J'], u'Midwife & <nurse>')
+        self.assertEqual(forms[1]['K'], '165')
+        problems = self.sheet_rows(archive, 2)
+        self.assertEqual([row['C'] for row in problems[1:]], ['Eclampsia', 'Other'])
+        self.assertEqual(problems[2]['D'], 'Twins')
+        drug_use = self.sheet_rows(archive, 5)
+        self.assertEqual((drug_use[1]['C'], drug_use[1]['G']), ('Cocaine', 'Yes'))
+
+    def test_choice_labels_are_shared(self):
+        for i in range(5):
+            make_form(self.user, case_id='C{0:04d}'.format(i))
+        archive = self.read_workbook()
+        strings = ElementTree.fromstring(archive.read('xl/sharedStrings.xml'))
+        texts = [si.find(self.NS + 't').text for si in strings.iter(self.NS + 'si')]
+        self.assertEqual(len(texts), len(set(texts)))
+        self.assertNotIn('C0001', texts)
+        self.assertEqual(self.sheet_rows(archive, 1)[5]['B'], 'C0004')
+
+    def test_column_letters(self):
+        self.assertEqual([xlsx.column_letter(i) for i in (0, 25, 26, 27, 701, 702)],
+                         ['A', 'Z', 'AA', 'AB', 'ZZ', 'AAA'])
+
+
+def count_queries(func, *args, **kwargs):
+    """
+    Run func and return the number of database queries it made, whatever the DEBUG setting
+    """
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    connection.queries = []
+    try:
+        func(*args, **kwargs)
+        return len(connection.queries)
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+
+
+class ChangeListTest(TestCase):
+    # Session, user, count, page of results and the creator counts for the sidebar
+    QUERY_BUDGET = 5
+    url = '/admin/caps/capsform/'
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+
+    def add_forms(self, count):
+        for i in range(count):
+            user = make_user('reporter{0}'.format(User.objects.count()))
+            make_form(user, case_id='C{0:04d}'.format(i))
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.add_forms(3)
+        small = count_queries(self.client.get, self.url)
+        self.add_forms(30)
+        large = count_queries(self.client.get, self.url)
+        self.assertEqual(small, large)
+        self.assertTrue(large <= self.QUERY_BUDGET, large)
+
+    def test_creator_filter_lists_counts(self):
+        self.add_forms(2)
+        response = self.client.get(self.url)
+        self.assertContains(response, 'Ann Reporter (1)', count=2)
+        self.assertNotContains(response, 'admin (')
+
+
+class KeysetPaginatorTest(TestCase):
+    def setUp(self):
+        user = make_user()
+        self.forms = [make_form(user, case_id='C{0:04d}'.format(i)) for i in range(5)]
+        self.newest_first = [form.pk for form in reversed(self.forms)]
+
+    def pages(self, **kwargs):
+        return KeysetPaginator(CapsForm.objects.all(), 2, **kwargs).page()
+
+    def test_walks_forwards_and_backwards(self):
+        first = self.pages()
+        self.assertEqual([f.pk for f in first.object_list], self.newest_first[:2])
+        self.assertFalse(first.has_previous())
+        second = self.pages(after=first.next_cursor())
+        self.assertEqual([f.pk for f in second.object_list], self.newest_first[2:4])
+        last = self.pages(after=second.next_cursor())
+        self.assertEqual([f.pk for f in last.object_list], self.newest_first[4:])
+        self.assertFalse(last.has_next())
+        back = self.pages(before=last.previous_cursor())
+        self.assertEqual([f.pk for f in back.object_list], self.newest_first[2:4])
+        self.assertTrue(back.has_previous())
+
+    def test_deep_page_costs_the_same_as_the_first(self):
+        first = count_queries(self.pages)
+        deep = count_queries(self.pages, after=encode_cursor(self.forms[1]))
+        self.assertEqual(first, deep)
+
+    def test_changelist_follows_cursor(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.get('/admin/caps/capsform/', {'after': encode_cursor(self.forms[2])})
+        self.assertEqual([f.pk for f in response.context['cl'].result_list], self.newest_first[3:])
+        response = self.client.get('/admin/caps/capsform/', {'after': 'nonsense'})
+        self.assertEqual(response.status_code, 302)
+
+
+class IndexTest(TestCase):
+    """
+    Check with EXPLAIN that each changelist filter, in the changelist's newest first order, is answered from an index
+    rather than by reading the whole table
+    """
+    def filtered(self, **lookups):
+        return CapsForm.objects.filter(**lookups).order_by('-created_on', '-id')[:100]
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        if connection.vendor == 'postgresql':
+            # Make a sequential scan as unattractive as possible, so one only shows up if there's no usable index
+            cursor.execute('SET enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+        else:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return u'\n'.join(u' '.join(unicode(column) for column in row) for row in cursor.fetchall())
+
+    def assertNoTableScan(self, queryset):
+        plan = self.plan(queryset)
+        self.assertFalse('Seq Scan' in plan, plan)
+        self.assertFalse(re.search(r'SCAN (TABLE )?caps_capsform\s*$', plan, re.M), plan)
+
+    @skipUnless(connection.vendor in ('postgresql', 'sqlite'), 'EXPLAIN output is only checked for PostgreSQL and SQLite')
+    def test_list_filters_use_indexes(self):
+        now = timezone.now()
+        self.assertNoTableScan(self.filtered())
+        self.assertNoTableScan(self.filtered(created_by=1))
+        self.assertNoTableScan(self.filtered(created_on__gte=now - timedelta(days=7), created_on__lt=now))
+        self.assertNoTableScan(self.filtered(smoking='never'))
+        self.assertNoTableScan(self.filtered(previous_pregnancy_problem=True))
+        self.assertNoTableScan(self.filtered(previous_pregnancy_problem__isnull=True))
+        self.assertNoTableScan(self.filtered(heart_disease=True))
+        self.assertNoTableScan(self.filtered(cardiac_arrest=False))
+        self.assertNoTableScan(self.filtered(drug_use=True))
+        self.assertNoTableScan(self.filtered(previous_medical_problem=True))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Trigram indexes are only created on PostgreSQL')
+    def test_drug_search_uses_trigram_index(self):
+        queryset = Drug.objects.filter(models.Q(name__icontains='coc') | models.Q(alternative_names__icontains='coc'))
+        plan = self.plan(queryset)
+        self.assertFalse('Seq Scan' in plan, plan)
+
+
+class ChoicesTest(TestCase):
+    def test_nested_groups_are_flattened(self):
+        ethnic_group = choices.get(CapsForm, 'ethnic_group')
+        self.assertEqual(ethnic_group.label(13), u'African')
+        self.assertEqual(ethnic_group.label(0), u'Unknown')
+        self.assertEqual(ethnic_group.label(99), u'')
+        self.assertEqual(len(ethnic_group), 17)
+
+    def test_reverse_lookup_accepts_labels_and_codes(self):
+        ethnic_group = choices.get(CapsForm, 'ethnic_group')
+        self.assertEqual(ethnic_group.code(u' british '), 1)
+        self.assertEqual(ethnic_group.code(u'1'), 1)
+        self.assertEqual(ethnic_group.code(u'Martian'), None)
+        self.assertEqual(choices.get(HeartDisease, 'type').code(u'Cocaine use'), u'cocaineuse')
+
+    def test_model_accessors(self):
+        form = CapsForm(ethnic_group=8, marital_status='cohabiting', smoking='prior')
+        self.assertEqual(form.ethnic_group_string(), u'Indian')
+        self.assertEqual(form.marital_status_string(), u'Cohabiting')
+        self.assertEqual(form.smoking_string(), u'Gave up prior to pregnancy')
+        self.assertEqual(PregnancyProblem(type='sga').type_string(), u'Small for gestational age (SGA) infant')
+
+
+class ImporterTest(TestCase):
+    def setUp(self):
+        make_user('ann')
+        Drug.objects.create(name='Cocaine', alternative_names='Coke, Charlie')
+        self.record = {
+            'case_id': 'H0001', 'created_by': 'ann', 'year_of_birth': '1979', 'ethnic_group': 'Irish',
+            'marital_status': 'Single', 'employed': 'No', 'height': '160', 'weight': '60.0', 'smoking': 'never',
+            'gravidity_24plus': '2', 'gravidity_24minus': '0', 'previous_pregnancy_problem': 'Yes',
+            'heart_disease': 'No', 'cardiac_arrest': 'No', 'drug_use': 'No', 'previous_medical_problem': 'No',
+            'previous_pregnancy_history': 'Eclampsia | Other: Twins',
+            'drug_history': 'Charlie (2012-05-01 10:00)',
+        }
+
+    def test_imports_forms_with_histories(self):
+        importer = Importer(batch_size=2)
+        records = [dict(self.record, case_id='H{0:04d}'.format(i)) for i in range(5)]
+        self.assertEqual(importer.run(records), 5)
+        self.assertEqual(importer.errors, [])
+        form = CapsForm.objects.get(case_id='H0003')
+        self.assertEqual(form.ethnic_group, 2)
+        self.assertTrue(form.drug_use)
+        self.assertEqual(sorted(form.previous_pregnancy_history.values_list('type', flat=True)), ['eclampsia', 'other'])
+        self.assertEqual(form.drug_history.get().drug.name, 'Cocaine')
+
+    def test_validation_needs_no_queries(self):
+        importer = Importer()
+        with self.assertNumQueries(0):
+            importer.build(self.record)
+
+    def test_rejected_records_are_reported(self):
+        bad = dict(self.record, case_id='BAD', gravidity_24plus='0', created_by='nobody', height='20')
+        importer = Importer()
+        self.assertEqual(importer.run([self.record, bad]), 1)
+        number, case_id, messages = importer.errors[0]
+        self.assertEqual((number, case_id), (2, 'BAD'))
+        self.assertEqual(len(messages), 2)
+        self.assertFalse(CapsForm.objects.filter(case_id='BAD').exists())
+
+    def test_historical_returns_keep_their_created_on(self):
+        records = [dict(self.record, case_id='H0001', created_on='12-03-2011 09:30:00'),
+                   dict(self.record, case_id='H0002', created_on='2010-07-01'), dict(self.record, case_id='H0003')]
+        self.assertEqual(Importer().run(records), 3)
+        forms = dict(CapsForm.objects.values_list('case_id', 'created_on'))
+        local = timezone.get_current_timezone()
+        self.assertEqual(timezone.localtime(forms['H0001']), timezone.make_aware(datetime(2011, 3, 12, 9, 30), local))
+        self.assertEqual(timezone.localtime(forms['H0002']), timezone.make_aware(datetime(2010, 7, 1), local))
+        self.assertTrue(forms['H0003'] > timezone.now() - timedelta(hours=1))
+        accrual = dict(SummaryCount.objects.filter(dimension=summary.ACCRUAL).values_list('bucket', 'count'))
+        self.assertEqual((accrual['2011-03'], accrual['2010-07']), (1, 1))
+        self.assertEqual(Importer().run([dict(self.record, created_on='31-02-2011')]), 0)
+
+    def test_readers(self):
+        rows = list(read_csv(StringIO('case_id,ethnic_group\nA1,British\n')))
+        self.assertEqual(rows, [{'case_id': u'A1', 'ethnic_group': u'British'}])
+        self.assertEqual(len(list(read_json(StringIO('{"case_id": "A1"}\n\n{"case_id": "A2"}\n')))), 2)
+        self.assertEqual(len(list(read_json(StringIO(' [{"case_id": "A1"}]')))), 1)
+
+
+def admin_post_data(user, pregnancy_types=(), **kwargs):
+    """
+    The data posted by the admin's CapsForm add and change pages, for a valid form with the given changes
+    """
+    data = {
+        'case_id': 'A0001', 'created_by': user.pk, 'year_of_birth': '1980', 'ethnic_group': '1',
+        'marital_status': 'married', 'employed': 'False', 'height': '165', 'weight': '70.5', 'smoking': 'never',
+        'gravidity_24plus': '1', 'gravidity_24minus': '0', 'previous_pregnancy_problem': 'False',
+        'heart_disease': 'False', 'cardiac_arrest': 'False', 'drug_use': 'False',
+        'previous_medical_problem': 'False',
+    }
+    for prefix in ('previous_pregnancy_history', 'heart_disease_history', 'previous_medical_history',
+                   'drug_history'):
+        data[prefix + '-TOTAL_FORMS'] = '0'
+        data[prefix + '-INITIAL_FORMS'] = '0'
+    data['previous_pregnancy_history-TOTAL_FORMS'] = str(len(pregnancy_types))
+    for i, pregnancy_type in enumerate(pregnancy_types):
+        data['previous_pregnancy_history-{0}-type'.format(i)] = pregnancy_type
+    data.update(kwargs)
+    return data
+
+
+class AdminValidationTest(TestCase):
+    url = '/admin/caps/capsform/add/'
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+
+    def post_data(self, pregnancy_types=(), **kwargs):
+        return admin_post_data(self.admin, pregnancy_types, **kwargs)
+
+    def test_histories_correct_the_summary_flag(self):
+        response = self.client.post(self.url, self.post_data(pregnancy_types=['eclampsia']))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(CapsForm.objects.get().previous_pregnancy_problem)
+
+    def test_submitted_histories_are_checked_against_the_form(self):
+        response = self.client.post(self.url, self.post_data(drug_use='True', previous_medical_problem='True'))
+        self.assertContains(response, 'Please specify at least one drug used by the woman')
+        self.assertContains(response, 'Please specify a pre-existing or previous medical condition')
+        response = self.client.post(self.url, self.post_data(pregnancy_types=['sga'], gravidity_24plus='0'))
+        self.assertContains(response, 'No previous pregnancies have been entered')
+        self.assertFalse(CapsForm.objects.exists())
+
+    def test_model_clean_makes_no_queries(self):
+        form = make_form(make_user())
+        with self.assertNumQueries(0):
+            form.clean()
+
+
+class ConcurrencyTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        self.form = make_form(self.admin, gravidity_24plus=1, gravidity_24minus=0, previous_pregnancy_problem=False)
+        self.url = '/admin/caps/capsform/{0}/'.format(self.form.pk)
+
+    def test_save_updates_only_the_changed_fields(self):
+        form = CapsForm.objects.get()
+        form.height = 170
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            form.save()
+            updates = [query['sql'] for query in connection.queries if query['sql'].startswith('UPDATE "caps_capsform"')]
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"height"', updates[0])
+        self.assertNotIn('"weight"', updates[0])
+        self.assertEqual(form.version, 2)
+        self.assertEqual(CapsForm.objects.get().version, 2)
+
+    def test_saves_of_different_fields_are_merged(self):
+        first, second = CapsForm.objects.get(), CapsForm.objects.get()
+        first.height = 170
+        first.save()
+        second.weight = Decimal('80.0')
+        second.save()
+        saved = CapsForm.objects.get()
+        self.assertEqual((saved.height, saved.weight, saved.version), (170, Decimal('80.0'), 3))
+        self.assertEqual(second.height, 170)
+
+    def test_saves_of_the_same_field_conflict(self):
+        first, second = CapsForm.objects.get(), CapsForm.objects.get()
+        first.height = 170
+        first.save()
+        second.height = 160
+        with self.assertRaises(EditConflict) as raised:
+            second.save()
+        self.assertEqual(raised.exception.conflicts, [('height', 160, 170)])
+        self.assertEqual(CapsForm.objects.get().height, 170)
+
+    def test_admin_shows_the_conflicting_answers(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'name="version" value="1"')
+        other = CapsForm.objects.get()
+        other.height = 170
+        other.save()
+        data = admin_post_data(self.admin, height='160', weight='72.0', version='1')
+        response = self.client.post(self.url, data)
+        self.assertContains(response, 'Someone else has saved this form since you opened it')
+        self.assertContains(response, 'Saved by someone else as &quot;170&quot;')
+        self.assertContains(response, 'name="version" value="2"')
+        self.assertEqual(CapsForm.objects.get().height, 170)
+        # Saving again replaces their answers
+        response = self.client.post(self.url, dict(data, version='2'))
+        self.assertEqual(response.status_code, 302)
+        saved = CapsForm.objects.get()
+        self.assertEqual((saved.height, saved.weight, saved.version), (160, Decimal('72.0'), 3))
+
+    def loaded(self):
+        # The answers the change page carries, as the browser posts them back
+        return self.client.get(self.url).context['adminform'].form['loaded'].value()
+
+    def test_admin_keeps_answers_only_someone_else_changed(self):
+        loaded = self.loaded()
+        other = CapsForm.objects.get()
+        other.smoking = 'current'
+        other.save()
+        # A history saved on its own moves the version on too
+        HeartDisease.objects.create(form=self.form, type='other', details='Murmur')
+        response = self.client.post(self.url, admin_post_data(self.admin, height='160', version='1', loaded=loaded))
+        self.assertEqual(response.status_code, 302)
+        saved = CapsForm.objects.get()
+        self.assertEqual((saved.height, saved.smoking), (160, 'current'))
+
+    def test_admin_marks_only_answers_both_changed(self):
+        loaded = self.loaded()
+        other = CapsForm.objects.get()
+        other.height, other.smoking = 170, 'current'
+        other.save()
+        data = admin_post_data(self.admin, height='160', weight='72.0', version='1', loaded=loaded)
+        response = self.client.post(self.url, data)
+        self.assertContains(response, 'Saved by someone else as &quot;170&quot;', count=1)
+        self.assertEqual(sorted(response.context['adminform'].form.errors), ['__all__', 'height'])
+        form = response.context['adminform'].form
+        # Saving again keeps their other answer, sent back with the form
+        response = self.client.post(self.url, dict(data, version=form['version'].value(), loaded=form['loaded'].value(),
+                                                   smoking=form['smoking'].value()))
+        self.assertEqual(response.status_code, 302)
+        saved = CapsForm.objects.get()
+        self.assertEqual((saved.height, saved.weight, saved.smoking), (160, Decimal('72.0'), 'current'))
+
+    def test_history_changes_move_the_version_on(self):
+        PregnancyProblem.objects.create(form=self.form, type='eclampsia')
+        self.assertEqual(CapsForm.objects.get().version, 2)
+        # An instance loaded before the change still saves, as the history didn't change any of its fields
+        self.form.height = 170
+        self.form.save()
+        self.assertEqual(CapsForm.objects.get().version, 3)
+
+    def test_history_clean_leaves_the_form_alone(self):
+        problem = PregnancyProblem(form=self.form, type='eclampsia')
+        problem.clean()
+        self.assertFalse(self.form.previous_pregnancy_problem)
+
+
+class AuditTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        self.start = timezone.now() - timedelta(days=10)
+        self.last = 0
+
+    def at(self, days):
+        # Date the changes made since the last call, and the form's creation, days after the start
+        when = self.start + timedelta(days=days)
+        FieldChange.objects.filter(pk__gt=self.last).update(changed_on=when)
+        self.last = FieldChange.objects.order_by('-pk').values_list('pk', flat=True)[0]
+        return when
+
+    def test_admin_changes_are_recorded_against_the_user(self):
+        form = make_form(self.admin, gravidity_24plus=1, gravidity_24minus=0, previous_pregnancy_problem=False)
+        url = '/admin/caps/capsform/{0}/'.format(form.pk)
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            response = self.client.post(url, admin_post_data(self.admin, case_id='C0001', height='170', weight='72.0',
+                                                                   version='1'))
+            inserts = [query for query in connection.queries if query['sql'].startswith('INSERT INTO "caps_fieldchange"')]
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(inserts), 1)
+        changes = audit.changes_by(self.admin, timezone.now() - timedelta(hours=1), timezone.now())
+        self.assertEqual(sorted((change.field, change.old_value, change.new_value) for change in changes),
+                         [('height', '165', '170'), ('weight', '70.5', '72.0')])
+        self.assertContains(self.client.get(url + 'history/'), 'Changes to the answers')
+
+    def actions(self, form):
+        return [(change.model, change.action) for change in audit.form_history(form.pk)]
+
+    def test_admin_saves_and_deletes_write_the_trail_once(self):
+        def inserts(func, *args):
+            use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            connection.queries = []
+            try:
+                response = func(*args)
+                self.assertEqual(response.status_code, 302)
+                return len([query for query in connection.queries
+                            if query['sql'].startswith('INSERT INTO "caps_fieldchange"')])
+            finally:
+                connection.use_debug_cursor = use_debug_cursor
+
+        data = admin_post_data(self.admin, pregnancy_types=['eclampsia', 'sga'], previous_pregnancy_problem='True')
+        self.assertEqual(inserts(self.client.post, '/admin/caps/capsform/add/', data), 1)
+        form = CapsForm.objects.get()
+        self.assertEqual(sorted(self.actions(form)), [('capsform', 'c'), ('pregnancyproblem', 'c'),
+                                                              ('pregnancyproblem', 'c')])
+        url = '/admin/caps/capsform/{0}/delete/'.format(form.pk)
+        self.assertEqual(inserts(self.client.post, url, {'post': 'yes'}), 1)
+        self.assertEqual(sorted(set(self.actions(form))),
+                         [('capsform', 'c'), ('capsform', 'd'), ('pregnancyproblem', 'c'), ('pregnancyproblem', 'd')])
+        # Saves outside a batch are still written straight away
+        make_form(self.admin, case_id='C0002')
+        self.assertEqual(FieldChange.objects.filter(model='capsform', action='c').count(), 2)
+
+    def test_form_is_rebuilt_as_it_was(self):
+        form = make_form(self.admin, gravidity_24plus=1, gravidity_24minus=0, previous_pregnancy_problem=False)
+        CapsForm.objects.filter(pk=form.pk).update(created_on=self.at(0))
+        problem = PregnancyProblem.objects.create(form=form, type='eclampsia')
+        self.at(2)
+        form = CapsForm.objects.get()
+        form.height = 170
+        form.save()
+        problem.type = 'sga'
+        problem.save()
+        self.at(4)
+        problem.delete()
+        self.at(6)
+        form_id = form.pk
+        form.delete()
+        self.at(8)
+
+        def as_of(days):
+            return audit.form_as_of(form_id, self.start + timedelta(days=days))
+
+        self.assertIsNone(as_of(-1))
+        for days, height, types in ((1, 165, []), (3, 165, ['eclampsia']), (5, 170, ['sga']), (7, 170, [])):
+            rebuilt, histories = as_of(days)
+            self.assertEqual(rebuilt.height, height)
+            self.assertEqual(rebuilt.weight, Decimal('70.5'))
+            self.assertEqual([entry.type for entry in histories['previous_pregnancy_history']], types)
+        self.assertIsNone(as_of(9))
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.nurse = make_form(self.admin, case_id='S0001', employed=True, occupation='Nurse')
+        self.teacher = make_form(self.admin, case_id='S0002', employed=True, occupation='Teacher',
+                                 case_reported='Leeds General Infirmary')
+        HeartDisease.objects.create(form=self.nurse, type='other', details='Severe infection of the heart valve')
+
+    def case_ids(self, text):
+        return [case_id for pk, case_id, rank in search.search(text)]
+
+    def test_index_follows_saves(self):
+        self.assertEqual(self.case_ids('nurse'), ['S0001'])
+        self.assertEqual(self.case_ids('heart infection'), ['S0001'])
+        self.assertEqual(self.case_ids('leeds infirmary'), ['S0002'])
+        self.assertEqual(self.case_ids('nurse leeds'), [])
+        self.nurse.occupation = 'Midwife'
+        self.nurse.save()
+        self.assertEqual(self.case_ids('nurse'), [])
+        self.assertEqual(self.case_ids('midwife'), ['S0001'])
+        self.nurse.heart_disease_history.all().delete()
+        self.assertEqual(self.case_ids('infection'), [])
+        self.teacher.delete()
+        self.assertEqual(self.case_ids('teacher'), [])
+        self.assertEqual(self.case_ids('S0001'), ['S0001'])
+
+    def test_results_are_ranked(self):
+        MedicalProblem.objects.create(form=self.teacher, type='other', details='Infection')
+        MedicalProblem.objects.create(form=self.teacher, type='other', details='Another infection')
+        self.assertEqual(self.case_ids('infection'), ['S0002', 'S0001'])
+
+    def test_changelist_searches_the_index(self):
+        self.client.login(username='admin', password='secret')
+        response = self.client.get('/admin/caps/capsform/', {'q': 'valve'})
+        self.assertEqual([form.case_id for form in response.context['cl'].result_list], ['S0001'])
+
+    def test_imported_and_rebuilt_forms_are_indexed(self):
+        importer = Importer()
+        importer.run([{'case_id': 'S0003', 'created_by': 'admin', 'year_of_birth': '1980', 'ethnic_group': '1',
+                       'marital_status': 'single', 'employed': 'No', 'height': '160', 'weight': '60',
+                       'smoking': 'never', 'gravidity_24plus': '0', 'gravidity_24minus': '0',
+                       'cardiac_arrest': 'Yes', 'cardiac_arrest_date': '2011-01-01',
+                       'cardiac_arrest_cause': 'Amniotic fluid embolism'}])
+        self.assertEqual(importer.errors, [])
+        self.assertEqual(self.case_ids('embolism'), ['S0003'])
+        self.assertEqual(search.rebuild(), 3)
+        self.assertEqual(self.case_ids('embolism'), ['S0003'])
+        self.assertEqual(self.case_ids('infection'), ['S0001'])
+
+
+class ProfileTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.first = make_form(self.admin, case_id='P0001')
+        self.second = make_form(self.admin, case_id='P0002')
+        self.third = make_form(self.admin, case_id='P0003')
+        PregnancyProblem.objects.create(form=self.first, type='eclampsia')
+        HeartDisease.objects.create(form=self.first, type='prevcardsurg')
+        PregnancyProblem.objects.create(form=self.second, type='eclampsia')
+        MedicalProblem.objects.create(form=self.second, type='cancer')
+        HeartDisease.objects.create(form=self.third, type='prevcardsurg')
+
+    def cohort(self, text):
+        return sorted(profiles.cohort(profiles.parse(text)).values_list('case_id', flat=True))
+
+    def test_combinations(self):
+        self.assertEqual(self.cohort('pregnancy.eclampsia'), ['P0001', 'P0002'])
+        self.assertEqual(self.cohort('pregnancy.eclampsia and heart.prevcardsurg'), ['P0001'])
+        self.assertEqual(self.cohort('pregnancy.eclampsia or heart.prevcardsurg'), ['P0001', 'P0002', 'P0003'])
+        self.assertEqual(self.cohort('not medical.cancer'), ['P0001', 'P0003'])
+        self.assertEqual(self.cohort('heart.prevcardsurg and not (pregnancy.eclampsia or medical.cancer)'), ['P0003'])
+        self.assertEqual(sorted(profiles.cohort(profiles.HasAll('pregnancy.eclampsia', 'medical.cancer'))
+                                .values_list('case_id', flat=True)), ['P0002'])
+        self.assertRaises(ValueError, profiles.parse, 'pregnancy.eclampsia and')
+        self.assertRaises(ValueError, profiles.parse, 'heart.unknown')
+
+    def test_profiles_follow_saves(self):
+        problem = MedicalProblem.objects.get(form=self.second)
+        problem.type = 'renaldisease'
+        problem.save()
+        self.assertEqual(self.cohort('medical.cancer'), [])
+        self.assertEqual(self.cohort('medical.renaldisease'), ['P0002'])
+        self.first.previous_pregnancy_history.all().delete()
+        self.assertEqual(self.cohort('pregnancy.eclampsia'), ['P0002'])
+        self.third.delete()
+        self.assertFalse(RiskProfile.objects.filter(form_id=self.third.pk).exists())
+        self.assertEqual(profiles.rebuild(), 2)
+        self.assertEqual(self.cohort('heart.prevcardsurg'), ['P0001'])
+
+    def test_cohorts_with_drug_use(self):
+        cocaine = Drug.objects.create(name='Cocaine', alternative_names='Coke', type='erythroxylum')
+        use = DrugUse.objects.create(drug=cocaine, person=self.first, last_use_unknown=True)
+        DrugUse.objects.create(drug=cocaine, person=self.second, last_use_unknown=True)
+        self.assertEqual(self.cohort('pregnancy.eclampsia and heart.prevcardsurg and drug.erythroxylum'), ['P0001'])
+        self.assertEqual(self.cohort('drug.erythroxylum and not medical.cancer'), ['P0001'])
+        cocaine.type = 'stimulant'
+        cocaine.save()
+        self.assertEqual(self.cohort('drug.erythroxylum'), [])
+        self.assertEqual(self.cohort('drug.stimulant'), ['P0001', 'P0002'])
+        use.delete()
+        self.assertEqual(self.cohort('drug.stimulant'), ['P0002'])
+        self.assertEqual(profiles.rebuild(), 3)
+        self.assertEqual(self.cohort('drug.stimulant and medical.cancer'), ['P0002'])
+
+    def test_cooccurrence(self):
+        matrix = profiles.cooccurrence()
+        eclampsia = profiles.BITS['pregnancy.eclampsia']
+        surgery = profiles.BITS['heart.prevcardsurg']
+        self.assertEqual(matrix[eclampsia][eclampsia], 2)
+        self.assertEqual(matrix[eclampsia][surgery], 1)
+        self.assertEqual(matrix[surgery][eclampsia], 1)
+        self.assertEqual(sum(map(sum, matrix)), 5 + 2 * 2)
+
+    @skipUnless(profiles.numpy is not None, 'Loading the risk profiles needs NumPy')
+    def test_profiles_in_memory(self):
+        loaded = profiles.Profiles()
+        self.assertEqual(len(loaded), 3)
+        condition = profiles.Has('pregnancy.eclampsia') & ~profiles.Has('medical.cancer')
+        self.assertEqual(list(loaded.matches(condition)), [self.first.pk])
+        self.assertEqual(loaded.count(profiles.Has('heart.prevcardsurg') | profiles.Has('medical.cancer')), 3)
+        self.assertEqual(loaded.cooccurrence().tolist(), profiles.cooccurrence())
+
+    def test_imported_forms_have_profiles(self):
+        Drug.objects.create(name='Cocaine', alternative_names='', type='erythroxylum')
+        importer = Importer()
+        importer.run([{'case_id': 'P0004', 'created_by': 'admin', 'year_of_birth': '1980', 'ethnic_group': '1',
+                       'marital_status': 'single', 'employed': 'No', 'height': '160', 'weight': '60',
+                       'smoking': 'never', 'gravidity_24plus': '1', 'gravidity_24minus': '0',
+                       'previous_pregnancy_history': 'Eclampsia', 'previous_medical_history': 'Cancer',
+                       'drug_history': 'Cocaine (unknown)'}])
+        self.assertEqual(importer.errors, [])
+        self.assertEqual(self.cohort('pregnancy.eclampsia and medical.cancer'), ['P0002', 'P0004'])
+        self.assertEqual(self.cohort('drug.erythroxylum'), ['P0004'])
+
+
+class ReconcileTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.forms = [make_form(self.admin, case_id='R%04d' % i) for i in range(5)]
+        # Histories added on their own, without the rules setting the flags on the form
+        HeartDisease.objects.create(form=self.forms[0], type='prevcardsurg')
+        MedicalProblem.objects.create(form=self.forms[0], type='cancer')
+        MedicalProblem.objects.create(form=self.forms[3], type='cancer')
+        CapsForm.objects.filter(pk=self.forms[4].pk).update(cardiac_arrest_date=date(2010, 1, 1))
+        CapsForm.objects.filter(pk=self.forms[2].pk).update(drug_use=True)
+
+    def flags(self, form):
+        return CapsForm.objects.filter(pk=form.pk).values_list('heart_disease', 'previous_medical_problem',
+                                                               'cardiac_arrest', 'drug_use')[0]
+
+    def test_dry_run_changes_nothing(self):
+        found = []
+        counts = reconcile.sweep(dry_run=True, chunk_size=2, found=found.append)
+        self.assertEqual([(mismatch.case_id, mismatch.flag) for mismatch in found],
+                         [('R0000', 'heart_disease'), ('R0000', 'previous_medical_problem'),
+                          ('R0003', 'previous_medical_problem'), ('R0004', 'cardiac_arrest')])
+        self.assertEqual(counts['previous_medical_problem'], 2)
+        self.assertEqual(self.flags(self.forms[0]), (False, False, False, False))
+        self.assertFalse(FieldChange.objects.filter(field='heart_disease').exists())
+
+    def test_sweep_fixes_flags(self):
+        versions = dict(CapsForm.objects.values_list('pk', 'version'))
+        counts = reconcile.sweep(chunk_size=2)
+        self.assertEqual(counts, {'previous_pregnancy_problem': 0, 'heart_disease': 1, 'previous_medical_problem': 2,
+                                  'drug_use': 0, 'cardiac_arrest': 1})
+        self.assertEqual(self.flags(self.forms[0]), (True, True, False, False))
+        self.assertEqual(self.flags(self.forms[3]), (False, True, False, False))
+        self.assertEqual(self.flags(self.forms[4]), (False, False, True, False))
+        self.assertEqual(self.flags(self.forms[1]), (False, False, False, False))
+        # The forms fixed have moved on a version, and the fixes are in the audit trail
+        self.assertEqual(CapsForm.objects.get(pk=self.forms[0].pk).version, versions[self.forms[0].pk] + 2)
+        self.assertEqual(CapsForm.objects.get(pk=self.forms[1].pk).version, versions[self.forms[1].pk])
+        change = FieldChange.objects.get(form_id=self.forms[4].pk, field='cardiac_arrest')
+        self.assertEqual((change.old_value, change.new_value, change.action), (u'False', u'True', audit.CHANGED))
+        self.assertEqual(reconcile.sweep(), dict((rule.flag, 0) for rule in reconcile.RULES))
+        self.assertEqual(reconcile.unanswered()['drug_use'], 1)
+
+
+class ReplicaTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.form = make_form(self.admin)
+        # A replica sharing the test database's connection, and one that can't be reached
+        connections['replica'] = connection
+        connections.databases['broken'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '/nonexistent/caps.db'}
+        replicas.reset_health()
+        replicas.ReplicaMiddleware().process_request(RequestFactory().get('/'))
+        self.router = replicas.ReplicaRouter()
+
+    def tearDown(self):
+        delattr(connections._connections, 'replica')
+        del connections.databases['broken']
+        if hasattr(connections._connections, 'broken'):
+            delattr(connections._connections, 'broken')
+        replicas.reset_health()
+        replicas.ReplicaMiddleware().process_request(RequestFactory().get('/'))
+
+    @override_settings(CAPS_REPLICAS=['replica'])
+    def test_reads_inside_the_block_go_to_the_replica(self):
+        self.assertEqual(self.router.db_for_read(CapsForm), None)
+        with replicas.use_replica():
+            self.assertEqual(self.router.db_for_read(CapsForm), 'replica')
+            with replicas.use_primary():
+                self.assertEqual(self.router.db_for_read(CapsForm), None)
+            form = CapsForm.objects.db_manager('replica').get()
+        self.assertEqual(self.router.db_for_read(CapsForm), None)
+        self.assertEqual(self.router.db_for_read(PregnancyProblem, instance=form), 'default')
+        self.assertFalse(self.router.allow_syncdb('replica', CapsForm))
+
+    @override_settings(CAPS_REPLICAS=['replica'])
+    def test_writes_keep_the_thread_on_the_primary(self):
+        with replicas.use_replica():
+            self.assertEqual(self.router.db_for_write(CapsForm, instance=self.form), 'default')
+            self.assertEqual(self.router.db_for_read(CapsForm), None)
+        replicas.ReplicaMiddleware().process_request(RequestFactory().get('/'))
+        with replicas.use_replica():
+            self.assertEqual(self.router.db_for_read(CapsForm), 'replica')
+
+    @override_settings(CAPS_REPLICAS=['broken'])
+    def test_unhealthy_replicas_are_left_out(self):
+        with replicas.use_replica():
+            self.assertEqual(self.router.db_for_read(CapsForm), None)
+        with self.settings(CAPS_REPLICAS=['broken', 'replica']):
+            with replicas.use_replica():
+                for i in range(10):
+                    self.assertEqual(self.router.db_for_read(CapsForm), 'replica')
+        self.assertFalse(replicas.healthy('broken'))
+        self.assertTrue(replicas.healthy('replica'))
+
+    @override_settings(CAPS_REPLICAS=['replica'])
+    def test_saving_keeps_the_browser_on_the_primary(self):
+        self.client.login(username='admin', password='secret')
+        self.client.cookies.pop(replicas.COOKIE_NAME, None)
+        response = self.client.get('/admin/caps/capsform/')
+        self.assertEqual([(form.case_id, form._state.db) for form in response.context['cl'].result_list],
+                         [('C0001', 'replica')])
+        self.assertNotIn(replicas.COOKIE_NAME, response.cookies)
+        self.assertFalse(replicas.is_pinned())
+        response = self.client.post('/admin/caps/capsform/{0}/'.format(self.form.pk),
+                                    admin_post_data(self.admin, case_id='C0001', height='170', version='1'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(replicas.COOKIE_NAME, response.cookies)
+        self.client.get('/admin/caps/capsform/')
+        self.assertTrue(replicas.is_pinned())
+
+    @override_settings(CAPS_REPLICAS=['replica'])
+    def test_streamed_export_reads_from_the_replica(self):
+        self.client.login(username='admin', password='secret')
+        self.client.cookies.pop(replicas.COOKIE_NAME, None)
+        read_from = []
+        rows = replicas.iterate_on_replica(iter(['line']))
+        response = self.client.get('/admin/caps/capsform/view/all/')
+        self.assertIn('C0001', response.content)
+        for row in rows:
+            read_from.append(self.router.db_for_read(CapsForm))
+        self.assertEqual(read_from, ['replica'])
+        self.assertEqual(self.router.db_for_read(CapsForm), None)
+
+
+class DrugSearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cocaine = Drug.objects.create(name='Cocaine', alternative_names='Coke, Charlie')
+        self.codeine = Drug.objects.create(name='Codeine', alternative_names='')
+        self.heroin = Drug.objects.create(name='Diamorphine', alternative_names='Heroin, Smack')
+
+    def results(self, text):
+        return [pk for pk, label in drugs.search(text)]
+
+    def test_prefix_substring_and_fuzzy_matches(self):
+        self.assertEqual(self.results('co'), [self.cocaine.pk, self.codeine.pk])
+        self.assertEqual(self.results('charl'), [self.cocaine.pk])
+        self.assertEqual(self.results('morph'), [self.heroin.pk])
+        self.assertEqual(self.results('heroine'), [self.heroin.pk])
+        self.assertEqual(self.results(''), [])
+
+    def test_index_is_cached_until_a_drug_changes(self):
+        drugs.search('co')
+        with self.assertNumQueries(0):
+            drugs.search('co')
+        self.codeine.name = 'Dihydrocodeine'
+        self.codeine.save()
+        self.assertEqual(self.results('dihydro'), [self.codeine.pk])
+
+    def test_search_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.get('/admin/caps/drug/search/', {'q': 'smack'})
+        self.assertEqual(json.loads(response.content),
+                         {'results': [{'id': self.heroin.pk, 'label': 'Diamorphine (Heroin, Smack)'}]})
+
+    def test_inline_renders_type_ahead_instead_of_select(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        form = make_form(make_user(), drug_use=True)
+        DrugUse.objects.create(drug=self.heroin, person=form, last_use_unknown=True)
+        response = self.client.get('/admin/caps/capsform/{0}/'.format(form.pk))
+        self.assertContains(response, 'value="Diamorphine (Heroin, Smack)"')
+        self.assertNotContains(response, '>Cocaine (Coke, Charlie)</option>')
+
+    def test_widget_renders_an_invalid_choice_without_a_label(self):
+        html = DrugAutocompleteWidget().render('drug', 'cocaine')
+        self.assertIn('value="cocaine"', html)
+        self.assertIn('data-url="/admin/caps/drug/search/" value=""', html)
+
+
+class SummaryTest(TestCase):
+    def counts(self):
+        return dict(((row.dimension, row.bucket), row.count) for row in SummaryCount.objects.filter(count__gt=0))
+
+    def test_counts_follow_saves_and_deletes(self):
+        user = make_user()
+        form = make_form(user, smoking='current', height=170, weight=Decimal('80.0'))
+        make_form(user, case_id='C0002', smoking='never', weight=Decimal('55.0'))
+        problem = PregnancyProblem.objects.create(form=form, type='eclampsia')
+        counts = self.counts()
+        self.assertEqual(counts[('total', 'all')], 2)
+        self.assertEqual(counts[('smoking', 'current')], 1)
+        self.assertEqual(counts[('height', '170-179')], 1)
+        self.assertEqual(counts[('bmi', 'Overweight (25 to 29.9)')], 1)
+        self.assertEqual(counts[('pregnancy_problem', 'eclampsia')], 1)
+
+        form.smoking = 'never'
+        form.save()
+        problem.type = 'sga'
+        problem.save()
+        counts = self.counts()
+        self.assertFalse(('smoking', 'current') in counts)
+        self.assertEqual(counts[('smoking', 'never')], 2)
+        self.assertEqual(counts[('pregnancy_problem', 'sga')], 1)
+
+        # Rebuilding from scratch gives the same answer as the incremental updates
+        summary.rebuild()
+        self.assertEqual(self.counts(), counts)
+
+        form.delete()
+        counts = self.counts()
+        self.assertEqual(counts[('total', 'all')], 1)
+        self.assertFalse(('pregnancy_problem', 'sga') in counts)
+
+    def test_drug_uses_follow_a_change_of_drug_type(self):
+        form = make_form(make_user(), drug_use=True)
+        drug = Drug.objects.create(name='Cocaine', alternative_names='', type='other')
+        DrugUse.objects.create(drug=drug, person=form, last_use_unknown=True)
+        DrugUse.objects.create(drug=drug, person=form, last_use_unknown=True)
+        drug.type = 'stimulant'
+        drug.save()
+        counts = self.counts()
+        self.assertEqual(counts[('drug_type', 'stimulant')], 2)
+        self.assertFalse(('drug_type', 'other') in counts)
+        summary.rebuild()
+        self.assertEqual(self.counts(), counts)
+
+    def test_summary_page(self):
+        make_form(make_user(), ethnic_group=13)
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.get('/admin/caps/capsform/summary/')
+        self.assertContains(response, '<td>African</td>')
+
+
+@skipUnless(quality.numpy is not None, 'The data quality report needs NumPy')
+class QualityReportTest(TestCase):
+    def test_report_flags_outliers_by_reporter(self):
+        careful, careless = make_user('careful'), make_user('careless')
+        for i, height in enumerate([160, 162, 164, 165, 166, 168, 170]):
+            make_form(careful, case_id='C{0:04d}'.format(i), height=height)
+        odd = make_form(careless, case_id='C0100', height=250, employed=True, occupation='')
+        result = quality.report()
+        self.assertEqual(result['forms'], 8)
+        height = result['measures']['height']
+        self.assertEqual(height['outliers'], 1)
+        self.assertEqual(height['worst'][0]['id'], odd.pk)
+        self.assertEqual(result['missing']['occupation_when_employed'], 1.0)
+        self.assertEqual(result['reporters'][0]['created_by'], careless.pk)
+        self.assertEqual(result['reporters'][0]['outlier_rate'], 1.0)
+        self.assertEqual(result['reporters'][1]['outlier_rate'], 0.0)
+
+    def test_mostly_zero_measures_fall_back_to_the_mean_absolute_deviation(self):
+        user = make_user()
+        forms = [make_form(user, case_id='C{0:04d}'.format(i), gravidity_24minus=gravidity)
+                 for i, gravidity in enumerate([0, 0, 0, 0, 0, 1, 2, 0, 0, 3])]
+        result = quality.report()
+        gravidity = result['measures']['gravidity_24minus']
+        # The MAD is 0, and only the 3 is far enough from the mean absolute deviation of 0.6
+        self.assertEqual(gravidity['outliers'], 1)
+        self.assertEqual(gravidity['worst'][0]['id'], forms[-1].pk)
+        self.assertAlmostEqual(gravidity['worst'][0]['z'], 3 / (1.2533 * 0.6), places=3)
+        self.assertEqual(result['measures']['gravidity_24plus']['outliers'], 0)
+        self.assertEqual(result['reporters'][0]['outlier_rate'], 0.1)
+        self.assertNotIn('Infinity', json.dumps(result))
+
+    def test_empty_study(self):
+        self.assertEqual(quality.report()['forms'], 0)
+
+
+@skipUnless(columnar.pyarrow is not None, 'The columnar export needs pyarrow')
+class ColumnarExportTest(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, table, columns):
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(os.path.join(self.directory, table), columns=columns).to_pydict()
+
+    def test_snapshots_are_typed_and_incremental(self):
+        first = make_form(self.user, case_id='C0001', previous_pregnancy_problem=None, cardiac_arrest=True,
+                          cardiac_arrest_date=timezone.now().date(), heart_disease=True)
+        HeartDisease.objects.create(form=first, type='other', details='Murmur')
+        written = columnar.snapshot(self.directory)
+        self.assertEqual((written['forms'], written['heart_disease']), (1, 1))
+        forms = self.read('forms', ['weight', 'ethnic_group', 'previous_pregnancy_problem', 'cardiac_arrest_date'])
+        self.assertEqual(forms['weight'], [Decimal('70.5')])
+        self.assertEqual(forms['ethnic_group'], [first.ethnic_group])
+        self.assertEqual(forms['previous_pregnancy_problem'], [None])
+        self.assertEqual(forms['cardiac_arrest_date'], [first.cardiac_arrest_date])
+        self.assertEqual(columnar.snapshot(self.directory), {})
+
+        second = make_form(self.user, case_id='C0002')
+        HeartDisease.objects.create(form=first, type='other', details='Added after the snapshot')
+        written = columnar.snapshot(self.directory)
+        self.assertEqual((written['forms'], written['heart_disease']), (1, 0))
+        self.assertEqual(sorted(self.read('forms', ['id'])['id']), [first.pk, second.pk])
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'forms'))), 2)
+        self.assertEqual(columnar.read_watermark(self.directory)['id'], second.pk)
+
+    def test_forms_committed_behind_the_watermark_are_picked_up(self):
+        first = make_form(self.user, case_id='C0001')
+        columnar.snapshot(self.directory)
+        # Created before the first snapshot, but only committed after it
+        late = make_form(self.user, case_id='C0002')
+        HeartDisease.objects.create(form=late, type='other', details='Murmur')
+        CapsForm.objects.filter(pk=late.pk).update(created_on=first.created_on - timedelta(minutes=1))
+        written = columnar.snapshot(self.directory)
+        self.assertEqual((written['forms'], written['heart_disease']), (1, 1))
+        self.assertEqual(sorted(self.read('forms', ['id'])['id']), [first.pk, late.pk])
+        self.assertEqual(columnar.snapshot(self.directory), {})
+        self.assertEqual([pk for pk, created_on in columnar.read_watermark(self.directory)['recent']],
+                         [first.pk, late.pk])
+
+    def test_choice_labels_are_kept_in_the_metadata(self):
+        make_form(self.user)
+        columnar.snapshot(self.directory)
+        import pyarrow.parquet
+        schema = pyarrow.parquet.read_schema(os.path.join(self.directory, 'forms', 'part-00001.parquet'))
+        codes = json.loads(schema.metadata['caps.choices'])
+        self.assertIn([1, 'British'], codes['ethnic_group'])
+        self.assertNotIn('employed', codes)
+
+
+@skipUnless(pdf.A4 is not None, 'The PDF print out needs ReportLab')
+class PdfTest(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_render_form_includes_the_histories(self):
+        form = make_form(self.user, previous_pregnancy_problem=True, gravidity_24plus=1, occupation=u'R&D <lab>')
+        PregnancyProblem.objects.create(form=form, type='other', details='Twins')
+        output = StringIO()
+        pdf.render_form(export_queryset().get(pk=form.pk), output)
+        self.assertTrue(output.getvalue().startswith('%PDF'))
+        self.assertEqual(pdf.history_rows(form, 'previous_pregnancy_history'), [(u'Other', u'Twins')])
+        self.assertEqual(pdf.display_value(form, 'smoking'), u'Never')
+        self.assertEqual(pdf.display_value(form, 'created_by'), u'Ann Reporter')
+
+    def test_batch_renders_into_one_zip_and_reports_progress(self):
+        ids = [make_form(self.user, case_id='C{0:04d}'.format(i)).pk for i in range(3)]
+        batch = PdfBatch(created_by=self.user)
+        batch.set_form_ids(ids)
+        batch.save()
+        with self.settings(CAPS_PDF_ROOT=self.directory):
+            pdf.run_batch(batch, processes=1)
+            batch = PdfBatch.objects.get(pk=batch.pk)
+            self.assertEqual((batch.status, batch.done, batch.percent()), ('done', 3, 100))
+            archive = zipfile.ZipFile(pdf.archive_path(batch))
+            self.assertEqual(sorted(archive.namelist()),
+                             ['caps-C{0:04d}-{1}.pdf'.format(i, pk) for i, pk in enumerate(ids)])
+
+            User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+            self.client.login(username='admin', password='secret')
+            url = '/admin/caps/pdfbatch/{0}/progress/?format=json'.format(batch.pk)
+            progress = json.loads(self.client.get(url).content)
+            self.assertEqual(progress['percent'], 100)
+            response = self.client.get(progress['download_url'])
+            self.assertEqual(response['Content-Type'], 'application/zip')
+
+    def test_missing_reportlab_fails_the_batch_rather_than_leaving_it_pending(self):
+        form = make_form(self.user)
+        batch = PdfBatch(created_by=self.user)
+        batch.set_form_ids([form.pk])
+        batch.save()
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        a4, pdf.A4 = pdf.A4, None
+        try:
+            # The command's error ends the process, as it does from manage.py
+            self.assertRaises(SystemExit, call_command, 'caps_render_pdfs', str(batch.pk), stderr=StringIO())
+            response = self.client.post('/admin/caps/capsform/', {'action': 'print_pdf', '_selected_action': [form.pk]},
+                                        follow=True)
+        finally:
+            pdf.A4 = a4
+        self.assertEqual(PdfBatch.objects.get(pk=batch.pk).status, 'failed')
+        self.assertEqual(PdfBatch.objects.count(), 1)
+        self.assertContains(response, 'needs ReportLab')
+
+
+class ApiTest(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+
+    def get(self, url, **extra):
+        response = self.client.get(url, **extra)
+        return response, json.loads(response.content) if response.content else None
+
+    def test_pages_follow_the_cursor_with_sparse_fields(self):
+        forms = [make_form(self.user, case_id='C{0:04d}'.format(i)) for i in range(5)]
+        response, data = self.get('/api/v1/forms/?limit=2&fields=id,case_id,smoking_display')
+        self.assertEqual(data['results'][0], {'id': forms[-1].pk, 'case_id': 'C0004', 'smoking_display': 'Never'})
+        seen = [row['id'] for row in data['results']]
+        while data['next']:
+            response, data = self.get(data['next'])
+            seen.extend(row['id'] for row in data['results'])
+        self.assertEqual(seen, [form.pk for form in reversed(forms)])
+        self.assertTrue(data['previous'])
+
+    def test_histories_are_nested_and_filters_match_the_changelist(self):
+        form = make_form(self.user, smoking='current', previous_pregnancy_problem=True, gravidity_24plus=1)
+        make_form(self.user, case_id='C0002')
+        PregnancyProblem.objects.create(form=form, type='other', details='Twins')
+        response, data = self.get('/api/v1/forms/?smoking=Current&fields=id,previous_pregnancy_history')
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['results'][0]['previous_pregnancy_history'][0]['details'], 'Twins')
+        url = '/api/v1/forms/?created_by={0}&previous_pregnancy_problem=null'.format(self.user.pk)
+        response, data = self.get(url)
+        self.assertEqual([row['case_id'] for row in data['results']], ['C0002'])
+        response, data = self.get('/api/v1/forms/?fields=nonsense')
+        self.assertEqual(response.status_code, 400)
+        response, data = self.get('/api/v1/forms/?smokng=current')
+        self.assertEqual(response.status_code, 400)
+
+    def test_unchanged_pages_are_not_modified(self):
+        form = make_form(self.user)
+        response = self.client.get('/api/v1/forms/')
+        # Only the session, the user and the page of key columns are read before answering 304
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get('/api/v1/forms/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        PregnancyProblem.objects.create(form=form, type='eclampsia')
+        self.assertEqual(self.client.get('/api/v1/forms/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+        url = '/api/v1/forms/{0}/'.format(form.pk)
+        response = self.client.get(url)
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get('/api/v1/forms/0/').status_code, 404)
+
+    def test_staff_only_with_basic_authentication(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/v1/forms/').status_code, 401)
+        credentials = 'Basic ' + base64.b64encode('admin:secret')
+        self.assertEqual(self.client.get('/api/v1/forms/', HTTP_AUTHORIZATION=credentials).status_code, 200)
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.records.append(json.loads(record.getMessage()))
+        logging.getLogger('caps.requests').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('caps.requests').removeHandler(self.handler)
+
+    def test_sampled_requests_record_queries_templates_and_repeats(self):
+        user = make_user()
+        with self.settings(CAPS_INSTRUMENT_SAMPLE_RATE=1, CAPS_INSTRUMENT_REPEAT_THRESHOLD=5):
+            middleware = InstrumentationMiddleware()
+        request = RequestFactory().get('/admin/caps/capsform/summary/')
+        middleware.process_request(request)
+        for i in range(6):
+            User.objects.get(pk=user.pk)
+        Template('{% for i in items %}{{ i }}{% endfor %}').render(Context({'items': range(3)}))
+        middleware.process_response(request, HttpResponse())
+        record = self.records[-1]
+        self.assertEqual((record['endpoint'], record['queries'], record['sampled']), ('caps_summary', 6, True))
+        self.assertEqual(record['repeated'][0]['count'], 6)
+        self.assertIn('auth_user', record['repeated'][0]['sql'])
+        self.assertTrue(record['template_ms'] >= 0)
+        # The connection is back to its usual cursor
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_query_log_is_kept_for_sampled_requests(self):
+        with self.settings(CAPS_INSTRUMENT_SAMPLE_RATE=1):
+            middleware = InstrumentationMiddleware()
+        request = RequestFactory().get('/')
+        self.assertEqual(count_queries(lambda: (middleware.process_request(request), User.objects.count(),
+                                                middleware.process_response(request, HttpResponse()))), 1)
+        self.assertEqual(self.records[-1]['queries'], 1)
+
+    def test_unsampled_requests_are_only_logged_when_slow(self):
+        with self.settings(CAPS_INSTRUMENT_SAMPLE_RATE=0, CAPS_INSTRUMENT_SLOW_MS=0):
+            middleware = InstrumentationMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual((self.records[-1]['endpoint'], self.records[-1]['sampled']), ('home', False))
+        self.assertNotIn('queries', self.records[-1])
+
+    def test_report_lists_the_worst_endpoints(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'requests.log')
+            with open(path, 'w') as f:
+                for wall_ms in (10, 20, 3000):
+                    f.write(json.dumps({'endpoint': 'caps_capsform_changelist', 'wall_ms': wall_ms, 'sampled': True,
+                                        'queries': 60, 'query_ms': 5, 'template_ms': 2,
+                                        'repeated': [{'sql': 'SELECT 1', 'count': 50, 'ms': 3}]}) + '\n')
+                f.write(json.dumps({'endpoint': 'home', 'wall_ms': 5, 'sampled': False}) + '\n')
+            output = StringIO()
+            call_command('caps_request_report', log=path, stdout=output)
+            lines = output.getvalue().splitlines()
+            self.assertTrue(lines[1].startswith('caps_capsform_changelist'))
+            self.assertIn('up to 50 times per request, in 3 requests: SELECT 1', output.getvalue())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_report_takes_the_percentiles_from_the_sample_alone(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'requests.log')
+            with open(path, 'w') as f:
+                for wall_ms in range(10, 30):
+                    f.write(json.dumps({'endpoint': 'home', 'wall_ms': wall_ms, 'sampled': True, 'sample_rate': 0.05,
+                                        'slow': False, 'queries': 1, 'query_ms': 1, 'template_ms': 1,
+                                        'repeated': []}) + '\n')
+                # Every slow request is logged, not just the sampled ones
+                for wall_ms in (2000, 3000, 4000, 5000):
+                    f.write(json.dumps({'endpoint': 'home', 'wall_ms': wall_ms, 'sampled': False, 'sample_rate': 0.05,
+                                        'slow': True}) + '\n')
+            output = StringIO()
+            call_command('caps_request_report', log=path, stdout=output)
+            self.assertEqual(output.getvalue().splitlines()[1].split(),
+                             ['home', '400', '20.0', '28.0', '29.0', '4', '5000.0', '1.0', '1.0', '1.0'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class BenchmarkTest(TestCase):
+    fixtures = ['Drugs']
+
+    def test_synthetic_study_is_valid_and_repeatable(self):
+        generator = benchmark.setup_study(seed=1)
+        self.assertEqual(benchmark.grow_study(generator, 50), 50)
+        self.assertEqual(CapsForm.objects.count(), 50)
+        self.assertEqual(benchmark.grow_study(generator, 20), 0)
+        first, second = benchmark.setup_study(seed=2), benchmark.setup_study(seed=2)
+        self.assertEqual(list(first.records(3)), list(second.records(3)))
+
+    def test_measure_counts_queries(self):
+        make_user()
+        result = benchmark.measure('users', lambda: [list(User.objects.all()) for i in range(3)], repeat=2)
+        self.assertEqual((result['benchmark'], result['queries']), ('users', 3))
+        self.assertTrue(result['seconds'] >= 0 and result['maxrss_kb'] > 0)
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_simulated_requests_close_their_connections(self):
+        closed = []
+        wrapper = connections['default']
+        wrapper.close = lambda: closed.append(True)
+        try:
+            benchmark.simulate_requests(3)
+        finally:
+            del wrapper.close
+        self.assertEqual(len(closed), 3)
+
+
+def rollback(connection):
+    connection.rollback()
+
+
+def select_one(connection):
+    connection.execute('SELECT 1').fetchone()
+
+
+class PoolTest(TestCase):
+    def make_pool(self, **kwargs):
+        return pool.Pool(lambda: sqlite3.connect(':memory:', check_same_thread=False), **kwargs)
+
+    def test_connections_are_reused(self):
+        pooled = self.make_pool(max_size=2)
+        first = pooled.get()
+        pooled.put(first)
+        self.assertIs(pooled.get(), first)
+        second = pooled.get()
+        self.assertIsNot(second, first)
+        stats = pooled.stats()
+        self.assertEqual((stats['connects'], stats['checkouts'], stats['in_use'], stats['size']), (2, 3, 2, 2))
+
+    def test_waits_for_a_connection_to_be_given_back(self):
+        pooled = self.make_pool(max_size=1, timeout=0.05)
+        first = pooled.get()
+        self.assertRaises(pool.PoolTimeout, pooled.get)
+        self.assertEqual((pooled.stats()['timeouts'], pooled.stats()['waits']), (1, 1))
+        pooled.timeout = 5
+        giver = threading.Timer(0.05, pooled.put, [first])
+        giver.start()
+        self.assertIs(pooled.get(), first)
+        giver.join()
+        stats = pooled.stats()
+        self.assertEqual((stats['waits'], stats['connects']), (2, 1))
+        self.assertTrue(stats['max_wait_seconds'] > 0)
+
+    def test_old_and_broken_connections_are_replaced(self):
+        pooled = self.make_pool(max_lifetime=0)
+        first = pooled.get()
+        pooled.put(first)
+        self.assertIsNot(pooled.get(), first)
+        self.assertEqual(pooled.stats()['closes'], 1)
+
+        pooled = self.make_pool(check=select_one, check_interval=0)
+        first = pooled.get()
+        pooled.put(first)
+        first.close()
+        second = pooled.get()
+        self.assertIsNot(second, first)
+        self.assertEqual(pooled.stats()['failed_checks'], 1)
+        pooled.put(second)
+        self.assertIs(pooled.get(), second)
+
+    def test_connections_are_reset_when_given_back(self):
+        pooled = self.make_pool(reset=rollback)
+        first = pooled.get()
+        first.execute('CREATE TABLE t (x INTEGER)')
+        first.execute('INSERT INTO t VALUES (1)')
+        pooled.put(first)
+        self.assertIs(pooled.get(), first)
+        self.assertEqual(first.execute('SELECT COUNT(*) FROM t').fetchone(), (0,))
+        first.close()
+        pooled.put(first)
+        self.assertEqual((pooled.stats()['failed_resets'], pooled.stats()['size']), (1, 0))
+
+    def test_idle_connections_are_closed_down_to_min_size(self):
+        pooled = self.make_pool(min_size=1, max_idle=0)
+        pooled.fill()
+        self.assertEqual((pooled.stats()['connects'], pooled.stats()['idle']), (1, 1))
+        first, second = pooled.get(), pooled.get()
+        pooled.put(first)
+        pooled.put(second)
+        stats = pooled.stats()
+        self.assertEqual((stats['size'], stats['idle'], stats['closes']), (1, 1, 1))
+
+    def test_closing_the_pool(self):
+        pooled = pool.get_pool('test', lambda: self.make_pool())
+        self.assertIs(pool.get_pool('test', None), pooled)
+        idle, in_use = pooled.get(), pooled.get()
+        pooled.put(idle)
+        self.assertEqual(pool.stats()['test']['in_use'], 1)
+        pool.close_pool('test')
+        self.assertNotIn('test', pool.stats())
+        self.assertEqual(pooled.stats()['size'], 1)
+        pooled.put(in_use)
+        self.assertEqual((pooled.stats()['size'], pooled.stats()['closes']), (0, 2))
+        self.assertRaises(sqlite3.ProgrammingError, in_use.execute, 'SELECT 1')
+
+    @skipUnless(psycopg2 is not None, 'The pooled backend needs psycopg2')
+    def test_pooled_backend_gets_the_postgresql_sql(self):
+        engine = 'caps.backends.pooled.postgresql_psycopg2'
+        pooled = load_backend(engine).DatabaseWrapper(dict(connection.settings_dict, ENGINE=engine), 'pooled')
+        search_sql = u' '.join(custom_sql_for_model(SearchDocument, no_style(), pooled))
+        self.assertIn('ADD COLUMN vector tsvector', search_sql)
+        self.assertIn('CREATE TRIGGER caps_searchdocument_vector', search_sql)
+        self.assertIn('gin_trgm_ops', u' '.join(custom_sql_for_model(Drug, no_style(), pooled)))
+
+    def test_stats_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        pooled = pool.get_pool('test', lambda: self.make_pool())
+        try:
+            pooled.put(pooled.get())
+            response = self.client.get('/admin/caps/pool/')
+            self.assertEqual(json.loads(response.content)['test']['checkouts'], 1)
+        finally:
+            pool.close_pool('test')
+
+
+class CacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = make_user()
+        # A file based cache, shared between processes as the form regions need
+        self.directory = tempfile.mkdtemp()
+        self.shared = override_settings(CAPS_SHARED_CACHE='shared', CACHES=dict(settings.CACHES, shared={
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': self.directory}))
+        self.shared.enable()
+
+    def tearDown(self):
+        self.shared.disable()
+        shutil.rmtree(self.directory)
+
+    def test_local_and_shared_tiers_with_counters(self):
+        region = caps_cache.Region('test', local=True)
+        built = []
+        build = lambda: built.append(1) or len(built)
+        self.assertEqual((region.get('key', build), region.get('key', build)), (1, 1))
+        caps_cache._local.clear()
+        self.assertEqual(region.get('key', build), 1)
+        region.invalidate()
+        self.assertEqual(region.get('key', build), 2)
+        self.assertEqual(region.stats, {'local_hits': 1, 'shared_hits': 1, 'misses': 2, 'invalidations': 1})
+        self.assertEqual(caps_cache.stats()['test']['hit_rate'], 0.5)
+        del caps_cache.REGIONS['test']
+
+    def test_local_regions_are_kept_briefly_in_a_cache_kept_by_each_process(self):
+        region = caps_cache.Region('test', local=True)
+        built = []
+        build = lambda: built.append(1) or len(built)
+        real_time = time.time
+        try:
+            with self.settings(CAPS_SHARED_CACHE='default'):
+                self.assertEqual((region.get('key', build), region.get('key', build)), (1, 1))
+                # Another process may have changed what it was built from, and had no way to drop it here
+                time.time = lambda: real_time() + caps_cache.UNSHARED_TIMEOUT + 1
+                self.assertEqual(region.get('key', build), 2)
+            time.time = real_time
+            self.assertEqual((region.get('key', build), region.get('key', build)), (3, 3))
+            time.time = lambda: real_time() + caps_cache.UNSHARED_TIMEOUT + 1
+            self.assertEqual(region.get('key', build), 3)
+        finally:
+            time.time = real_time
+            del caps_cache.REGIONS['test']
+
+    def test_creator_counts_are_cached_in_a_cache_kept_by_each_process(self):
+        make_form(self.user)
+        with self.settings(CAPS_SHARED_CACHE='default'):
+            self.assertEqual(filters.creator_counts(), [(self.user.pk, u'Ann Reporter', 1)])
+            with self.assertNumQueries(0):
+                filters.creator_counts()
+
+    def test_form_regions_need_a_cache_shared_between_processes(self):
+        make_form(self.user)
+        self.assertTrue(caps_cache.shared_between_processes())
+        with self.settings(CAPS_SHARED_CACHE='default'):
+            self.assertFalse(caps_cache.shared_between_processes())
+            list(export.iter_cached_csv_rows())
+            # Built every time, as a save in another process couldn't drop them
+            with self.assertNumQueries(2 + 5):
+                list(export.iter_cached_csv_rows())
+
+    def test_csv_lines_are_cached_until_their_form_changes(self):
+        first = make_form(self.user, case_id='C0001')
+        second = make_form(self.user, case_id='C0002', previous_pregnancy_problem=True, gravidity_24plus=1)
+        expected = list(export.iter_csv_rows(export.iter_forms()))
+        self.assertEqual(list(export.iter_cached_csv_rows()), expected)
+        # Just the ids, and the final empty chunk
+        with self.assertNumQueries(2):
+            self.assertEqual(list(export.iter_cached_csv_rows()), expected)
+        PregnancyProblem.objects.create(form=second, type='eclampsia')
+        self.user.last_name = 'Renamed'
+        self.user.save()
+        rows = list(export.iter_cached_csv_rows())
+        self.assertIn('Eclampsia', rows[2])
+        self.assertIn('Ann Renamed', rows[1])
+        first.delete()
+        self.assertEqual(len(list(export.iter_cached_csv_rows())), 2)
+
+    def test_logins_leave_the_form_regions_alone(self):
+        make_form(self.user)
+        list(export.iter_cached_csv_rows())
+        self.user.last_login = timezone.now()
+        self.user.save()
+        with self.assertNumQueries(2):
+            list(export.iter_cached_csv_rows())
+
+    def test_created_by_select_is_cached(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        self.client.get('/admin/caps/capsform/add/')
+        misses = caps_cache.REGIONS['users'].stats['misses']
+        response = self.client.get('/admin/caps/capsform/add/')
+        self.assertContains(response, '<option value="{0}">reporter</option>'.format(self.user.pk))
+        self.assertEqual(caps_cache.REGIONS['users'].stats['misses'], misses)
+        make_user('newcomer')
+        self.assertContains(self.client.get('/admin/caps/capsform/add/'), '>newcomer</option>')
+
+
+class FollowUpTest(TestCase):
+    def setUp(self):
+        self.user = make_user(email='ann@example.com')
+        self.now = timezone.now()
+
+    def due_form(self, days_ago, **kwargs):
+        # A form whose follow-up came due days_ago days ago
+        due_date = (timezone.localtime(self.now) - followup.FOLLOW_UP_DELAY - timedelta(days=days_ago + 1)).date()
+        return make_form(kwargs.pop('user', self.user), expected_due_date=due_date, **kwargs)
+
+    def test_follow_up_follows_the_due_date(self):
+        form = make_form(self.user, expected_due_date=date(2012, 6, 1))
+        follow_up = FollowUp.objects.get(form=form)
+        self.assertEqual(timezone.localtime(follow_up.due_on).date(), date(2012, 6, 15))
+        self.assertEqual(follow_up.status, 'pending')
+        form.expected_due_date = date(2012, 7, 1)
+        form.save()
+        self.assertEqual(timezone.localtime(FollowUp.objects.get(form=form).due_on).date(), date(2012, 7, 15))
+        form.expected_due_date = None
+        form.save()
+        self.assertEqual(FollowUp.objects.get(form=form).status, 'cancelled')
+        make_form(self.user, case_id='C0002')
+        self.assertEqual(FollowUp.objects.count(), 1)
+
+    def test_the_same_date_given_again_is_queued_again(self):
+        form = make_form(self.user, expected_due_date=date(2012, 6, 1))
+        form.expected_due_date = None
+        form.save()
+        form.expected_due_date = date(2012, 6, 1)
+        form.save()
+        self.assertEqual(sorted(FollowUp.objects.values_list('status', flat=True)), ['cancelled', 'pending'])
+
+    def test_a_reminder_sent_on_a_retry_is_not_queued_again(self):
+        form = self.due_form(1)
+
+        class FailingBackend(followup.BaseBackend):
+            def send(self, follow_up):
+                raise IOError('Mail server unavailable')
+
+        followup.send_batch('worker', FailingBackend(), now=self.now)
+        self.assertEqual(followup.send_batch('worker', followup.get_backend(), now=self.now + followup.RETRY_DELAY),
+                         (1, 0))
+        form.height = 170
+        form.save()
+        self.assertEqual(list(FollowUp.objects.values_list('status', 'expected_due_date')),
+                         [('sent', form.expected_due_date)])
+
+    def test_due_reminders_are_sent_once(self):
+        first, second = self.due_form(2), self.due_form(1, case_id='C0002')
+        make_form(self.user, case_id='C0003', expected_due_date=self.now.date())
+        output = StringIO()
+        call_command('caps_send_followups', stdout=output)
+        self.assertEqual(output.getvalue(), 'Sent 2 follow-up reminders, 0 failed\n')
+        self.assertEqual([message.subject for message in mail.outbox],
+                         ['CAPS follow-up due for case C0001', 'CAPS follow-up due for case C0002'])
+        self.assertIn('/admin/caps/capsform/{0}/'.format(first.pk), mail.outbox[0].body)
+        self.assertEqual(FollowUp.objects.filter(status='sent').count(), 2)
+        self.assertEqual(followup.send_batch('worker', followup.get_backend()), (0, 0))
+
+    def test_workers_claim_different_follow_ups(self):
+        for i in range(3):
+            self.due_form(i, case_id='C{0:04d}'.format(i))
+        first = followup.claim('first', batch_size=2)
+        second = followup.claim('second', batch_size=2)
+        self.assertEqual((len(first), len(second)), (2, 1))
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(followup.claim('third'), [])
+        # A claim that has run out goes back in the queue
+        later = timezone.now() + followup.CLAIM_TIMEOUT + timedelta(minutes=1)
+        self.assertEqual(len(followup.claim('third', now=later)), 3)
+
+    def test_failures_are_retried_unless_permanent(self):
+        self.due_form(1, user=make_user('noemail'))
+        self.due_form(1, case_id='C0002')
+
+        class FlakyBackend(followup.EmailBackend):
+            def send(self, follow_up):
+                if follow_up.form.case_id == 'C0002':
+                    raise IOError('Mail server unavailable')
+                super(FlakyBackend, self).send(follow_up)
+
+        self.assertEqual(followup.send_batch('worker', FlakyBackend(), now=self.now), (0, 2))
+        failed, retry = FollowUp.objects.order_by('form__case_id')
+        self.assertEqual((failed.status, failed.error), ('failed', 'noemail has no email address'))
+        self.assertEqual((retry.status, retry.attempts), ('pending', 1))
+        self.assertEqual(retry.due_on, self.now + followup.RETRY_DELAY)
+
+    def test_imported_forms_are_queued(self):
+        importer = Importer()
+        importer.run([{'case_id': 'I0001', 'created_by': 'reporter', 'year_of_birth': 1980, 'ethnic_group': 1,
+                       'marital_status': 'single', 'employed': False, 'height': 165, 'weight': '70.0',
+                       'smoking': 'never', 'expected_due_date': '2012-06-01'}])
+        self.assertEqual(importer.errors, [])
+        self.assertEqual(FollowUp.objects.get().form.case_id, 'I0001')
@@ -0,0 +1,92 @@
+# coding=utf-8
+"""
+The cross-field rules for a CAPS form, written against in-memory data so they can be run without touching the
+database: the form is an (unsaved or changed) CapsForm instance, and the histories are the lists of PregnancyProblem,
+HeartDisease, MedicalProblem and DrugUse objects that are about to be saved along with it.
+
+As well as reporting errors, the rules correct the summary flags on the form where the histories make the answer
+obvious, e.g. entering a heart disease history means heart_disease must be True.
+"""
+from django.core.exceptions import ValidationError
+
+# Related name of each history on CapsForm, and the summary flag on the form that it answers
+PREGNANCY = 'previous_pregnancy_history'
+HEART = 'heart_disease_history'
+MEDICAL = 'previous_medical_history'
+DRUGS = 'drug_history'
+HISTORY_FLAGS = (
+    (PREGNANCY, 'previous_pregnancy_problem'),
+    (HEART, 'heart_disease'),
+    (MEDICAL, 'previous_medical_problem'),
+    (DRUGS, 'drug_use'),
+)
+
+
+def check_form(form):
+    """
+    Rules that only need the values on the form itself. Returns a list of error messages.
+    """
+    errors = []
+    # Test employed status and ensure there's occupation information when expected
+    if form.employed and not form.occupation:
+        errors.append(u'Section 1: Please enter occupation details for the woman')
+    # If there are previous cardiac arrests, ensure a date has been entered
+    if form.cardiac_arrest and form.cardiac_arrest_date is None:
+        errors.append(u'Section 3: Please enter the date of the most recent cardiac arrest')
+    # Autocorrect the cardiac arrest history
+    if not form.cardiac_arrest and form.cardiac_arrest_date is not None:
+        form.cardiac_arrest = True
+    return errors
+
+
+def check_history(form, name, entries):
+    """
+    Rules that tie one of the histories to the answers on the form. Returns a list of error messages.
+    """
+    errors = []
+    if name == PREGNANCY:
+        no_pregnancies = form.gravidity_24minus == 0 and form.gravidity_24plus == 0
+        # If previous pregnancy problems have been entered, then ensure gravidity count and pregnancy_problem are set
+        if entries:
+            form.previous_pregnancy_problem = True
+        elif form.previous_pregnancy_problem:
+            errors.append(u'Section 2: Please enter more information about previous pregnancy problems.')
+        if form.previous_pregnancy_problem and no_pregnancies:
+            errors.append(u'Section 2: No previous pregnancies have been entered. '
+                          u'Please correct the number of previous pregnancies.')
+        # If there were previous pregnancies, remind them to answer the past problems question
+        if not no_pregnancies and form.previous_pregnancy_problem is None:
+            errors.append(u'Section 2: Please indicate whether there were any previous pregnancy problems')
+    elif name == HEART:
+        if entries:
+            form.heart_disease = True
+        elif form.heart_disease:
+            errors.append(u'Section 3: Please specify more information about pre-disposing factors for heart disease.')
+    elif name == MEDICAL:
+        if entries:
+            form.previous_medical_problem = True
+        elif form.previous_medical_problem:
+            errors.append(u'Section 3: Please specify a pre-existing or previous medical condition')
+    elif name == DRUGS:
+        if entries:
+            form.drug_use = True
+        elif form.drug_use:
+            errors.append(u'Section 3: Please specify at least one drug used by the woman')
+        for entry in entries:
+            if entry.last_use is None and not entry.last_use_unknown:
+                errors.append(u'Section 3: Please specify a date for this drug use, '
+                              u'or tick the box to say the timing is unknown')
+                break
+    return errors
+
+
+def validate(form, histories):
+    """
+    Run every rule in one pass over the form and a dictionary mapping each history's related name to its list of
+    entries, raising a single ValidationError listing every problem found.
+    """
+    errors = check_form(form)
+    for name, flag in HISTORY_FLAGS:
+        errors.extend(check_history(form, name, histories.get(name, ())))
+    if errors:
+        raise ValidationError(errors)
@@ -1,7 +1,13 @@
+import json
+import os
 from django.contrib.admin.views.decorators import staff_member_required
-from django.shortcuts import render_to_response
+from django.core.servers.basehttp import FileWrapper
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, Http404
+from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
-from caps.models import CapsForm
+from caps import cache, drugs, export, pdf, pool, replicas, summary, xlsx
+from caps.models import PdfBatch
 
 # Create your views here.
 def home(request):
@@ -13,11 +19,101 @@ def home(request):
 @staff_member_required
 def admin_view_all_csv(request):
     """
-    Display a listing of all CAPS reports as a CSV file, but restrict to staff members
+    Stream a listing of all CAPS reports as a CSV file, but restrict to staff members. The rows are read from a
+    replica as they are streamed.
     """
-    listing = CapsForm.objects.all().select_related()
+    return export.csv_response(replicas.iterate_on_replica(export.iter_cached_csv_rows()))
+
+@staff_member_required
+def admin_view_all_xlsx(request):
+    """
+    Stream all CAPS reports as an Excel workbook, with a sheet for the forms and one for each history, read from a
+    replica as it is streamed
+    """
+    return xlsx.xlsx_response(replicas.iterate_on_replica(xlsx.caps_workbook().stream()))
+
+@staff_member_required
+def drug_search(request):
+    """
+    Type-ahead lookup of the drug dictionary for the drug use inline, returning the matching drugs as JSON
+    """
+    results = [{'id': pk, 'label': label} for pk, label in drugs.search(request.GET.get('q', ''))]
+    return HttpResponse(json.dumps({'results': results}), content_type='application/json')
+
+@staff_member_required
+def cache_stats(request):
+    """
+    Hits, misses and invalidations of each cache region in the process serving the request, for tuning the cache
+    """
+    return HttpResponse(json.dumps(cache.stats(), indent=2), content_type='application/json')
+
+@staff_member_required
+def pool_stats(request):
+    """
+    Connections, checkouts and waits of each database connection pool in the process serving the request, for sizing
+    the pools (see caps.backends.pooled.postgresql_psycopg2)
+    """
+    return HttpResponse(json.dumps(pool.stats(), indent=2), content_type='application/json')
+
+@staff_member_required
+@replicas.use_replica()
+def admin_summary(request):
+    """
+    On screen summary of the form data, read from the materialised counts
+    """
+    counts = summary.summary()
+    sections = [
+        ('Forms', counts[summary.TOTAL]),
+        ('Forms by month entered', counts[summary.ACCRUAL]),
+        ('Ethnic group', counts[summary.ETHNIC_GROUP]),
+        ('Marital status', counts[summary.MARITAL_STATUS]),
+        ('Smoking status', counts[summary.SMOKING]),
+        ('Height at booking (cm)', counts[summary.HEIGHT]),
+        ('Weight at booking (kg)', counts[summary.WEIGHT]),
+        ('BMI at booking', counts[summary.BMI]),
+        ('Previous pregnancy problems', counts['pregnancy_problem']),
+        ('Heart disease history', counts['heart_disease']),
+        ('Previous medical problems', counts['medical_problem']),
+        ('Drug use by drug type', counts[summary.DRUG_TYPE]),
+    ]
     return render_to_response(
-        'admin/list-caps.csv',
-        { 'listing':listing },
+        'admin/caps/capsform/summary.html',
+        {'sections': sections, 'title': 'Summary of CAPS forms'},
         context_instance=RequestContext(request)
     )
+
+@staff_member_required
+def pdf_progress(request, batch_id):
+    """
+    Follow the progress of a PDF batch. The page polls itself for the JSON version (?format=json) until it is done.
+    """
+    batch = get_object_or_404(PdfBatch, pk=batch_id)
+    if request.GET.get('format') == 'json':
+        data = {
+            'status': batch.status,
+            'status_display': batch.get_status_display(),
+            'done': batch.done,
+            'total': batch.total,
+            'percent': batch.percent(),
+            'download_url': reverse('caps_pdf_download', args=[batch.pk]) if batch.status == 'done' else None,
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+    return render_to_response(
+        'admin/caps/pdfbatch/progress.html',
+        {'batch': batch, 'title': 'Printing %d forms as PDF' % batch.total},
+        context_instance=RequestContext(request)
+    )
+
+@staff_member_required
+def pdf_download(request, batch_id):
+    """
+    Download the zip of PDFs from a completed batch, streamed from disk
+    """
+    batch = get_object_or_404(PdfBatch, pk=batch_id, status='done')
+    path = pdf.archive_path(batch)
+    if not os.path.exists(path):
+        raise Http404
+    response = HttpResponse(FileWrapper(open(path, 'rb')), content_type='application/zip')
+    response['Content-Length'] = os.path.getsize(path)
+    response['Content-Disposition'] = 'attachment; filename="{0}"'.format(batch.archive)
+    return response
@@ -0,0 +1,28 @@
+from django import forms
+from django.core.urlresolvers import reverse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from caps import drugs
+
+
+class DrugAutocompleteWidget(forms.HiddenInput):
+    """
+    Type-ahead replacement for the Drug <select>. The chosen drug's id is kept in a hidden input, and a text box next to
+    it fetches matching drugs from the drug search view as the user types, so the page never lists the whole
+    dictionary. The label for an existing choice comes from the cached drug index rather than a query.
+    """
+    # Shown in its own column on the tabular inline, rather than tucked away with the hidden fields
+    is_hidden = False
+
+    class Media:
+        js = ('caps/js/drug_autocomplete.js',)
+
+    def render(self, name, value, attrs=None):
+        hidden = super(DrugAutocompleteWidget, self).render(name, value, attrs)
+        try:
+            label = drugs.get_index().label(int(value)) if value else u''
+        except (TypeError, ValueError):
+            # An invalid submission being shown again
+            label = u''
+        return mark_safe(u'{0}<input type="text" class="vTextField drug-autocomplete" autocomplete="off" '
+                         u'data-url="{1}" value="{2}" />'.format(hidden, reverse('caps_drug_search'), escape(label)))
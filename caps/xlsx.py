@@ -0,0 +1,396 @@
+# coding=utf-8
+"""
+Excel (XLSX) export of the CAPS data, with one sheet per entity: the forms, and each of the four histories.
+
+An XLSX file is a zip of XML parts. Rather than build the workbook in memory (or on disk) and then send it, the zip is
+written as a stream: each part is deflated as it is generated and the sizes and checksum that zip normally puts in
+front of the data are sent after it in a data descriptor instead. Rows are read from the database in chunks, so memory
+use stays the same however many forms there are.
+
+Text that repeats from row to row (the choice labels, Yes/No answers, drug names) is written once to the shared
+strings table and referred to by index, which keeps the sheets small. Free text is written inline in the cell, so the
+shared strings table only grows with the number of distinct labels, not with the number of rows.
+"""
+import re
+import struct
+import time
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.encoding import force_unicode
+from caps import choices
+from caps.export import iter_chunks
+from caps.models import CapsForm, Drug, DrugUse, PregnancyProblem, HeartDisease, MedicalProblem
+
+CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Generated output is collected up to this many bytes before being handed on, to avoid lots of tiny writes
+BUFFER_SIZE = 64 * 1024
+
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+# Characters that aren't allowed in XML 1.0 at all, so are dropped from any text
+ILLEGAL_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Style indexes into the cellXfs of STYLES_XML
+DATE_STYLE = 1
+DATETIME_STYLE = 2
+
+
+class Label(unicode):
+    """
+    Text that repeats across rows (e.g. a choice label), which is written once to the shared strings table
+    """
+
+
+class ZipStream(object):
+    """
+    Write a zip archive as a series of byte strings, without needing to seek back to fill in the sizes of each file.
+    Files are deflated as they are added, and the archive is finished off by close().
+    """
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    def add(self, name, parts):
+        """
+        Yield the zip data for a file with the given name, whose content is given by the iterable of byte strings parts
+        """
+        name = name.encode('utf-8')
+        modified = time.localtime()[:6]
+        dos_time = (modified[3] << 11) | (modified[4] << 5) | (modified[5] // 2)
+        dos_date = ((modified[0] - 1980) << 9) | (modified[1] << 5) | modified[2]
+        header_offset = self.offset
+        # General purpose flag 0x08: the crc and sizes follow the data in a data descriptor
+        yield self.written(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x08, 8, dos_time, dos_date, 0, 0, 0,
+                                       len(name), 0) + name)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc, size, compressed_size = 0, 0, 0
+        for part in parts:
+            crc = zlib.crc32(part, crc)
+            size += len(part)
+            data = compressor.compress(part)
+            if data:
+                compressed_size += len(data)
+                yield self.written(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        crc &= 0xffffffff
+        yield self.written(data + struct.pack('<IIII', 0x08074b50, crc, compressed_size, size))
+        self.entries.append((name, dos_time, dos_date, crc, compressed_size, size, header_offset))
+
+    def close(self):
+        """
+        Yield the central directory that ends the archive
+        """
+        start = self.offset
+        for name, dos_time, dos_date, crc, compressed_size, size, header_offset in self.entries:
+            yield self.written(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x08, 8, dos_time, dos_date,
+                                           crc, compressed_size, size, len(name), 0, 0, 0, 0, 0, header_offset) + name)
+        yield self.written(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                       self.offset - start, start, 0))
+
+    def written(self, data):
+        self.offset += len(data)
+        return data
+
+
+def buffered(parts, size=BUFFER_SIZE):
+    """
+    Join up small byte strings into larger ones of at least size bytes (apart from the last)
+    """
+    buffer, length = [], 0
+    for part in parts:
+        if part:
+            buffer.append(part)
+            length += len(part)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def column_letter(index):
+    """
+    Spreadsheet column name for a zero based column index, e.g. 0 gives A and 27 gives AB
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def clean_text(value):
+    return escape(ILLEGAL_XML.sub(u'', force_unicode(value))).encode('utf-8')
+
+
+def excel_date(value):
+    """
+    Excel's serial number for a date or datetime, in days since the end of 1899. Aware datetimes are given in local time.
+    """
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.get_current_timezone())
+        delta = value - EXCEL_EPOCH
+        return delta.days + (delta.seconds + delta.microseconds / 1e6) / 86400.0
+    return (value - EXCEL_EPOCH.date()).days
+
+
+class Workbook(object):
+    """
+    Generate an XLSX workbook from a list of (sheet name, headings, rows) tuples, where rows is an iterable of lists of
+    cell values. Cells may be None (left empty), numbers, dates, datetimes, booleans, Label for repeated text and any
+    other text, which is written inline.
+    """
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.strings = {}
+
+    def shared(self, text):
+        index = self.strings.get(text)
+        if index is None:
+            index = self.strings[text] = len(self.strings)
+        return index
+
+    def cell(self, ref, value):
+        if value is None or value == u'':
+            return ''
+        if isinstance(value, bool):
+            value = Label(u'Yes' if value else u'No')
+        if isinstance(value, Label):
+            return '<c r="%s" t="s"><v>%d</v></c>' % (ref, self.shared(value))
+        if isinstance(value, (datetime, date)):
+            style = DATETIME_STYLE if isinstance(value, datetime) else DATE_STYLE
+            return '<c r="%s" s="%d"><v>%r</v></c>' % (ref, style, excel_date(value))
+        if isinstance(value, (int, long, float, Decimal)):
+            return '<c r="%s"><v>%s</v></c>' % (ref, value)
+        return '<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (ref, clean_text(value))
+
+    def sheet_xml(self, headings, rows):
+        letters = [column_letter(i) for i in range(len(headings))]
+        yield ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+               '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+               '<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" '
+               'state="frozen"/></sheetView></sheetViews><sheetData>')
+        yield self.row_xml(1, letters, [Label(heading) for heading in headings])
+        for number, row in enumerate(rows, 2):
+            yield self.row_xml(number, letters, row)
+        yield '</sheetData></worksheet>'
+
+    def row_xml(self, number, letters, row):
+        return '<row r="%d">%s</row>' % (
+            number, ''.join(self.cell('%s%d' % (letter, number), value) for letter, value in zip(letters, row))
+        )
+
+    def shared_strings_xml(self):
+        yield ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+               '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" uniqueCount="%d">'
+               % len(self.strings))
+        for text, index in sorted(self.strings.items(), key=lambda item: item[1]):
+            yield '<si><t xml:space="preserve">%s</t></si>' % clean_text(text)
+        yield '</sst>'
+
+    def workbook_xml(self):
+        sheets = ''.join('<sheet name="%s" sheetId="%d" r:id="rId%d"/>' % (clean_text(name), i, i)
+                         for i, (name, headings, rows) in enumerate(self.sheets, 1))
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                '<sheets>%s</sheets></workbook>' % sheets)
+
+    def workbook_rels_xml(self):
+        count = len(self.sheets)
+        rels = ''.join('<Relationship Id="rId%d" Type="%s/worksheet" Target="worksheets/sheet%d.xml"/>'
+                       % (i, RELATIONSHIP_TYPES, i) for i in range(1, count + 1))
+        rels += '<Relationship Id="rId%d" Type="%s/sharedStrings" Target="sharedStrings.xml"/>' % (
+            count + 1, RELATIONSHIP_TYPES)
+        rels += '<Relationship Id="rId%d" Type="%s/styles" Target="styles.xml"/>' % (count + 2, RELATIONSHIP_TYPES)
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">%s'
+                '</Relationships>' % rels)
+
+    def content_types_xml(self):
+        sheets = ''.join('<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="application/'
+                         'vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' % i
+                         for i in range(1, len(self.sheets) + 1))
+        return CONTENT_TYPES_XML % sheets
+
+    def stream(self):
+        """
+        Yield the workbook as a series of byte strings. The sheets go first, as the shared strings table is only
+        complete once every row has been written.
+        """
+        archive = ZipStream()
+        for i, (name, headings, rows) in enumerate(self.sheets, 1):
+            for data in archive.add('xl/worksheets/sheet%d.xml' % i, buffered(self.sheet_xml(headings, rows))):
+                yield data
+        parts = (
+            ('xl/sharedStrings.xml', buffered(self.shared_strings_xml())),
+            ('xl/workbook.xml', [self.workbook_xml()]),
+            ('xl/_rels/workbook.xml.rels', [self.workbook_rels_xml()]),
+            ('xl/styles.xml', [STYLES_XML]),
+            ('_rels/.rels', [ROOT_RELS_XML]),
+            ('[Content_Types].xml', [self.content_types_xml()]),
+        )
+        for name, content in parts:
+            for data in archive.add(name, content):
+                yield data
+        for data in archive.close():
+            yield data
+
+
+RELATIONSHIP_TYPES = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+ROOT_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="%s/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>' % RELATIONSHIP_TYPES
+)
+
+CONTENT_TYPES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/sharedStrings.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '%s</Types>'
+)
+
+# Cell styles: 0 is the default, 1 a date (DATE_STYLE) and 2 a date and time (DATETIME_STYLE)
+STYLES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="2"><numFmt numFmtId="164" formatCode="dd/mm/yyyy"/>'
+    '<numFmt numFmtId="165" formatCode="dd/mm/yyyy hh:mm"/></numFmts>'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill>'
+    '</fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+    '</styleSheet>'
+)
+
+
+# The CAPS workbook. Each sheet is read as plain values in primary key order, a chunk at a time.
+
+def iter_values(queryset, fields):
+    """
+    Yield a dictionary of the given fields for each row of the queryset, fetched in chunks
+    """
+    for chunk in iter_chunks(queryset.values('pk', *fields)):
+        for row in chunk:
+            yield row
+
+
+def label(model, field, key=None):
+    """
+    Column of the label for a choice field, read from the row under key (by default the field name)
+    """
+    choice_set = choices.get(model, field)
+    key = key or field
+    return lambda row: Label(choice_set.label(row[key])) if row[key] is not None else None
+
+
+def answer(field):
+    return lambda row: Label(u'Not Applicable') if row[field] is None else row[field]
+
+
+def value(field):
+    return lambda row: row[field]
+
+
+FORM_COLUMNS = (
+    ('Form ID', value('pk')),
+    ('Case ID', value('case_id')),
+    ('Reported In', value('case_reported')),
+    ('Created By', lambda row: Label(u'{0} {1}'.format(row['created_by__first_name'], row['created_by__last_name']))),
+    ('Created On', value('created_on')),
+    ('Year of Birth', value('year_of_birth')),
+    ('Ethnic Group', label(CapsForm, 'ethnic_group')),
+    ('Marital Status', label(CapsForm, 'marital_status')),
+    ('Employed', value('employed')),
+    ('Occupation', value('occupation')),
+    ('Height (cm)', value('height')),
+    ('Weight (kg)', value('weight')),
+    ('Smoking Status', label(CapsForm, 'smoking')),
+    ('Pregnancies 24+ Weeks', value('gravidity_24plus')),
+    ('Pregnancies Under 24 Weeks', value('gravidity_24minus')),
+    ('Previous Pregnancy Problems', answer('previous_pregnancy_problem')),
+    ('Heart Disease', value('heart_disease')),
+    ('Cardiac Arrest', value('cardiac_arrest')),
+    ('Cardiac Arrest Date', value('cardiac_arrest_date')),
+    ('Cardiac Arrest Cause', value('cardiac_arrest_cause')),
+    ('Drug Use', value('drug_use')),
+    ('Medical Problems', value('previous_medical_problem')),
+    # Added after the rest, so the existing columns keep their places
+    ('Expected Due Date', value('expected_due_date')),
+)
+FORM_FIELDS = ('case_id', 'case_reported', 'created_by__first_name', 'created_by__last_name', 'created_on',
+               'expected_due_date', 'year_of_birth', 'ethnic_group', 'marital_status', 'employed', 'occupation',
+               'height', 'weight', 'smoking', 'gravidity_24plus', 'gravidity_24minus', 'previous_pregnancy_problem',
+               'heart_disease', 'cardiac_arrest', 'cardiac_arrest_date', 'cardiac_arrest_cause', 'drug_use',
+               'previous_medical_problem')
+
+
+def history_columns(model):
+    return (
+        ('Form ID', value('form')),
+        ('Case ID', value('form__case_id')),
+        (force_unicode(model._meta.verbose_name).capitalize(), label(model, 'type')),
+        ('Additional Information', value('details')),
+    )
+
+
+DRUG_USE_COLUMNS = (
+    ('Form ID', value('person')),
+    ('Case ID', value('person__case_id')),
+    ('Drug', lambda row: Label(row['drug__name'])),
+    ('Drug Type', label(Drug, 'type', 'drug__type')),
+    ('UK Classification', label(Drug, 'uk_class', 'drug__uk_class')),
+    ('Last Used', value('last_use')),
+    ('Last Use Unknown', value('last_use_unknown')),
+)
+
+
+def sheet(name, columns, queryset, fields):
+    rows = ([column(row) for heading, column in columns] for row in iter_values(queryset, fields))
+    return name, [heading for heading, column in columns], rows
+
+
+def caps_workbook():
+    """
+    The CAPS data as a Workbook, with a sheet for the forms and one for each history
+    """
+    sheets = [sheet('CAPS Forms', FORM_COLUMNS, CapsForm.objects.all(), FORM_FIELDS)]
+    for model, name in ((PregnancyProblem, 'Pregnancy Problems'), (HeartDisease, 'Heart Disease'),
+                        (MedicalProblem, 'Medical Problems')):
+        sheets.append(sheet(name, history_columns(model), model.objects.all(),
+                            ('form', 'form__case_id', 'type', 'details')))
+    sheets.append(sheet('Drug Use', DRUG_USE_COLUMNS, DrugUse.objects.all(),
+                        ('person', 'person__case_id', 'drug__name', 'drug__type', 'drug__uk_class', 'last_use',
+                         'last_use_unknown')))
+    return Workbook(sheets)
+
+
+def xlsx_response(chunks, filename='caps-forms.xlsx'):
+    """
+    Build a response that streams a workbook to the client as it is generated, from the chunks of Workbook.stream()
+    """
+    response = HttpResponse(chunks, content_type=CONTENT_TYPE)
+    response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+    return response
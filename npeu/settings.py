@@ -60,10 +60,16 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # First, so that its timing covers the rest
+    'caps.middleware.InstrumentationMiddleware',
+    # Before anything that reads from the database, so that a browser that has just saved is kept on the primary
+    'caps.replicas.ReplicaMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # After the authentication, so that it knows who is making the changes it records
+    'caps.audit.AuditMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -96,8 +102,103 @@ INSTALLED_APPS = (
     'caps'
 )
 
+# Read replicas (see caps/replicas.py): aliases in DATABASES that the exports, the summary, the API and the forms list
+# read from, how long someone is kept on the primary after saving, and how often each replica is checked
+DATABASE_ROUTERS = ['caps.replicas.ReplicaRouter']
+CAPS_REPLICAS = []
+CAPS_REPLICA_STICKY_SECONDS = 10
+CAPS_REPLICA_CHECK_SECONDS = 30
+
+# Caching (see caps/cache.py). The default cache is the shared tier behind each process's own copies of the reference
+# data, and holds each form's line of the CSV export and API serialisation, so it needs to hold an entry for every
+# form. In memory it is only shared within a process: with several server processes, use memcached or the file based
+# cache so they share entries and invalidations, e.g.
+#     'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache', 'LOCATION': '127.0.0.1:11211',
+#     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/var/tmp/caps-cache',
+# The per form values are only cached in a cache shared between processes like these, and are built every time with
+# the in-memory one.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'caps',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+CAPS_SHARED_CACHE = 'default'
+CAPS_CACHE_LOCAL_MAX_ENTRIES = 1000
+
+# Where batches of PDF print outs of the forms are written, and how many processes render them (None for one per CPU)
+CAPS_PDF_ROOT = os.path.join(PROJECT_ROOT, '..', 'pdf')
+CAPS_PDF_PROCESSES = None
+# The Python interpreter the rendering process is started with. sys.executable is the server binary under uwsgi or
+# mod_wsgi, so this is the python of the environment the site runs in.
+CAPS_PDF_PYTHON = os.path.join(sys.prefix, 'bin', 'python')
+
+# Follow-up reminders (see caps/followup.py) are sent by this class. The email backend sends them from
+# DEFAULT_FROM_EMAIL, which should be set in settings_local along with the EMAIL_* settings.
+CAPS_FOLLOWUP_BACKEND = 'caps.followup.EmailBackend'
+
+# Request instrumentation (see caps/middleware.py): the share of requests recorded in full, how slow a request has to
+# be to always be logged, and how many times a query has to run in one request to be reported as repeated
+CAPS_INSTRUMENT_SAMPLE_RATE = 0.05
+CAPS_INSTRUMENT_SLOW_MS = 1000
+CAPS_INSTRUMENT_REPEAT_THRESHOLD = 5
+CAPS_REQUEST_LOG = os.path.join(PROJECT_ROOT, '..', 'requests.log')
+
+# Logging. As Django's default, errors in requests are mailed to the admins when DEBUG is off, and the request
+# instrumentation is written to a rotating log file, which caps_request_report summarises.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'require_debug_false': {
+            '()': 'django.utils.log.RequireDebugFalse',
+        },
+    },
+    'formatters': {
+        'message': {
+            'format': '%(message)s',
+        },
+    },
+    'handlers': {
+        'mail_admins': {
+            'level': 'ERROR',
+            'filters': ['require_debug_false'],
+            'class': 'django.utils.log.AdminEmailHandler',
+        },
+        'requests_file': {
+            'level': 'INFO',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': CAPS_REQUEST_LOG,
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'delay': True,
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'django.request': {
+            'handlers': ['mail_admins'],
+            'level': 'ERROR',
+            'propagate': True,
+        },
+        'caps.requests': {
+            'handlers': ['requests_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 # Last but not least, import the local hosting settings
 try:
     from settings_local import *
 except ImportError:
     pass
+
+# The request log goes wherever settings_local puts CAPS_REQUEST_LOG
+if 'requests_file' in LOGGING.get('handlers', {}):
+    LOGGING['handlers']['requests_file']['filename'] = CAPS_REQUEST_LOG
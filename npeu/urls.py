@@ -7,8 +7,19 @@ urlpatterns = patterns('',
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
     # Uncomment the next line to enable the admin:
+    url(r'^admin/caps/capsform/view/all/xlsx/$', 'caps.views.admin_view_all_xlsx', name='caps_export_xlsx'),
     url(r'^admin/caps/capsform/view/all/', 'caps.views.admin_view_all_csv'),
+    url(r'^admin/caps/capsform/summary/$', 'caps.views.admin_summary', name='caps_summary'),
+    url(r'^admin/caps/pdfbatch/(?P<batch_id>\d+)/progress/$', 'caps.views.pdf_progress', name='caps_pdf_progress'),
+    url(r'^admin/caps/pdfbatch/(?P<batch_id>\d+)/download/$', 'caps.views.pdf_download', name='caps_pdf_download'),
+    url(r'^admin/caps/drug/search/$', 'caps.views.drug_search', name='caps_drug_search'),
+    url(r'^admin/caps/cache/$', 'caps.views.cache_stats', name='caps_cache_stats'),
+    url(r'^admin/caps/pool/$', 'caps.views.pool_stats', name='caps_pool_stats'),
     url(r'^admin/', include(admin.site.urls)),
 
+    # Read-only JSON API
+    url(r'^api/v1/forms/$', 'caps.api.form_list', name='caps_api_forms'),
+    url(r'^api/v1/forms/(?P<form_id>\d+)/$', 'caps.api.form_detail', name='caps_api_form'),
+
     url(r'^$', 'caps.views.home', name='home'),
 )